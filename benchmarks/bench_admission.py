@@ -0,0 +1,110 @@
+# Fairness and load shedding check. One heavy user keeps many concurrent requests with long
+# prompts in flight while a few light users chat normally, against a fake upstream that can only
+# generate FAKE_CONCURRENCY completions at once. The run is repeated without admission control
+# (CHAT_MAX_CONCURRENT=0, every request goes straight to the saturated upstream) and with it.
+# Reports the light users' latency, the heavy user's throughput, the 429/503 responses and the
+# server's admission stats. Exits non-zero if a light user's request failed or fair queuing did
+# not lower the light users' p99 latency.
+#
+# Usage: python benchmarks/bench_admission.py [--server asgi] [--heavy 40] [--light 5] [--turns 5]
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+
+import httpx
+
+from harness import latency_summary, start_server, start_upstream, stop, upstream_env
+
+SERVER_PORT = 5081
+UPSTREAM_CONCURRENCY = 4
+# Words in each of the heavy user's questions, standing in for a long history
+HEAVY_PROMPT_WORDS = 2000
+
+
+async def chat(client, user_name, text):
+    # Returns the status and the Retry-After of a rejected request
+    response = await client.post(f"http://127.0.0.1:{SERVER_PORT}/api/chat",
+                                 json={"input": text, "user_name": user_name})
+    await response.aread()
+    if response.status_code == 200 and ('"error"' in response.text or "error occurred" in response.text):
+        return 500, None
+    return response.status_code, response.headers.get('retry-after')
+
+
+async def heavy_worker(index, stop_event, counts):
+    question = " ".join(["context"] * HEAVY_PROMPT_WORDS) + f" question {index}"
+    async with httpx.AsyncClient(timeout=120) as client:
+        while not stop_event.is_set():
+            status, retry_after = await chat(client, "heavy", question)
+            counts[status] = counts.get(status, 0) + 1
+            if status != 200:
+                await asyncio.sleep(float(retry_after or 1))
+
+
+async def light_user(index, turns, latencies, counts):
+    async with httpx.AsyncClient(timeout=120) as client:
+        for turn in range(turns):
+            start_time = time.perf_counter()
+            status, _ = await chat(client, f"light{index}", f"Short question {turn}")
+            counts[status] = counts.get(status, 0) + 1
+            if status == 200:
+                latencies.append(time.perf_counter() - start_time)
+
+
+async def drive(heavy, light, turns):
+    stop_event = asyncio.Event()
+    heavy_counts, light_counts, light_latencies = {}, {}, []
+    heavy_tasks = [asyncio.create_task(heavy_worker(i, stop_event, heavy_counts)) for i in range(heavy)]
+    # Let the heavy user fill the queue first
+    await asyncio.sleep(1)
+    start_time = time.perf_counter()
+    await asyncio.gather(*(light_user(i, turns, light_latencies, light_counts) for i in range(light)))
+    wall = time.perf_counter() - start_time
+    stop_event.set()
+    await asyncio.gather(*heavy_tasks)
+    async with httpx.AsyncClient() as client:
+        admission = (await client.get(f"http://127.0.0.1:{SERVER_PORT}/api/admission/stats")).json()
+    return {
+        "light": dict(latency_summary(light_latencies), statuses=light_counts),
+        "heavy": {"statuses": heavy_counts, "answered_per_sec": round(heavy_counts.get(200, 0) / wall, 2)},
+        "admission": admission,
+    }
+
+
+def run(server_name, heavy, light, turns, env):
+    processes = [start_upstream(env)]
+    try:
+        processes.append(start_server(server_name, SERVER_PORT, env))
+        return asyncio.run(drive(heavy, light, turns))
+    finally:
+        stop(processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-user fairness and load shedding under a heavy user")
+    parser.add_argument('--server', default='asgi', choices=['default', 'stream', 'asgi'])
+    parser.add_argument('--heavy', type=int, default=40, help="concurrent requests of the heavy user")
+    parser.add_argument('--light', type=int, default=5, help="number of light users")
+    parser.add_argument('--turns', type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, max_concurrent in (("unlimited", 0), ("fair", UPSTREAM_CONCURRENCY)):
+            env = upstream_env(FAKE_TTFT_MS=200, FAKE_TOKENS_PER_SEC=200, FAKE_COMPLETION_TOKENS=40,
+                               FAKE_CONCURRENCY=UPSTREAM_CONCURRENCY, CHAT_MAX_CONCURRENT=max_concurrent,
+                               CHAT_HISTORY_DIR=directory, CHAT_LOG_LEVEL="ERROR")
+            results[name] = run(args.server, args.heavy, args.light, args.turns, env)
+
+    print(json.dumps({"server": args.server, "results": results}, indent=2))
+    if any(status != 200 for result in results.values() for status in result['light']['statuses']):
+        sys.exit("A light user's request failed or was shed")
+    if results['fair']['light']['p99_ms'] >= results['unlimited']['light']['p99_ms']:
+        sys.exit("Fair queuing did not lower the light users' p99 latency")
+
+
+if __name__ == '__main__':
+    main()
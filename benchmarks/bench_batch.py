@@ -0,0 +1,101 @@
+# Throughput of /api/chat/batch against one /api/chat request per prompt. Sends --prompts
+# distinct prompts through the fake upstream both ways: one at a time over a keep-alive
+# connection (what a job built on the interactive client does), then as batches of --batch-size
+# answered --concurrency at a time. Reports prompts/s for each, and checks that every prompt of the
+# batches got exactly one result with its input index and the fake upstream's answer.
+#
+# Usage: python benchmarks/bench_batch.py [--server default] [--prompts 200] [--batch-size 100] [--concurrency 8]
+import argparse
+import json
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fake_upstream import completion_tokens
+from harness import start_server, start_upstream, stop, upstream_env
+
+SERVER_PORT = 5131
+COMPLETION_TOKENS = 40
+
+
+def run_sequential(prompts):
+    started = time.perf_counter()
+    with httpx.Client(timeout=60) as client:
+        for prompt in prompts:
+            # A new session each time, so the prompts stay independent like the batch items
+            client.cookies.clear()
+            response = client.post(f"http://127.0.0.1:{SERVER_PORT}/api/chat", json={"input": prompt, "user_name": "bench"})
+            response.raise_for_status()
+            # The streaming servers answer with NDJSON, read it to the end
+            response.read()
+    return time.perf_counter() - started
+
+
+def run_batches(prompts, batch_size, concurrency):
+    results = []
+    started = time.perf_counter()
+    with httpx.Client(timeout=120) as client:
+        for offset in range(0, len(prompts), batch_size):
+            items = [{"id": str(offset + i), "input": prompt} for i, prompt in enumerate(prompts[offset:offset + batch_size])]
+            with client.stream('POST', f"http://127.0.0.1:{SERVER_PORT}/api/chat/batch",
+                               json={"user_name": "bench", "concurrency": concurrency, "items": items}) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line:
+                        results.append(dict(json.loads(line), offset=offset))
+    return time.perf_counter() - started, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch endpoint against one request per prompt")
+    parser.add_argument('--server', default='default', choices=['default', 'stream', 'asgi'])
+    parser.add_argument('--prompts', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    prompts = [f"Question {i}: summarize item {i} of the nightly job" for i in range(args.prompts)]
+    with tempfile.TemporaryDirectory() as directory:
+        env = upstream_env(FAKE_TTFT_MS=100, FAKE_TOKENS_PER_SEC=400, FAKE_COMPLETION_TOKENS=COMPLETION_TOKENS,
+                           CHAT_BATCH_CONCURRENCY=args.concurrency, CHAT_HISTORY_DIR=directory, CHAT_LOG_LEVEL="ERROR")
+        processes = [start_upstream(env)]
+        try:
+            processes.append(start_server(args.server, SERVER_PORT, env))
+            sequential_seconds = run_sequential(prompts)
+            batch_seconds, results = run_batches(prompts, args.batch_size, args.concurrency)
+        finally:
+            stop(processes)
+
+    expected = "".join(completion_tokens(COMPLETION_TOKENS))
+    answers = [r for r in results if 'done' not in r]
+    summaries = [r for r in results if 'done' in r]
+    indexes = sorted(r['offset'] + r['index'] for r in answers)
+    problems = []
+    if indexes != list(range(args.prompts)):
+        problems.append("prompts without exactly one result")
+    if any(r['id'] != str(r['offset'] + r['index']) for r in answers):
+        problems.append("results tagged with the wrong index")
+    if any('error' in r or r['response'] != expected for r in answers):
+        problems.append("failed or wrong answers")
+    if len(summaries) != -(-args.prompts // args.batch_size):
+        problems.append("batches without a summary line")
+
+    report = {
+        "server": args.server,
+        "prompts": args.prompts,
+        "sequential": {"seconds": round(sequential_seconds, 2), "prompts_per_sec": round(args.prompts / sequential_seconds, 1)},
+        "batch": {"seconds": round(batch_seconds, 2), "prompts_per_sec": round(args.prompts / batch_seconds, 1)},
+        "speedup": round(sequential_seconds / batch_seconds, 1),
+        # Results come back as they complete, not in input order
+        "in_input_order": [r['index'] for r in answers] == sorted(r['index'] for r in answers),
+        "errors": sum(r['errors'] for r in summaries),
+    }
+    print(json.dumps(report, indent=2))
+    if problems:
+        sys.exit("; ".join(problems))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# Measures bytes written to disk per turn by the old whole-session rewrite (Flask-Session's
+# filesystem backend pickles the entire session on every request) and by the append-only
+# conversation store.
+#
+# Usage: python benchmarks/bench_conversation_store.py [--turns 1 50 500]
+import argparse
+import json
+import os
+import pickle
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'server'))
+from conversation_store import ConversationStore  # noqa: E402
+
+USER_TEXT = "Can you tell me more about the MAINSTREAM AIIO Framework and how it helps with project management?"
+ASSISTANT_TEXT = ("Of course! The MAINSTREAM AIIO Framework brings AI into everyday marketing, IT and "
+                  "project management workflows. ") * 4
+
+
+def load_system_context():
+    with open(os.path.join(os.path.dirname(__file__), '..', 'server', 'system_context.txt'), 'r') as file:
+        return json.load(file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes written per turn benchmark")
+    parser.add_argument('--turns', type=int, nargs='+', default=[1, 50, 500])
+    args = parser.parse_args()
+
+    report_turns = set(args.turns)
+    system_context = load_system_context()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = ConversationStore(directory)
+        session = {"messages": list(system_context), "init_done": True, "user_name": "User123"}
+        conversation_id = store.create(system_context, [0] * len(system_context))
+
+        print(f"{'turn':>6} {'session rewrite (bytes)':>24} {'append-only (bytes)':>20}")
+        for turn in range(1, max(report_turns) + 1):
+            user_message = {"role": "user", "content": f"{USER_TEXT} ({turn})"}
+            assistant_message = {"role": "assistant", "content": f"{ASSISTANT_TEXT} ({turn})"}
+
+            # One request per turn, each rewrites the pickled session after the messages change
+            session['messages'].append(user_message)
+            session['messages'].append(assistant_message)
+            rewrite_bytes = len(pickle.dumps(dict(session)))
+
+            before = store.bytes_written
+            store.append(conversation_id, user_message, 20)
+            store.append(conversation_id, assistant_message, 100)
+            append_bytes = store.bytes_written - before
+
+            if turn in report_turns:
+                print(f"{turn:>6} {rewrite_bytes:>24} {append_bytes:>20}")
+
+
+if __name__ == '__main__':
+    main()
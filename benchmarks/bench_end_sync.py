@@ -0,0 +1,97 @@
+# Request size and latency of /api/chat/end. A conversation of --turns turns is held with a
+# streaming server through the fake upstream, then ended three ways: the legacy upload of the
+# whole conversation, the same upload gzip-compressed, and the delta sync request (conversation
+# id and sequence number, with no messages left to send). Reports the bytes sent and the p50/p95
+# time to end a conversation, and checks that the saved conversations have every message.
+#
+# Usage: python benchmarks/bench_end_sync.py [--server asgi] [--turns 20] [--conversations 20]
+import argparse
+import gzip
+import json
+import sys
+import tempfile
+import time
+
+import httpx
+
+from harness import latency_summary, start_server, start_upstream, stop, upstream_env
+
+SERVER_PORT = 5111
+
+
+def hold_conversation(client, turns):
+    # Local copy of the conversation, and the id and sequence number the server acknowledged
+    conversation = []
+    conversation_id, seq = None, 0
+    for turn in range(turns):
+        user_input = f"Question {turn}: " + "please explain this in detail " * 5
+        conversation.append({"role": "user", "content": user_input})
+        answer = ""
+        with client.stream('POST', f"http://127.0.0.1:{SERVER_PORT}/api/chat",
+                           json={"input": user_input, "user_name": "bench"}) as response:
+            response.raise_for_status()
+            conversation_id = response.headers.get('x-conversation-id')
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                seq = data.get('seq', seq)
+                for choice in data.get('choices', []):
+                    answer += choice['delta'].get('content') or ""
+        conversation.append({"role": "assistant", "content": answer})
+    return conversation, conversation_id, seq
+
+
+def end_request(mode, conversation, conversation_id, seq):
+    # (body, headers) for each way of ending the chat
+    if mode == 'delta':
+        return json.dumps({"conversation_id": conversation_id, "base_seq": seq, "messages": []}).encode(), {}
+    body = json.dumps(conversation).encode()
+    if mode == 'legacy_gzip':
+        return gzip.compress(body), {"Content-Encoding": "gzip"}
+    return body, {}
+
+
+def run_mode(mode, turns, conversations):
+    sizes, latencies, saved_lengths = [], [], []
+    for _ in range(conversations):
+        with httpx.Client(timeout=60) as client:
+            conversation, conversation_id, seq = hold_conversation(client, turns)
+            body, headers = end_request(mode, conversation, conversation_id, seq)
+            start_time = time.perf_counter()
+            response = client.post(f"http://127.0.0.1:{SERVER_PORT}/api/chat/end", content=body,
+                                   headers=dict(headers, **{"Content-Type": "application/json"}))
+            latencies.append(time.perf_counter() - start_time)
+            response.raise_for_status()
+            sizes.append(len(body))
+            saved_lengths.append(response.json().get('seq', len(conversation)))
+    return dict(latency_summary(latencies), request_bytes=round(sum(sizes) / len(sizes)),
+                all_messages_saved=all(length == turns * 2 for length in saved_lengths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes and latency of ending a chat")
+    parser.add_argument('--server', default='asgi', choices=['stream', 'asgi'])
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--conversations', type=int, default=20)
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        env = upstream_env(FAKE_TTFT_MS=0, FAKE_TOKENS_PER_SEC=100000, FAKE_COMPLETION_TOKENS=150,
+                           CHAT_HISTORY_DIR=directory, CHAT_LOG_LEVEL="ERROR")
+        processes = [start_upstream(env)]
+        try:
+            processes.append(start_server(args.server, SERVER_PORT, env))
+            for mode in ('legacy', 'legacy_gzip', 'delta'):
+                results[mode] = run_mode(mode, args.turns, args.conversations)
+        finally:
+            stop(processes)
+
+    print(json.dumps({"server": args.server, "turns": args.turns, "results": results}, indent=2))
+    if not results['delta']['all_messages_saved']:
+        sys.exit("A delta-synced conversation was saved without all of its messages")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Tail latency check for upstream deadlines and hedging. A fraction of the fake upstream's
+# requests stall before their first token (FAKE_STALL_RATE, FAKE_STALL_MS). The same stream of
+# requests is sent with the default deadlines, with a short first-token deadline (stalled calls
+# are retried) and with hedging (a duplicate is sent after the recent p95 time-to-first-token).
+# Reports client-side time-to-first-token percentiles, failures, upstream requests per answer and
+# the server's hedging stats. Exits non-zero if a request failed in the deadline or hedged runs,
+# or if hedging did not lower the p99 time-to-first-token.
+#
+# Usage: python benchmarks/bench_hedging.py [--server asgi] [--requests 300] [--concurrency 10]
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+
+import httpx
+
+from harness import UPSTREAM_PORT, latency_summary, start_server, start_upstream, stop, upstream_env
+
+SERVER_PORT = 5091
+
+
+async def one_stream(client, index, ttfts, counts):
+    start_time = time.perf_counter()
+    ttft = None
+    try:
+        async with client.stream('POST', f"http://127.0.0.1:{SERVER_PORT}/api/chat",
+                                 json={"input": f"Question {index}", "user_name": f"bench{index}"}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                if 'error' in json.loads(line):
+                    counts['errors'] += 1
+                    return
+                if ttft is None:
+                    ttft = time.perf_counter() - start_time
+    except (httpx.HTTPError, ValueError):
+        counts['errors'] += 1
+        return
+    counts['answered'] += 1
+    ttfts.append(ttft)
+
+
+async def drive(requests, concurrency):
+    counts = {"answered": 0, "errors": 0}
+    ttfts = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            # A new client per request, so every request starts a fresh session
+            async with httpx.AsyncClient(timeout=120) as client:
+                await one_stream(client, index, ttfts, counts)
+
+    await asyncio.gather(*(limited(i) for i in range(requests)))
+    async with httpx.AsyncClient() as client:
+        upstream = (await client.get(f"http://127.0.0.1:{UPSTREAM_PORT}/stats")).json()
+        hedging = (await client.get(f"http://127.0.0.1:{SERVER_PORT}/api/upstream/stats")).json()['hedging']
+    return dict(counts, **{f"ttft_{key}": value for key, value in latency_summary(ttfts).items()},
+                upstream_per_answer=round(upstream['requests'] / max(1, counts['answered']), 2),
+                upstream_stalled=upstream['stalled'], hedging=hedging)
+
+
+def run(server_name, requests, concurrency, env):
+    processes = [start_upstream(env)]
+    try:
+        processes.append(start_server(server_name, SERVER_PORT, env))
+        return asyncio.run(drive(requests, concurrency))
+    finally:
+        stop(processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first token with stalled upstream calls")
+    parser.add_argument('--server', default='asgi', choices=['stream', 'asgi'])
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--stall-rate', type=float, default=0.03)
+    parser.add_argument('--stall-ms', type=int, default=5000)
+    args = parser.parse_args()
+
+    configurations = {
+        "baseline": {},
+        "deadline": {"CHAT_UPSTREAM_TTFT_TIMEOUT": 1},
+        "hedged": {"CHAT_UPSTREAM_HEDGE": 1},
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, settings in configurations.items():
+            env = upstream_env(FAKE_TTFT_MS=100, FAKE_TOKENS_PER_SEC=1000, FAKE_COMPLETION_TOKENS=20,
+                               FAKE_STALL_RATE=args.stall_rate, FAKE_STALL_MS=args.stall_ms,
+                               CHAT_HISTORY_DIR=directory, CHAT_LOG_LEVEL="ERROR", **settings)
+            results[name] = run(args.server, args.requests, args.concurrency, env)
+
+    print(json.dumps({"server": args.server, "results": results}, indent=2))
+    if results['deadline']['errors'] or results['hedged']['errors']:
+        sys.exit("Requests failed despite retries or hedging")
+    if results['hedged']['ttft_p99_ms'] >= results['baseline']['ttft_p99_ms']:
+        sys.exit("Hedging did not lower the p99 time to first token")
+
+
+if __name__ == '__main__':
+    main()
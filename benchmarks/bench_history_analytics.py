@@ -0,0 +1,123 @@
+# Throughput of the history analytics. Writes a synthetic archive of --conversations
+# conversations (history writer segments plus client files, every message with its own text) to
+# a temporary directory. Counts it one message at a time with TokenCounter, the way the servers
+# count live messages, and then with analyze() and --workers tokenizer processes. Reports
+# messages/s and messages/s per core for each.
+#
+# Also checks the incremental runs:
+#   - a second run with the same state counts nothing
+#   - after more conversations are written, only those are counted
+#   - the totals then equal a --full recount
+#
+# Usage: python benchmarks/bench_history_analytics.py [--conversations 5000] [--turns 10] [--workers 0 1 2 4]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'server'))
+from history_analytics import analyze, read_conversations  # noqa: E402
+from history_writer import HistoryWriter  # noqa: E402
+from startup import LazyEncoding  # noqa: E402
+from token_counter import TokenCounter  # noqa: E402
+
+USER_TEXT = "Can you tell me more about the MAINSTREAM AIIO Framework and how it helps with project management?"
+ASSISTANT_TEXT = ("Of course! The MAINSTREAM AIIO Framework brings AI into everyday marketing, IT and "
+                  "project management workflows. ") * 4
+CLIENT_EVERY = 10
+
+
+def make_conversation(index, turns):
+    messages = [{"role": "system", "content": "You are a helpful assistant."}]
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"{USER_TEXT} ({index}/{turn})"})
+        messages.append({"role": "assistant", "content": f"{ASSISTANT_TEXT} ({index}/{turn})"})
+    return messages
+
+
+def write_archive(server_directory, client_directory, start, count, turns):
+    # Every CLIENT_EVERY-th conversation goes to the client's archive, the rest to the server's
+    writer = HistoryWriter(server_directory)
+    for index in range(start, start + count):
+        messages = make_conversation(index, turns)
+        if index % CLIENT_EVERY:
+            writer.submit(f"user{index % 50}", messages)
+        else:
+            day = 1 + index % 28
+            with open(os.path.join(client_directory, f"2024-01-{day:02d}_12-00-{index % 60:02d}_conversation_client{index}.json"), 'w') as f:
+                json.dump(messages[1:], f)
+    writer.close()
+
+
+def one_at_a_time(directories):
+    counter = TokenCounter(LazyEncoding("gpt-4o").get())
+    messages = 0
+    started = time.perf_counter()
+    for directory, source in zip(directories, ('server', 'client')):
+        for name in sorted(os.listdir(directory)):
+            for conversation in read_conversations(os.path.join(directory, name), source):
+                counter.count_messages(conversation.messages)
+                messages += len(conversation.messages)
+    elapsed = time.perf_counter() - started
+    return {"messages": messages, "seconds": round(elapsed, 3), "workers": 0,
+            "messages_per_sec": round(messages / elapsed), "messages_per_sec_per_core": round(messages / elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="History analytics throughput and incremental runs")
+    parser.add_argument('--conversations', type=int, default=5000)
+    parser.add_argument('--turns', type=int, default=10)
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        server_directory = os.path.join(root, 'server')
+        client_directory = os.path.join(root, 'client')
+        os.makedirs(client_directory)
+        directories = [server_directory, client_directory]
+        state_path = os.path.join(root, 'analytics-state.json')
+        first = args.conversations // 2
+        write_archive(server_directory, client_directory, 0, first, args.turns)
+
+        runs = {"one_message_at_a_time": one_at_a_time(directories)}
+        reports = []
+        for workers in args.workers:
+            report, run = analyze(directories, workers=workers)
+            runs[f"analyze_{workers}_workers"] = run
+            reports.append(report)
+
+        # Incremental: count the first half, then only what was written since
+        _, initial = analyze(directories, state_path, workers=args.workers[-1])
+        _, unchanged = analyze(directories, state_path, workers=args.workers[-1])
+        write_archive(server_directory, client_directory, first, args.conversations - first, args.turns)
+        incremental, added = analyze(directories, state_path, workers=args.workers[-1])
+        full, _ = analyze(directories, full=True, workers=args.workers[-1])
+
+    messages_per_conversation = 1 + 2 * args.turns
+    expected_added = sum(messages_per_conversation - (index % CLIENT_EVERY == 0)
+                         for index in range(first, args.conversations))
+    problems = []
+    if any(report != reports[0] for report in reports):
+        problems.append("worker counts gave different totals")
+    if unchanged['messages']:
+        problems.append(f"a run without new files counted {unchanged['messages']} messages")
+    if added['messages'] != expected_added:
+        problems.append(f"the incremental run counted {added['messages']} messages, expected {expected_added}")
+    if incremental != full:
+        problems.append("incremental totals differ from a full recount")
+
+    print(json.dumps({
+        "conversations": args.conversations,
+        "messages": full['messages'],
+        "runs": runs,
+        "incremental": {"initial": initial['messages'], "unchanged": unchanged['messages'], "added": added['messages']},
+        "tokens_by_role": full['by_role'],
+    }, indent=2))
+    if problems:
+        sys.exit("; ".join(problems))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# Lookup latency of the chat history index at archive scale. Fills an index with synthetic rows
+# (10^6 by default, no segment data is written), then times the queries behind the history
+# endpoints: a user's latest conversations, a time range, a token range and a lookup by id.
+# For comparison it also times finding one user's files by listing a directory of
+# chat_<user>_<timestamp>.json names, the way the original layout has to be searched.
+#
+# Usage: python benchmarks/bench_history_index.py [--conversations 1000000] [--users 10000]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'server'))
+from history_index import HistoryIndex  # noqa: E402
+from harness import latency_summary  # noqa: E402
+
+START_TIME = datetime(2024, 1, 1)
+
+
+def fill(index, conversations, users):
+    batch = []
+    for i in range(conversations):
+        saved_at = (START_TIME + timedelta(seconds=i * 30)).isoformat()
+        record = {"conversation_id": f"{i:032x}", "user_name": f"user{i % users}", "saved_at": saved_at,
+                  "total_tokens": random.randint(50, 4000), "messages": [None] * random.randint(2, 40)}
+        batch.append((record, "history-bench.jsonl", i * 1000, 1000, 0, 1000))
+        if len(batch) >= 10000:
+            index.add_many(batch)
+            batch = []
+    if batch:
+        index.add_many(batch)
+
+
+def time_queries(name, queries, run):
+    samples = []
+    for query in queries:
+        start_time = time.perf_counter()
+        run(query)
+        samples.append(time.perf_counter() - start_time)
+    print(f"{name:<28} {latency_summary(samples)}")
+
+
+def directory_scan(conversations, users, samples):
+    # The original layout: find a user's conversations by listing and matching file names
+    with tempfile.TemporaryDirectory() as directory:
+        for i in range(conversations):
+            saved_at = (START_TIME + timedelta(seconds=i * 30)).strftime('%Y-%m-%d_%H-%M-%S')
+            open(os.path.join(directory, f"chat_user{i % users}_{saved_at}.json"), 'w').close()
+        queries = [f"chat_user{random.randrange(users)}_" for _ in range(samples)]
+        time_queries(f"directory scan ({conversations:,})", queries,
+                     lambda prefix: [name for name in os.listdir(directory) if name.startswith(prefix)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat history index lookup benchmark")
+    parser.add_argument('--conversations', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--samples', type=int, default=1000, help="Queries timed per lookup type")
+    parser.add_argument('--scan-files', type=int, default=100000,
+                        help="Empty files created for the directory scan comparison, 0 to skip")
+    args = parser.parse_args()
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        index = HistoryIndex(directory)
+        start_time = time.perf_counter()
+        fill(index, args.conversations, args.users)
+        print(f"Indexed {args.conversations:,} conversations in {time.perf_counter() - start_time:.1f}s, "
+              f"{os.path.getsize(index.path) / 1e6:.1f} MB")
+
+        span = args.conversations * 30
+        users = [f"user{random.randrange(args.users)}" for _ in range(args.samples)]
+        time_queries("latest 50 for a user", users, lambda user: index.list(user_name=user))
+
+        def time_range(_):
+            since = START_TIME + timedelta(seconds=random.randrange(span))
+            return index.list(since=since.isoformat(), until=(since + timedelta(hours=1)).isoformat())
+        time_queries("one hour time range", range(args.samples), time_range)
+
+        def token_range(_):
+            low = random.randint(50, 3900)
+            return index.list(min_tokens=low, max_tokens=low + 10)
+        time_queries("token range", range(args.samples), token_range)
+
+        ids = [f"{random.randrange(args.conversations):032x}" for _ in range(args.samples)]
+        time_queries("lookup by conversation id", ids, index.get)
+
+    if args.scan_files:
+        directory_scan(args.scan_files, args.users, min(args.samples, 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Measures how long a request waits to save a finished conversation: the original
+# json.dump(..., indent=4) into a new file per conversation versus handing it to the
+# background history writer, and the files and bytes each approach leaves on disk.
+#
+# Usage: python benchmarks/bench_history_writer.py [--conversations 2000] [--turns 20]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'server'))
+from history_writer import HistoryWriter, iter_history  # noqa: E402
+from harness import latency_summary  # noqa: E402
+
+USER_TEXT = "Can you tell me more about the MAINSTREAM AIIO Framework and how it helps with project management?"
+ASSISTANT_TEXT = ("Of course! The MAINSTREAM AIIO Framework brings AI into everyday marketing, IT and "
+                  "project management workflows. ") * 4
+
+
+def make_conversation(index, turns):
+    messages = []
+    for turn in range(turns):
+        messages.append({"role": "user", "content": f"{USER_TEXT} ({index}/{turn})"})
+        messages.append({"role": "assistant", "content": f"{ASSISTANT_TEXT} ({index}/{turn})"})
+    return messages
+
+
+def disk_usage(directory):
+    paths = [os.path.join(directory, name) for name in os.listdir(directory)]
+    return len(paths), sum(os.path.getsize(path) for path in paths)
+
+
+def per_file_dump(directory, conversations):
+    waits = []
+    for index, messages in enumerate(conversations):
+        start_time = time.perf_counter()
+        # Unique names so same-second saves do not overwrite each other as they would in the server
+        with open(os.path.join(directory, f"chat_bench{index}_2024-01-01_00-00-00.json"), 'w') as f:
+            json.dump(messages, f, indent=4)
+        waits.append(time.perf_counter() - start_time)
+    return waits
+
+
+def batched_writer(directory, conversations, compression):
+    writer = HistoryWriter(directory, compression=compression)
+    waits = []
+    for messages in conversations:
+        start_time = time.perf_counter()
+        writer.submit("bench", messages)
+        waits.append(time.perf_counter() - start_time)
+    start_time = time.perf_counter()
+    writer.close()
+    return waits, time.perf_counter() - start_time
+
+
+def report(name, directory, waits, drain=None):
+    files, size = disk_usage(directory)
+    line = (f"{name:<14} request wait {latency_summary(waits)}  files {files:>6}  "
+            f"bytes {size:>12,}")
+    if drain is not None:
+        line += f"  drain on close {drain * 1000:.1f} ms"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat history write benchmark")
+    parser.add_argument('--conversations', type=int, default=2000)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--compression', nargs='+', default=['none', 'gzip'], choices=['none', 'gzip', 'zstd'])
+    args = parser.parse_args()
+
+    conversations = [make_conversation(i, args.turns) for i in range(args.conversations)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        report("per-file json", directory, per_file_dump(directory, conversations))
+
+    for compression in args.compression:
+        with tempfile.TemporaryDirectory() as directory:
+            waits, drain = batched_writer(directory, conversations, None if compression == 'none' else compression)
+            report(f"writer {compression}", directory, waits, drain)
+            read_back = sum(1 for _ in iter_history(directory))
+            if read_back != len(conversations):
+                sys.exit(f"Read back {read_back} of {len(conversations)} conversations")
+
+
+if __name__ == '__main__':
+    main()
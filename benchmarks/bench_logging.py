@@ -0,0 +1,45 @@
+# Streaming throughput with verbose, synchronous logging of every chunk and whole
+# conversations (what the servers used to print) versus the default sampled, truncated,
+# queue-based logging.
+#
+# Usage: python benchmarks/bench_logging.py [--server stream] [--clients 20] [--rounds 3]
+import argparse
+import json
+
+from harness import load_recorded_conversations, start_upstream, stop, upstream_env
+from run_benchmarks import SERVER_PORTS, benchmark_server
+
+MODES = {
+    "verbose-sync": {"CHAT_LOG_LEVEL": "DEBUG", "CHAT_LOG_SAMPLE": "", "CHAT_LOG_CONTENT": "full", "CHAT_LOG_ASYNC": "0"},
+    "default": {},
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Logging overhead benchmark")
+    parser.add_argument('--server', default='stream', choices=list(SERVER_PORTS))
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--tokens-per-sec', type=int, default=200)
+    args = parser.parse_args()
+
+    conversations = load_recorded_conversations()
+    base_env = upstream_env(FAKE_TTFT_MS=50, FAKE_TOKENS_PER_SEC=args.tokens_per_sec, CHAT_STREAM_FLUSH_BYTES=0,
+                            CHAT_STREAM_FLUSH_MS=0)
+    results = {}
+    upstream = start_upstream(base_env)
+    try:
+        for mode, settings in MODES.items():
+            env = dict(base_env, **settings)
+            results[mode] = benchmark_server(args.server, env, args.clients, args.rounds, conversations)
+    finally:
+        stop([upstream])
+
+    for mode, result in results.items():
+        print(f"{mode:<13} {result['requests_per_sec']:>8} req/s  p95 {result['latency']['p95_ms']} ms  "
+              f"cpu {result['cpu_ms_per_request']} ms/req")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Latency breakdown from the servers' /metrics endpoint. Sends chat requests to each server
+# through the fake upstream, ends every conversation, then scrapes GET /metrics and reports the
+# mean time and count of every stage (session load, tokenize, admission wait, first token,
+# streaming, history persist, ...), the token counters and the streaming rate. Exits non-zero if
+# a server does not report the stages of a chat turn.
+#
+# Usage: python benchmarks/bench_metrics.py [--servers default,stream,asgi] [--requests 100]
+import argparse
+import asyncio
+import json
+import re
+import sys
+import tempfile
+
+import httpx
+
+from harness import start_server, start_upstream, stop, upstream_env
+
+BASE_PORT = 5101
+SAMPLE = re.compile(r'^(\w+?)(_sum|_count)?(?:\{(.*)\})? (\S+)$')
+EXPECTED_STAGES = {
+    "default": {"session_load", "session_save", "tokenize", "admission_wait", "upstream", "history_persist"},
+    "stream": {"session_load", "tokenize", "admission_wait", "first_token", "streaming", "history_persist"},
+    "asgi": {"session_load", "tokenize", "admission_wait", "first_token", "streaming", "history_persist"},
+}
+
+
+def parse_metrics(text):
+    # {(name, labels): value} for the plain samples, histogram buckets are skipped
+    samples = {}
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if line.startswith('#') or not match or '_bucket' in line:
+            continue
+        name, suffix, labels, value = match.groups()
+        samples[(name + (suffix or ''), labels or '')] = float(value)
+    return samples
+
+
+def stage_breakdown(samples):
+    stages = {}
+    for (name, labels), total in samples.items():
+        if name != 'chat_stage_seconds_sum':
+            continue
+        stage = labels.split('"')[1]
+        count = samples[('chat_stage_seconds_count', labels)]
+        stages[stage] = {"count": int(count), "mean_ms": round(total / count * 1000, 3) if count else 0}
+    return stages
+
+
+async def one_chat(port, index):
+    async with httpx.AsyncClient(timeout=60) as client:
+        response = await client.post(f"http://127.0.0.1:{port}/api/chat",
+                                     json={"input": f"Question {index}", "user_name": f"bench{index % 10}"})
+        response.raise_for_status()
+        await client.post(f"http://127.0.0.1:{port}/api/chat/end", json={"user_name": f"bench{index % 10}"})
+
+
+async def drive(port, requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(index):
+        async with semaphore:
+            await one_chat(port, index)
+
+    await asyncio.gather(*(limited(i) for i in range(requests)))
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"http://127.0.0.1:{port}/metrics")).text
+
+
+def run(server_name, port, requests, concurrency, env):
+    processes = [start_upstream(env)]
+    try:
+        processes.append(start_server(server_name, port, env))
+        samples = parse_metrics(asyncio.run(drive(port, requests, concurrency)))
+    finally:
+        stop(processes)
+    rate_count = samples.get(('chat_stream_tokens_per_second_count', ''), 0)
+    return {
+        "stages": stage_breakdown(samples),
+        "prompt_tokens": samples.get(('chat_upstream_tokens_total', 'kind="prompt"'), 0),
+        "completion_tokens": samples.get(('chat_upstream_tokens_total', 'kind="completion"'), 0),
+        "mean_stream_tokens_per_second": round(samples[('chat_stream_tokens_per_second_sum', '')] / rate_count, 1)
+        if rate_count else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage latency breakdown from /metrics")
+    parser.add_argument('--servers', default='default,stream,asgi')
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+
+    results = {}
+    missing = {}
+    with tempfile.TemporaryDirectory() as directory:
+        env = upstream_env(FAKE_TTFT_MS=50, FAKE_TOKENS_PER_SEC=500, FAKE_COMPLETION_TOKENS=40,
+                           CHAT_HISTORY_DIR=directory, CHAT_LOG_LEVEL="ERROR")
+        for offset, server_name in enumerate(args.servers.split(',')):
+            results[server_name] = run(server_name, BASE_PORT + offset, args.requests, args.concurrency, env)
+            absent = EXPECTED_STAGES[server_name] - set(results[server_name]['stages'])
+            if absent:
+                missing[server_name] = sorted(absent)
+
+    print(json.dumps(results, indent=2))
+    if missing:
+        sys.exit(f"Stages missing from /metrics: {missing}")
+
+
+if __name__ == '__main__':
+    main()
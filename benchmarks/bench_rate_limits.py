@@ -0,0 +1,106 @@
+# Rate limit check. Runs a server against a fake upstream that enforces requests-per-minute and
+# tokens-per-minute limits (FAKE_RPM, FAKE_TPM) and sends a burst of distinct first questions,
+# larger than the per-minute budget, in three configurations:
+#
+#   headers     no configured limits, the scheduler only follows the x-ratelimit-* headers and 429s
+#   configured  CHAT_UPSTREAM_RPM/TPM set to 95% of the upstream's limits, calls wait for budget up front
+#   deadline    configured limits with a short CHAT_UPSTREAM_QUEUE_TIMEOUT, late calls are rejected
+#
+# Reports answered, rejected and failed requests, the 429s the upstream sent and latency. Exits
+# non-zero if a request failed, if the configured run still hit a 429, or if the short deadline
+# did not reject anything.
+#
+# Usage: python benchmarks/bench_rate_limits.py [--server asgi] [--clients 80] [--rpm 60]
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+
+import httpx
+
+from harness import UPSTREAM_PORT, latency_summary, start_server, start_upstream, stop, upstream_env
+
+SERVER_PORT = 5071
+# Error text of a call that could not be scheduled before its deadline
+REJECTED_TEXT = "Upstream rate limit reached"
+# Fraction of the upstream's limits the configured runs use
+LIMIT_HEADROOM = 0.95
+
+
+async def ask(index, counts, latencies):
+    # A new client per request, so every request starts a fresh session
+    start_time = time.perf_counter()
+    async with httpx.AsyncClient(timeout=120) as client:
+        try:
+            response = await client.post(f"http://127.0.0.1:{SERVER_PORT}/api/chat",
+                                         json={"input": f"Question number {index}", "user_name": f"bench{index}"})
+        except httpx.HTTPError:
+            counts['errors'] += 1
+            return
+    if REJECTED_TEXT in response.text:
+        counts['rejected'] += 1
+    elif response.status_code != 200 or '"error"' in response.text or "error occurred" in response.text:
+        counts['errors'] += 1
+    else:
+        counts['answered'] += 1
+        latencies.append(time.perf_counter() - start_time)
+
+
+async def burst(clients):
+    counts = {"answered": 0, "rejected": 0, "errors": 0}
+    latencies = []
+    await asyncio.gather(*(ask(i, counts, latencies) for i in range(clients)))
+    upstream = httpx.get(f"http://127.0.0.1:{UPSTREAM_PORT}/stats").json()
+    scheduler = httpx.get(f"http://127.0.0.1:{SERVER_PORT}/api/upstream/stats").json()
+    return dict(counts, upstream_429s=upstream['rate_limited'], scheduler=scheduler,
+                **latency_summary(latencies))
+
+
+def run(server_name, clients, env):
+    # A fresh upstream per run, so every run starts with a full budget
+    processes = [start_upstream(env)]
+    try:
+        processes.append(start_server(server_name, SERVER_PORT, env))
+        return asyncio.run(burst(clients))
+    finally:
+        stop(processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Burst of requests against a rate-limited upstream")
+    parser.add_argument('--server', default='asgi', choices=['default', 'stream', 'asgi'])
+    parser.add_argument('--clients', type=int, default=80)
+    parser.add_argument('--rpm', type=int, default=60, help="requests per minute allowed by the fake upstream")
+    parser.add_argument('--tpm', type=int, default=216000, help="tokens per minute allowed by the fake upstream")
+    parser.add_argument('--deadline', type=float, default=2.0, help="queue timeout of the deadline run, in seconds")
+    args = parser.parse_args()
+
+    # Below the upstream's limits, as the README recommends: the upstream counts a call when it
+    # arrives, so calls released the moment our budget is back can arrive before its budget is
+    limits = {"CHAT_UPSTREAM_RPM": int(args.rpm * LIMIT_HEADROOM), "CHAT_UPSTREAM_TPM": int(args.tpm * LIMIT_HEADROOM)}
+    configurations = {
+        "headers": {},
+        "configured": limits,
+        "deadline": dict(limits, CHAT_UPSTREAM_QUEUE_TIMEOUT=args.deadline),
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, settings in configurations.items():
+            env = upstream_env(FAKE_TTFT_MS=50, FAKE_TOKENS_PER_SEC=2000, FAKE_COMPLETION_TOKENS=20,
+                               FAKE_RPM=args.rpm, FAKE_TPM=args.tpm, CHAT_HISTORY_DIR=directory,
+                               CHAT_LOG_LEVEL="WARNING", **settings)
+            results[name] = run(args.server, args.clients, env)
+
+    print(json.dumps({"server": args.server, "clients": args.clients, "results": results}, indent=2))
+    if any(result['errors'] for result in results.values()):
+        sys.exit("Requests failed instead of waiting for the rate limit")
+    if results['configured']['upstream_429s']:
+        sys.exit("The configured scheduler still ran into the upstream rate limit")
+    if not results['deadline']['rejected']:
+        sys.exit("No request was rejected with a short queue deadline")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# Multi-worker scaling check. Starts 1, 2 and 4 processes of a server that share sessions and
+# conversations through the redis backend (served by the in-process stand-in in fake_redis.py)
+# and a common CHAT_SECRET_KEY. Every simulated client sends each turn of its conversation to
+# the next worker in turn, so a conversation only continues if the workers really share state.
+# Reports requests/sec per worker count, and exits non-zero if any request failed or a
+# conversation lost its history when it moved between workers.
+#
+# Usage: python benchmarks/bench_scaling.py [--server asgi] [--workers 1 2 4] [--clients 40] [--turns 5]
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+
+import httpx
+
+import fake_redis
+from harness import UPSTREAM_PORT, start_server, start_upstream, stop, upstream_env
+
+BASE_PORT = 5061
+REDIS_PORT = 6390
+SYSTEM_MESSAGES = 3
+
+
+async def simulated_client(ports, index, turns, counts):
+    # One cookie jar for all workers, like a browser behind a load balancer
+    async with httpx.AsyncClient(timeout=60) as client:
+        for turn in range(turns):
+            port = ports[(index + turn) % len(ports)]
+            try:
+                async with client.stream('POST', f"http://127.0.0.1:{port}/api/chat",
+                                         json={"input": f"Question {turn} from client {index}",
+                                               "user_name": f"bench{index}"}) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if line and 'error' in json.loads(line):
+                            counts['errors'] += 1
+            except (httpx.HTTPError, ValueError):
+                counts['errors'] += 1
+            counts['requests'] += 1
+
+
+async def drive(ports, clients, turns):
+    counts = {"requests": 0, "errors": 0}
+    start_time = time.perf_counter()
+    await asyncio.gather(*(simulated_client(ports, i, turns, counts) for i in range(clients)))
+    return counts, time.perf_counter() - start_time
+
+
+def run(server_name, workers, clients, turns, env):
+    upstream = start_upstream(env)
+    ports = [BASE_PORT + i for i in range(workers)]
+    servers = []
+    try:
+        servers = [start_server(server_name, port, env) for port in ports]
+        counts, wall = asyncio.run(drive(ports, clients, turns))
+        max_messages = httpx.get(f"http://127.0.0.1:{UPSTREAM_PORT}/stats").json()['max_messages']
+    finally:
+        stop(servers + [upstream])
+    return {
+        "workers": workers,
+        "requests": counts['requests'],
+        "errors": counts['errors'],
+        "requests_per_sec": round(counts['requests'] / wall, 2),
+        # Every user turn of a conversation reaches the upstream when the history is shared
+        "history_kept": max_messages >= SYSTEM_MESSAGES + turns,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-worker scaling check")
+    parser.add_argument('--server', default='asgi', choices=['default', 'stream', 'asgi'])
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=40)
+    parser.add_argument('--turns', type=int, default=5)
+    args = parser.parse_args()
+
+    fake_redis.start(REDIS_PORT)
+    with tempfile.TemporaryDirectory() as directory:
+        env = upstream_env(FAKE_TTFT_MS=50, FAKE_TOKENS_PER_SEC=2000, FAKE_COMPLETION_TOKENS=40)
+        env.update({
+            "CHAT_SESSION_BACKEND": "redis",
+            "CHAT_REDIS_URL": f"redis://127.0.0.1:{REDIS_PORT}/0",
+            "CHAT_SECRET_KEY": "bench-scaling-shared-key",
+            "CHAT_HISTORY_DIR": directory,
+            "CHAT_LOG_LEVEL": "WARNING",
+        })
+        results = [run(args.server, workers, args.clients, args.turns, env) for workers in args.workers]
+
+    print(json.dumps({"server": args.server, "results": results}, indent=2))
+    if any(result['errors'] or not result['history_kept'] for result in results):
+        sys.exit("Requests failed or a conversation lost its history between workers")
+
+
+if __name__ == '__main__':
+    main()
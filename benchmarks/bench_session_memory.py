@@ -0,0 +1,133 @@
+# Memory held by the async server's in-memory sessions, with the old representation (a list of
+# message dicts starting with the system context, and a list of token counts) and with
+# CompactConversation. Builds --sessions sessions of --turns turns each, every message with its
+# own text, and reports the bytes allocated per session (tracemalloc). For a sample of sessions it
+# also compares the size and encode/decode time of the JSON sessions the shared stores wrote
+# before with the binary SessionCodec format, and checks that the compact sessions give back the
+# exact message lists and token counts of the old ones.
+#
+# Usage: python benchmarks/bench_session_memory.py [--sessions 10000 100000] [--turns 4]
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'server'))
+from compact_conversation import CompactConversation, SessionCodec  # noqa: E402
+from system_context import SystemContextProvider  # noqa: E402
+
+USER_TEXT = "Can you tell me more about the MAINSTREAM AIIO Framework and how it helps with project management?"
+ASSISTANT_TEXT = ("Of course! The MAINSTREAM AIIO Framework brings AI into everyday marketing, IT and "
+                  "project management workflows.")
+SAMPLE = 1000
+
+
+def count_tokens(text):
+    # A stand-in for tiktoken, the benchmark is about memory layout
+    return len(text) // 4
+
+
+def turns_of(index, turns):
+    for turn in range(turns):
+        yield f"{USER_TEXT} ({index}.{turn})", f"{ASSISTANT_TEXT} ({index}.{turn})"
+
+
+def legacy_session(context, index, turns):
+    session = {"conversation": context.session_messages(), "token_counts": context.session_token_counts(),
+               "conversation_id": uuid.uuid4().hex, "user_name": f"user{index % 1000}"}
+    for question, answer in turns_of(index, turns):
+        for role, content in (("user", question), ("assistant", answer)):
+            session['conversation'].append({"role": role, "content": content})
+            session['token_counts'].append(count_tokens(content))
+    return session
+
+
+def compact_session(context, index, turns):
+    session = {"conversation": CompactConversation(context), "conversation_id": uuid.uuid4().hex,
+               "user_name": f"user{index % 1000}"}
+    for question, answer in turns_of(index, turns):
+        session['conversation'].append("user", question, count_tokens(question))
+        session['conversation'].append("assistant", answer, count_tokens(answer))
+    return session
+
+
+def measure(build, context, sessions, turns):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    store = {f"session{index}": build(context, index, turns) for index in range(sessions)}
+    elapsed = time.perf_counter() - started
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return store, {"bytes_per_session": round(allocated / sessions), "total_mb": round(allocated / 2**20, 1),
+                   "build_seconds": round(elapsed, 2)}
+
+
+def timed(function, values):
+    started = time.perf_counter()
+    results = [function(value) for value in values]
+    return results, (time.perf_counter() - started) / len(values) * 1e6
+
+
+def compare_serialization(legacy, compact, codec):
+    legacy_sample = [legacy[f"session{index}"] for index in range(min(SAMPLE, len(legacy)))]
+    compact_sample = [compact[f"session{index}"] for index in range(len(legacy_sample))]
+    json_blobs, json_dump_us = timed(lambda s: json.dumps(s, separators=(',', ':')).encode('utf-8'), legacy_sample)
+    _, json_load_us = timed(json.loads, json_blobs)
+    binary_blobs, binary_dump_us = timed(codec.dumps, compact_sample)
+    loaded, binary_load_us = timed(codec.loads, binary_blobs)
+    # Legacy JSON sessions are still readable and come back sharing the system context
+    upgraded, _ = timed(codec.loads, json_blobs[:10])
+    return {
+        "json": {"bytes": round(sum(map(len, json_blobs)) / len(json_blobs)),
+                 "dump_us": round(json_dump_us, 1), "load_us": round(json_load_us, 1)},
+        "binary": {"bytes": round(sum(map(len, binary_blobs)) / len(binary_blobs)),
+                   "dump_us": round(binary_dump_us, 1), "load_us": round(binary_load_us, 1)},
+    }, loaded, upgraded
+
+
+def exact(legacy_session_, compact_session_):
+    conversation = compact_session_['conversation']
+    return (conversation.to_messages() == legacy_session_['conversation']
+            and conversation.token_counts() == legacy_session_['token_counts']
+            and conversation.total_tokens == sum(legacy_session_['token_counts']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory per session, dict messages against compact records")
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--turns', type=int, default=4)
+    args = parser.parse_args()
+
+    provider = SystemContextProvider(count_tokens)
+    context = provider.get()
+    codec = SessionCodec(provider, count_tokens)
+    results = []
+    mismatched = 0
+    for sessions in args.sessions:
+        legacy, legacy_memory = measure(legacy_session, context, sessions, args.turns)
+        compact, compact_memory = measure(compact_session, context, sessions, args.turns)
+        serialization, loaded, upgraded = compare_serialization(legacy, compact, codec)
+        mismatched += sum(not exact(legacy[f"session{index}"], compact[f"session{index}"]) for index in range(sessions))
+        mismatched += sum(not exact(legacy[f"session{index}"], session) for index, session in enumerate(loaded))
+        mismatched += sum(session['conversation'].system is not context for session in loaded + upgraded)
+        results.append({
+            "sessions": sessions,
+            "messages_per_session": len(context.messages) + 2 * args.turns,
+            "dict_messages": legacy_memory,
+            "compact": compact_memory,
+            "saved_per_session": legacy_memory['bytes_per_session'] - compact_memory['bytes_per_session'],
+            "serialization": serialization,
+        })
+        del legacy, compact
+    print(json.dumps(results, indent=2))
+    if mismatched:
+        sys.exit(f"{mismatched} compact sessions differ from the message lists they replace")
+
+
+if __name__ == '__main__':
+    main()
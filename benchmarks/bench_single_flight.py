@@ -0,0 +1,78 @@
+# Sends N concurrent identical first questions from fresh sessions to each server and reports
+# how many upstream calls the fake upstream received. With request coalescing every server
+# should make exactly one upstream call per burst, and every client should get the fake
+# upstream's answer, not an error.
+#
+# Usage: python benchmarks/bench_single_flight.py [--clients 50]
+import argparse
+import asyncio
+import json
+import sys
+
+import httpx
+
+from fake_upstream import completion_tokens
+from harness import UPSTREAM_PORT, start_server, start_upstream, stop, upstream_env
+
+SERVER_PORTS = {"default": 5011, "stream": 5012, "asgi": 5013}
+COMPLETION_TOKENS = 20
+
+
+def answer_text(body):
+    # The answer in a response body, None when the server answered with an error. The default
+    # server sends one JSON object, the streaming servers NDJSON deltas.
+    text = ""
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        payload = json.loads(line)
+        if 'error' in payload or str(payload.get('response', '')).startswith(("An OpenAI error", "An error")):
+            return None
+        text += payload.get('response', '')
+        for choice in payload.get('choices', []):
+            text += choice.get('delta', {}).get('content') or ''
+    return text
+
+
+async def ask(port):
+    # A new client per request, so every request starts a fresh session
+    async with httpx.AsyncClient(timeout=None) as client:
+        response = await client.post(f"http://127.0.0.1:{port}/api/chat", json={"input": "Who are you?", "user_name": "bench"})
+        response.raise_for_status()
+        return answer_text(response.text)
+
+
+async def burst(port, clients):
+    async with httpx.AsyncClient() as client:
+        before = (await client.get(f"http://127.0.0.1:{UPSTREAM_PORT}/stats")).json()['requests']
+        answers = await asyncio.gather(*(ask(port) for _ in range(clients)))
+        after = (await client.get(f"http://127.0.0.1:{UPSTREAM_PORT}/stats")).json()['requests']
+    return after - before, answers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upstream calls made for a burst of identical requests")
+    parser.add_argument('--clients', type=int, default=50)
+    args = parser.parse_args()
+
+    env = upstream_env(FAKE_TTFT_MS=500, FAKE_COMPLETION_TOKENS=COMPLETION_TOKENS)
+    expected = "".join(completion_tokens(COMPLETION_TOKENS))
+    processes = []
+    failed = False
+    try:
+        processes.append(start_upstream(env))
+        for name, port in SERVER_PORTS.items():
+            processes.append(start_server(name, port, env))
+            upstream_calls, answers = asyncio.run(burst(port, args.clients))
+            errors = answers.count(None)
+            wrong = sum(answer is not None and answer != expected for answer in answers)
+            print(f"{name}: {args.clients} identical requests -> {upstream_calls} upstream call(s), "
+                  f"{len(set(answers))} distinct answer(s), {errors} error(s), {wrong} wrong answer(s)")
+            failed = failed or upstream_calls != 1 or errors or wrong
+    finally:
+        stop(processes)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
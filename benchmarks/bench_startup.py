@@ -0,0 +1,94 @@
+# Import-to-first-request time of each server. Spawns the server against the fake upstream and
+# measures, from the moment the process is started: when the port accepts connections, when
+# GET /api/ready reports ready, and when the first /api/chat response has been read completely.
+# Run it with and without a seeded tokenizer cache (--server-env CHAT_TIKTOKEN_CACHE_DIR=...)
+# to see what the local BPE cache saves.
+#
+# Usage: python benchmarks/bench_startup.py [--servers default stream asgi] [--runs 5]
+import argparse
+import json
+import socket
+import statistics
+import subprocess
+import time
+
+import httpx
+
+from harness import SERVER_DIR, SERVERS, start_upstream, stop, upstream_env
+
+SERVER_PORTS = {"default": 5051, "stream": 5052, "asgi": 5053}
+
+
+def wait_until(predicate, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return
+        time.sleep(0.01)
+    raise RuntimeError(f"Timed out after {timeout}s")
+
+
+def port_open(port):
+    try:
+        with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+            return True
+    except OSError:
+        return False
+
+
+def ready(base_url):
+    try:
+        return httpx.get(f"{base_url}/api/ready", timeout=5).status_code == 200
+    except httpx.HTTPError:
+        return False
+
+
+def measure(name, env):
+    port = SERVER_PORTS[name]
+    base_url = f"http://127.0.0.1:{port}"
+    command, _ = SERVERS[name]
+    start_time = time.perf_counter()
+    server = subprocess.Popen(command + [str(port)], cwd=SERVER_DIR, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until(lambda: port_open(port))
+        listening = time.perf_counter() - start_time
+        wait_until(lambda: ready(base_url))
+        is_ready = time.perf_counter() - start_time
+        with httpx.Client(timeout=60) as client:
+            response = client.post(f"{base_url}/api/chat", json={"input": "Hello!", "user_name": "bench"})
+            response.read()
+        first_response = time.perf_counter() - start_time
+    finally:
+        stop([server])
+    return {"listening": listening, "ready": is_ready, "first_response": first_response}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-to-first-request benchmark")
+    parser.add_argument('--servers', nargs='+', default=list(SERVER_PORTS), choices=list(SERVER_PORTS))
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--server-env', nargs='*', default=[], metavar='KEY=VALUE',
+                        help="Extra environment variables for the servers, e.g. CHAT_TIKTOKEN_CACHE_DIR=/srv/tiktoken")
+    args = parser.parse_args()
+
+    # A fast upstream so the first response measures the server, not the fake model
+    env = upstream_env(FAKE_TTFT_MS=0, FAKE_TOKENS_PER_SEC=10000, FAKE_COMPLETION_TOKENS=5)
+    env.update(dict(item.split('=', 1) for item in args.server_env))
+
+    results = {}
+    upstream = start_upstream(env)
+    try:
+        for name in args.servers:
+            runs = [measure(name, env) for _ in range(args.runs)]
+            results[name] = {key: round(statistics.median(run[key] for run in runs) * 1000, 1)
+                             for key in runs[0]}
+    finally:
+        stop([upstream])
+
+    # Median milliseconds from process start
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Writes per response, bytes on the wire, time-to-first-write and added per-token delay for
+# several stream flush policies, replaying a simulated upstream token schedule through the
+# same DeltaCoalescer and framers the streaming servers use. Timed flushes are applied the way
+# the ASGI server does them, when the oldest pending delta reaches its max delay.
+#
+# Usage: python benchmarks/bench_stream_flush.py [--tokens 300] [--ttft-ms 200] [--tokens-per-sec 60]
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'server'))
+from stream_framing import DeltaCoalescer, FlushPolicy, NdjsonFramer, SseFramer  # noqa: E402
+
+POLICIES = [
+    ("per-delta", FlushPolicy(max_bytes=0, max_delay=0)),
+    ("40ms/256B", FlushPolicy(max_bytes=256, max_delay=0.040)),
+    ("100ms/1KiB", FlushPolicy(max_bytes=1024, max_delay=0.100)),
+]
+WORDS = "Streamy here to help with marketing, information technology and project management".split()
+
+
+def token_schedule(tokens, ttft, tokens_per_sec, seed=7):
+    # Arrival time and text of every upstream delta, with some jitter between tokens
+    rng = random.Random(seed)
+    t = ttft
+    schedule = []
+    for i in range(tokens):
+        schedule.append((t, WORDS[i % len(WORDS)] + " "))
+        t += rng.expovariate(tokens_per_sec)
+    return schedule
+
+
+def simulate(schedule, policy, framer):
+    now = [0.0]
+    coalescer = DeltaCoalescer(policy, clock=lambda: now[0])
+    writes = []  # (time, text)
+    pending_arrivals = []
+    delays = []
+
+    def record(at, text):
+        writes.append((at, framer.delta(text)))
+        delays.extend(at - arrival for arrival in pending_arrivals)
+        pending_arrivals.clear()
+
+    for arrival, text in schedule:
+        due_in = coalescer.time_until_due()
+        if due_in is not None and now[0] + due_in <= arrival:
+            now[0] += due_in
+            record(now[0], coalescer.flush())
+        now[0] = arrival
+        pending_arrivals.append(arrival)
+        flushed = coalescer.add(text)
+        if flushed:
+            record(arrival, flushed)
+    leftover = coalescer.flush()
+    if leftover:
+        record(now[0], leftover)
+    writes.append((now[0], framer.end()))
+
+    return {
+        "writes": sum(1 for _, frame in writes if frame),
+        "bytes": sum(len(frame.encode('utf-8')) for _, frame in writes),
+        "ttft_ms": writes[0][0] * 1000,
+        "mean_added_delay_ms": sum(delays) / len(delays) * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream flush policy benchmark")
+    parser.add_argument('--tokens', type=int, default=300)
+    parser.add_argument('--ttft-ms', type=float, default=200)
+    parser.add_argument('--tokens-per-sec', type=float, default=60)
+    args = parser.parse_args()
+
+    schedule = token_schedule(args.tokens, args.ttft_ms / 1000, args.tokens_per_sec)
+    print(f"{'policy':<12} {'framing':<8} {'writes':>7} {'bytes':>8} {'ttft (ms)':>10} {'added delay (ms)':>17}")
+    for name, policy in POLICIES:
+        for framing, framer_class in (("ndjson", NdjsonFramer), ("sse", SseFramer)):
+            result = simulate(schedule, policy, framer_class())
+            print(f"{name:<12} {framing:<8} {result['writes']:>7} {result['bytes']:>8} "
+                  f"{result['ttft_ms']:>10.1f} {result['mean_added_delay_ms']:>17.1f}")
+
+
+if __name__ == '__main__':
+    main()
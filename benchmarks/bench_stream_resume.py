@@ -0,0 +1,135 @@
+# Resumable streams check. Each request streams an answer from the Flask streaming server through
+# the fake upstream and drops the connection after a random number of chunks (sometimes before
+# the first one, sometimes again while resuming). It then resumes at /api/chat/stream/<id> from
+# the last chunk it got. Every reassembled answer must match the fake upstream's completion, and
+# the upstream must have been asked once per answer: resuming never starts a new generation.
+# Reports resume latency (time to the first resumed chunk) and the replay buffer stats.
+#
+# Usage: python benchmarks/bench_stream_resume.py [--requests 100] [--concurrency 8] [--seed 1]
+import argparse
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+from fake_upstream import completion_tokens
+from harness import UPSTREAM_PORT, latency_summary, start_server, start_upstream, stop, upstream_env
+
+SERVER_PORT = 5121
+COMPLETION_TOKENS = 60
+
+
+def read_chunks(response, state, cut_after=None):
+    # Collect numbered chunks into `state` until the end frame, or drop the connection after
+    # `cut_after` chunks. Returns True once the stream has ended.
+    if cut_after == 0:
+        return False
+    received = 0
+    for line in response.iter_lines():
+        if not line:
+            continue
+        data = json.loads(line)
+        if 'error' in data:
+            state['error'] = data['error']
+            return True
+        if 'seq' in data:
+            return True
+        if state['first_resumed_at'] is None and state['resumed_at'] is not None:
+            state['first_resumed_at'] = time.perf_counter()
+        state['chunk'] = data['chunk']
+        state['text'] += data['choices'][0]['delta']['content']
+        received += 1
+        if cut_after is not None and received >= cut_after:
+            return False
+    return False
+
+
+def one_request(index, rng, results, lock):
+    state = {"text": "", "chunk": 0, "error": None, "resumed_at": None, "first_resumed_at": None}
+    with httpx.Client(timeout=60) as client:
+        with client.stream('POST', f"http://127.0.0.1:{SERVER_PORT}/api/chat",
+                           json={"input": f"Question {index}", "user_name": f"bench{index}"}) as response:
+            response.raise_for_status()
+            stream_id = response.headers['x-stream-id']
+            complete = read_chunks(response, state, cut_after=rng.randint(0, COMPLETION_TOKENS // 4))
+        resumes = 0
+        while not complete:
+            resumes += 1
+            if state['resumed_at'] is None:
+                state['resumed_at'] = time.perf_counter()
+            # Drop the first resumed connection too, now and then
+            cut_after = rng.randint(1, 5) if resumes == 1 and rng.random() < 0.3 else None
+            with client.stream('GET', f"http://127.0.0.1:{SERVER_PORT}/api/chat/stream/{stream_id}",
+                               params={"after": state['chunk']}) as response:
+                response.raise_for_status()
+                complete = read_chunks(response, state, cut_after)
+    with lock:
+        results.append(dict(state, resumes=resumes))
+
+
+def drive(requests, concurrency, seed):
+    results = []
+    lock = threading.Lock()
+    indexes = iter(range(requests))
+
+    def worker(worker_index):
+        rng = random.Random(seed * 1000 + worker_index)
+        for index in indexes:
+            one_request(index, rng, results, lock)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resume streams cut at random points")
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    expected = "".join(completion_tokens(COMPLETION_TOKENS))
+    with tempfile.TemporaryDirectory() as directory:
+        # Flush every delta as it arrives, so there are many chunks to cut between
+        env = upstream_env(FAKE_TTFT_MS=50, FAKE_TOKENS_PER_SEC=200, FAKE_COMPLETION_TOKENS=COMPLETION_TOKENS,
+                           CHAT_STREAM_FLUSH_BYTES=0, CHAT_STREAM_FLUSH_MS=0,
+                           CHAT_HISTORY_DIR=directory, CHAT_LOG_LEVEL="ERROR")
+        processes = [start_upstream(env)]
+        try:
+            processes.append(start_server('stream', SERVER_PORT, env))
+            results = drive(args.requests, args.concurrency, args.seed)
+            upstream = httpx.get(f"http://127.0.0.1:{UPSTREAM_PORT}/stats").json()
+            metrics = httpx.get(f"http://127.0.0.1:{SERVER_PORT}/metrics").text
+        finally:
+            stop(processes)
+
+    replay = {line.split()[0]: float(line.split()[1]) for line in metrics.splitlines()
+              if line.startswith('chat_replay_')}
+    mismatched = [r for r in results if r['error'] or r['text'] != expected]
+    resume_latencies = [r['first_resumed_at'] - r['resumed_at'] for r in results if r['first_resumed_at']]
+    report = {
+        "requests": len(results),
+        "resumed": sum(1 for r in results if r['resumes']),
+        "reconnects": sum(r['resumes'] for r in results),
+        "mismatched": len(mismatched),
+        "upstream_requests": upstream['requests'],
+        "resume_latency": latency_summary(resume_latencies),
+        "replay": replay,
+    }
+    print(json.dumps(report, indent=2))
+    if mismatched:
+        sys.exit(f"{len(mismatched)} answers did not match after resuming")
+    if upstream['requests'] != args.requests:
+        sys.exit("Resuming started new upstream generations")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Compares the per-turn tokenization cost of re-encoding the whole history (the old
+# calculate_messages_tokens behaviour) with the cached, incremental token accounting.
+#
+# Usage: python benchmarks/bench_token_counter.py [--turns 500] [--every 50]
+import argparse
+import json
+import os
+import sys
+import time
+
+import tiktoken
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'server'))
+from token_counter import TokenCounter, sync_token_counts  # noqa: E402
+
+MODEL_NAME = "gpt-4o"
+USER_TEXT = "Can you tell me more about the MAINSTREAM AIIO Framework and how it helps with project management?"
+ASSISTANT_TEXT = ("Of course! The MAINSTREAM AIIO Framework brings AI into everyday marketing, IT and "
+                  "project management workflows. ") * 4
+
+
+def load_system_context():
+    with open(os.path.join(os.path.dirname(__file__), '..', 'server', 'system_context.txt'), 'r') as file:
+        return json.load(file)
+
+
+def full_reencode(enc, messages):
+    total_tokens = 0
+    for message in messages:
+        total_tokens += len(enc.encode(message['content']))
+    return total_tokens
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-turn tokenization cost benchmark")
+    parser.add_argument('--turns', type=int, default=500)
+    parser.add_argument('--every', type=int, default=50, help="Report every N turns")
+    args = parser.parse_args()
+
+    enc = tiktoken.encoding_for_model(MODEL_NAME)
+    counter = TokenCounter(enc)
+
+    old_messages = load_system_context()
+    new_messages = load_system_context()
+    token_counts = []
+    sync_token_counts(new_messages, token_counts, counter)
+
+    print(f"{'turn':>6} {'messages':>9} {'full re-encode (us)':>20} {'incremental (us)':>17}")
+    for turn in range(1, args.turns + 1):
+        # Each turn adds a user message with a unique suffix, mirroring distinct user inputs
+        user_message = {"role": "user", "content": f"{USER_TEXT} ({turn})"}
+        assistant_message = {"role": "assistant", "content": f"{ASSISTANT_TEXT} ({turn})"}
+
+        start = time.perf_counter()
+        old_messages.append(user_message)
+        full_reencode(enc, old_messages)
+        old_messages.append(assistant_message)
+        full_reencode(enc, old_messages)
+        old_cost = time.perf_counter() - start
+
+        start = time.perf_counter()
+        new_messages.append(user_message)
+        sync_token_counts(new_messages, token_counts, counter)
+        new_messages.append(assistant_message)
+        sync_token_counts(new_messages, token_counts, counter)
+        new_cost = time.perf_counter() - start
+
+        if turn == 1 or turn % args.every == 0:
+            print(f"{turn:>6} {len(new_messages):>9} {old_cost * 1e6:>20.1f} {new_cost * 1e6:>17.1f}")
+
+    print(f"cache hits: {counter.hits}, misses: {counter.misses}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# Compares the Flask streaming server with the ASGI streaming server under N concurrent
+# streams, both talking to the local fake upstream.
+#
+# Usage: python benchmarks/compare_stream_servers.py [--clients 200] [--ttft-ms 200]
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from harness import percentile, start_server, start_upstream, stop, upstream_env
+
+FLASK_PORT = 5001
+ASGI_PORT = 5002
+
+
+async def one_stream(base_url, user_name):
+    async with httpx.AsyncClient(timeout=None) as client:
+        start_time = time.perf_counter()
+        ttft = None
+        async with client.stream('POST', f"{base_url}/api/chat", json={"input": "Hello Streamy!", "user_name": user_name}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line and ttft is None:
+                    ttft = time.perf_counter() - start_time
+        return ttft, time.perf_counter() - start_time
+
+
+async def drive(base_url, clients):
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*(one_stream(base_url, f"bench{i}") for i in range(clients)), return_exceptions=True)
+    wall = time.perf_counter() - start_time
+    ok = [result for result in results if not isinstance(result, BaseException)]
+    ttfts = sorted(result[0] for result in ok if result[0] is not None)
+    totals = sorted(result[1] for result in ok)
+    return {
+        "completed": len(ok),
+        "failed": len(results) - len(ok),
+        "wall_seconds": round(wall, 3),
+        "ttft_p50_ms": round(percentile(ttfts, 0.5) * 1000, 1) if ttfts else None,
+        "total_p50_ms": round(percentile(totals, 0.5) * 1000, 1) if totals else None,
+        "total_max_ms": round(totals[-1] * 1000, 1) if totals else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flask vs ASGI streaming server comparison")
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--ttft-ms', type=int, default=200)
+    parser.add_argument('--tokens-per-sec', type=int, default=50)
+    args = parser.parse_args()
+
+    env = upstream_env(FAKE_TTFT_MS=args.ttft_ms, FAKE_TOKENS_PER_SEC=args.tokens_per_sec)
+
+    processes = []
+    try:
+        processes.append(start_upstream(env))
+        processes.append(start_server("stream", FLASK_PORT, env))
+        processes.append(start_server("asgi", ASGI_PORT, env))
+
+        for name, port in (("flask", FLASK_PORT), ("asgi", ASGI_PORT)):
+            result = asyncio.run(drive(f"http://127.0.0.1:{port}", args.clients))
+            print(name, result)
+    finally:
+        stop(processes)
+
+
+if __name__ == '__main__':
+    main()
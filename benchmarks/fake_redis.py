@@ -0,0 +1,178 @@
+# A small in-process stand-in for a Redis server, speaking enough of the RESP protocol for the
+# servers' redis session backend (strings with expiry, lists) and Flask-Session. It lets the
+# multi-worker benchmarks run without installing Redis.
+#
+# Run with: python benchmarks/fake_redis.py [--port 6390]
+import argparse
+import socketserver
+import threading
+import time
+
+data = {}
+expires = {}
+lock = threading.Lock()
+
+
+class RespError(Exception):
+    pass
+
+
+class RespMap(list):
+    # Flat key/value list sent as a RESP3 map
+    pass
+
+
+def encode(value, protocol=2):
+    if value is None:
+        return b"_\r\n" if protocol == 3 else b"$-1\r\n"
+    if isinstance(value, RespError):
+        return b"-ERR " + str(value).encode() + b"\r\n"
+    if isinstance(value, bool):
+        return b"+OK\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, RespMap):
+        return b"%%%d\r\n" % (len(value) // 2) + b"".join(encode(item, protocol) for item in value)
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item, protocol) for item in value)
+    return b"$%d\r\n" % len(value) + value + b"\r\n"
+
+
+def alive(key):
+    deadline = expires.get(key)
+    if deadline is not None and deadline <= time.monotonic():
+        data.pop(key, None)
+        expires.pop(key, None)
+    return key in data
+
+
+def set_expiry(key, seconds):
+    expires[key] = time.monotonic() + seconds
+
+
+def command_set(key, value, *options):
+    data[key] = value
+    expires.pop(key, None)
+    options = [option.upper() for option in options]
+    if b"EX" in options:
+        set_expiry(key, int(options[options.index(b"EX") + 1]))
+    return True
+
+
+def command_setex(key, seconds, value):
+    return command_set(key, value, b"EX", seconds)
+
+
+def command_get(key):
+    return data[key] if alive(key) else None
+
+
+def command_delete(*keys):
+    removed = 0
+    for key in keys:
+        if alive(key):
+            removed += 1
+        data.pop(key, None)
+        expires.pop(key, None)
+    return removed
+
+
+def command_expire(key, seconds):
+    if not alive(key):
+        return 0
+    set_expiry(key, int(seconds))
+    return 1
+
+
+def command_rpush(key, *values):
+    if not alive(key):
+        data[key] = []
+    data[key].extend(values)
+    return len(data[key])
+
+
+def command_llen(key):
+    return len(data[key]) if alive(key) else 0
+
+
+def command_lrange(key, start, stop):
+    items = data[key] if alive(key) else []
+    start, stop = int(start), int(stop)
+    stop = len(items) if stop == -1 else stop + 1
+    return items[start:stop]
+
+
+def command_hello(protocol=b"2", *args):
+    # redis-py negotiates RESP3, which only changes how a missing value is sent for these commands
+    fields = [b"server", b"redis", b"version", b"7.0.0", b"proto", int(protocol), b"mode", b"standalone"]
+    if int(protocol) == 3:
+        return RespMap(fields)
+    return fields
+
+
+def command_ping(*args):
+    return args[0] if args else b"PONG"
+
+
+COMMANDS = {
+    b"SET": command_set, b"SETEX": command_setex, b"GET": command_get, b"DEL": command_delete,
+    b"EXPIRE": command_expire, b"RPUSH": command_rpush, b"LLEN": command_llen, b"LRANGE": command_lrange,
+    b"PING": command_ping, b"HELLO": command_hello,
+    # Connection setup sent by redis-py, accepted and ignored
+    b"CLIENT": lambda *args: True, b"SELECT": lambda *args: True,
+}
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        count = int(line[1:])
+        args = []
+        for _ in range(count):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        protocol = 2
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            command = COMMANDS.get(args[0].upper())
+            if command is None:
+                reply = RespError(f"unknown command {args[0].decode()}")
+            else:
+                try:
+                    with lock:
+                        reply = command(*args[1:])
+                except (TypeError, ValueError, IndexError) as e:
+                    reply = RespError(str(e))
+            if args[0].upper() == b"HELLO" and not isinstance(reply, RespError):
+                protocol = int(args[1]) if len(args) > 1 else 2
+            self.wfile.write(encode(reply, protocol))
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start(port):
+    # Serve on a background thread of the calling process and return the server
+    server = Server(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Redis protocol stand-in")
+    parser.add_argument('--port', type=int, default=6390)
+    args = parser.parse_args()
+    Server(('127.0.0.1', args.port), Handler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
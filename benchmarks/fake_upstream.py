@@ -0,0 +1,219 @@
+# A local stand-in for the OpenAI /v1/chat/completions (and /v1/models) endpoint, so the servers can be
+# benchmarked without real API calls. Point the servers at it with
+# OPENAI_BASE_URL=http://127.0.0.1:8100/v1 and any OPENAI_API_KEY.
+#
+# Run with: uvicorn fake_upstream:app --port 8100 (from the /benchmarks directory)
+#
+# Behaviour is configured through environment variables:
+#   FAKE_TTFT_MS            delay before the first token (default 200)
+#   FAKE_TOKENS_PER_SEC     streaming rate after the first token (default 50)
+#   FAKE_COMPLETION_TOKENS  number of tokens in every completion (default 60)
+#   FAKE_ERROR_RATE         fraction of requests that fail instead of completing (default 0)
+#   FAKE_ERROR_STATUS       HTTP status of injected failures (default 500, 429 adds Retry-After)
+#   FAKE_RPM                requests per minute before answering 429, 0 for no limit (default 0)
+#   FAKE_TPM                tokens per minute (prompt plus max_completion_tokens) before answering 429 (default 0)
+#   FAKE_STALL_RATE         fraction of requests whose first token takes FAKE_STALL_MS instead (default 0)
+#   FAKE_STALL_MS           time to first token of a stalled request (default 5000)
+#   FAKE_CONCURRENCY        completions generated at once, later ones wait in arrival order (default 0, no limit)
+import asyncio
+import json
+import os
+import random
+import time
+
+TTFT_SECONDS = float(os.getenv("FAKE_TTFT_MS", "200")) / 1000
+TOKENS_PER_SEC = float(os.getenv("FAKE_TOKENS_PER_SEC", "50"))
+COMPLETION_TOKENS = int(os.getenv("FAKE_COMPLETION_TOKENS", "60"))
+ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", "0"))
+ERROR_STATUS = int(os.getenv("FAKE_ERROR_STATUS", "500"))
+RPM = int(os.getenv("FAKE_RPM", "0"))
+TPM = int(os.getenv("FAKE_TPM", "0"))
+CONCURRENCY = int(os.getenv("FAKE_CONCURRENCY", "0"))
+STALL_RATE = float(os.getenv("FAKE_STALL_RATE", "0"))
+STALL_SECONDS = float(os.getenv("FAKE_STALL_MS", "5000")) / 1000
+MODEL_NAME = "gpt-4o"
+
+# Number of completion requests received and the longest message list seen, served at GET /stats
+stats = {"requests": 0, "errors": 0, "rate_limited": 0, "stalled": 0, "max_messages": 0}
+
+# Rough stand-in for a tokenized answer, one "token" per word
+WORDS = ("Streamy here! The MAINSTREAM AIIO Framework helps teams bring AI into marketing, "
+         "information technology and project management work. ").split()
+
+
+def completion_tokens(count):
+    return [WORDS[i % len(WORDS)] + " " for i in range(count)]
+
+
+def prompt_tokens(request_json):
+    return sum(len(str(message.get('content', '')).split()) for message in request_json.get('messages', []))
+
+
+class RateLimit:
+    # Per-minute budget refilled continuously, like the provider's limits
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def retry_after(self, amount):
+        # Seconds until `amount` is available, 0 if it is now
+        self.refill()
+        return max(0.0, (amount - self.level) * 60 / self.per_minute)
+
+    def headers(self, kind):
+        return [(f'x-ratelimit-limit-{kind}'.encode(), str(self.per_minute).encode()),
+                (f'x-ratelimit-remaining-{kind}'.encode(), str(int(self.level)).encode())]
+
+
+# A saturated provider: requests beyond FAKE_CONCURRENCY queue up first come, first served
+capacity = asyncio.Semaphore(CONCURRENCY) if CONCURRENCY else None
+
+limits = {kind: RateLimit(per_minute) for kind, per_minute in (('requests', RPM), ('tokens', TPM)) if per_minute}
+
+
+def check_rate_limits(cost):
+    # Take the request's cost, or return (retry after, headers) if a limit is exhausted
+    costs = {'requests': 1, 'tokens': cost}
+    retry_after = max((limit.retry_after(costs[kind]) for kind, limit in limits.items()), default=0.0)
+    if not retry_after:
+        for kind, limit in limits.items():
+            limit.level -= costs[kind]
+    headers = [header for kind, limit in limits.items() for header in limit.headers(kind)]
+    return retry_after, headers
+
+
+def chunk_payload(completion_id, created, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": created,
+        "model": MODEL_NAME,
+        "choices": [{"index": 0, "delta": delta, "logprobs": None, "finish_reason": finish_reason}],
+    }
+
+
+async def read_json(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return json.loads(body)
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def completions(receive, send):
+    request_json = await read_json(receive)
+    stats['requests'] += 1
+    stats['max_messages'] = max(stats['max_messages'], len(request_json.get('messages', [])))
+
+    if ERROR_RATE and random.random() < ERROR_RATE:
+        stats['errors'] += 1
+        error_type = "rate_limit_exceeded" if ERROR_STATUS == 429 else "server_error"
+        headers = [(b'retry-after', b'1')] if ERROR_STATUS == 429 else []
+        await send_json(send, {"error": {"message": "Injected failure.", "type": error_type, "code": error_type}},
+                        status=ERROR_STATUS, headers=headers)
+        return
+
+    cost = prompt_tokens(request_json) + int(request_json.get('max_completion_tokens') or COMPLETION_TOKENS)
+    retry_after, limit_headers = check_rate_limits(cost)
+    if retry_after:
+        stats['rate_limited'] += 1
+        headers = limit_headers + [(b'retry-after-ms', str(int(retry_after * 1000) + 1).encode())]
+        await send_json(send, {"error": {"message": "Rate limit reached.", "type": "requests",
+                                         "code": "rate_limit_exceeded"}}, status=429, headers=headers)
+        return
+
+    if capacity is None:
+        await respond(send, request_json, limit_headers)
+    else:
+        async with capacity:
+            await respond(send, request_json, limit_headers)
+
+
+async def respond(send, request_json, limit_headers):
+    tokens = completion_tokens(COMPLETION_TOKENS)
+    completion_id = f"chatcmpl-fake{time.monotonic_ns()}"
+    created = int(time.time())
+    usage = {
+        "prompt_tokens": prompt_tokens(request_json),
+        "completion_tokens": len(tokens),
+        "total_tokens": prompt_tokens(request_json) + len(tokens),
+    }
+
+    if STALL_RATE and random.random() < STALL_RATE:
+        stats['stalled'] += 1
+        await asyncio.sleep(STALL_SECONDS)
+    else:
+        await asyncio.sleep(TTFT_SECONDS)
+
+    if not request_json.get('stream'):
+        await asyncio.sleep(len(tokens) / TOKENS_PER_SEC)
+        await send_json(send, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": MODEL_NAME,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "logprobs": None,
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        }, headers=limit_headers)
+        return
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream')] + limit_headers,
+    })
+    events = [chunk_payload(completion_id, created, {"role": "assistant", "content": ""})]
+    events += [chunk_payload(completion_id, created, {"content": token}) for token in tokens]
+    events.append(chunk_payload(completion_id, created, {}, finish_reason="stop"))
+    if (request_json.get('stream_options') or {}).get('include_usage'):
+        events.append(dict(chunk_payload(completion_id, created, {}), choices=[], usage=usage))
+    for i, event in enumerate(events):
+        if i > 1:
+            await asyncio.sleep(1 / TOKENS_PER_SEC)
+        await send({'type': 'http.response.body', 'body': f"data: {json.dumps(event)}\n\n".encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b"data: [DONE]\n\n"})
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['path'] == '/v1/chat/completions' and scope['method'] == 'POST':
+        await completions(receive, send)
+    elif scope['path'] == '/v1/models' and scope['method'] == 'GET':
+        # Used by the servers' startup warmup to open a connection
+        await send_json(send, {"object": "list", "data": [{"id": MODEL_NAME, "object": "model", "owned_by": "fake"}]})
+    elif scope['path'] == '/stats' and scope['method'] == 'GET':
+        await send_json(send, stats)
+    else:
+        await send_json(send, {"error": {"message": "Not found.", "type": "invalid_request_error"}}, status=404)
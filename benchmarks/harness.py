@@ -0,0 +1,92 @@
+# Shared helpers for the benchmark scripts: starting the fake upstream and the servers as
+# subprocesses, and summarizing latency samples.
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SERVER_DIR = os.path.join(ROOT, 'server')
+BENCH_DIR = os.path.join(ROOT, 'benchmarks')
+UPSTREAM_PORT = 8100
+
+sys.path.insert(0, SERVER_DIR)
+from history_writer import iter_history  # noqa: E402
+
+# name -> (command, end_chat payload style), the port is appended to the command
+SERVERS = {
+    "default": ([sys.executable, '-m', 'flask', '--app', 'flask_default_chat', 'run', '--port'], 'object'),
+    "stream": ([sys.executable, '-m', 'flask', '--app', 'flask_stream_chat', 'run', '--port'], 'list'),
+    "asgi": ([sys.executable, '-m', 'uvicorn', 'asgi_stream_chat:app', '--log-level', 'warning', '--port'], 'list'),
+}
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port} after {timeout}s")
+
+
+def start(args, cwd, env, port, output=subprocess.DEVNULL):
+    process = subprocess.Popen(args, cwd=cwd, env=env, stdout=output, stderr=output)
+    wait_for_port(port)
+    return process
+
+
+def upstream_env(**fake_settings):
+    # Environment that points the servers' OpenAI clients at the fake upstream
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{UPSTREAM_PORT}/v1",
+    })
+    env.update({key: str(value) for key, value in fake_settings.items()})
+    return env
+
+
+def start_upstream(env):
+    return start([sys.executable, '-m', 'uvicorn', 'fake_upstream:app', '--port', str(UPSTREAM_PORT),
+                  '--log-level', 'warning'], BENCH_DIR, env, UPSTREAM_PORT)
+
+
+def start_server(name, port, env, output=subprocess.DEVNULL):
+    command, _ = SERVERS[name]
+    return start(command + [str(port)], SERVER_DIR, env, port, output)
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+        process.wait()
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(samples):
+    # p50/p95/p99 in milliseconds
+    return {
+        f"p{int(fraction * 100)}_ms": round(percentile(samples, fraction) * 1000, 2) if samples else None
+        for fraction in (0.5, 0.95, 0.99)
+    }
+
+
+def load_recorded_conversations(directory=os.path.join(SERVER_DIR, 'chat_history')):
+    # The user turns of every saved conversation, in order
+    # Reads both the original per-conversation files and the history writer's segments
+    conversations = []
+    for record in iter_history(directory):
+        user_turns = [message['content'] for message in record['messages'] if message.get('role') == 'user']
+        if user_turns:
+            conversations.append(user_turns)
+    return conversations
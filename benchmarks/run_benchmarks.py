@@ -0,0 +1,186 @@
+# Offline benchmark suite. Starts the fake upstream and each server, then drives the server
+# with N concurrent simulated clients that replay the conversations saved under
+# server/chat_history/. Results are written as JSON so runs can be diffed between releases.
+#
+# Usage: python benchmarks/run_benchmarks.py [--servers default stream asgi] [--clients 20]
+#                                            [--rounds 3] [--output results.json]
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+import psutil
+
+from harness import (ROOT, SERVERS, latency_summary, load_recorded_conversations, start_server,
+                     start_upstream, stop, upstream_env)
+
+SERVER_PORTS = {"default": 5021, "stream": 5022, "asgi": 5023}
+
+
+class ClientStats:
+    def __init__(self):
+        self.latencies = []
+        self.ttfts = []
+        self.errors = 0
+        self.requests = 0
+
+
+async def send_turn(client, base_url, user_input, user_name, stats):
+    start_time = time.perf_counter()
+    ttft = None
+    failed = False
+    try:
+        async with client.stream('POST', f"{base_url}/api/chat", json={"input": user_input, "user_name": user_name}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                if ttft is None:
+                    ttft = time.perf_counter() - start_time
+                payload = json.loads(line)
+                # The streaming servers send {"error": ...}, the default server an error text as the response
+                if 'error' in payload or str(payload.get('response', '')).startswith(("An OpenAI error", "An error")):
+                    failed = True
+    except (httpx.HTTPError, ValueError):
+        failed = True
+
+    stats.requests += 1
+    if failed:
+        stats.errors += 1
+        return
+    stats.latencies.append(time.perf_counter() - start_time)
+    if ttft is not None:
+        stats.ttfts.append(ttft)
+
+
+async def simulated_client(base_url, server_name, index, conversations, rounds, stats):
+    user_name = f"bench{index}"
+    _, end_style = SERVERS[server_name]
+    async with httpx.AsyncClient(timeout=60) as client:
+        for round_number in range(rounds):
+            user_turns = conversations[(index + round_number) % len(conversations)]
+            transcript = []
+            for user_input in user_turns:
+                await send_turn(client, base_url, user_input, user_name, stats)
+                transcript.append({"role": "user", "content": user_input})
+            payload = {"conversation": transcript, "user_name": user_name} if end_style == 'object' else transcript
+            try:
+                await client.post(f"{base_url}/api/chat/end", json=payload)
+            except httpx.HTTPError:
+                stats.errors += 1
+
+
+async def drive(base_url, server_name, clients, rounds, conversations):
+    stats = ClientStats()
+    start_time = time.perf_counter()
+    await asyncio.gather(*(simulated_client(base_url, server_name, i, conversations, rounds, stats)
+                           for i in range(clients)))
+    return stats, time.perf_counter() - start_time
+
+
+def process_usage(process):
+    # CPU seconds and RSS of the server process and anything it spawned
+    processes = [process] + process.children(recursive=True)
+    cpu = sum(p.cpu_times().user + p.cpu_times().system for p in processes)
+    rss = sum(p.memory_info().rss for p in processes)
+    return cpu, rss
+
+
+def benchmark_server(name, env, clients, rounds, conversations):
+    port = SERVER_PORTS[name]
+    # Server output goes to a real file so logging costs what it would in production
+    with tempfile.TemporaryFile() as server_output:
+        server = start_server(name, port, env, server_output)
+        try:
+            process = psutil.Process(server.pid)
+            cpu_before, rss_before = process_usage(process)
+            stats, wall = asyncio.run(drive(f"http://127.0.0.1:{port}", name, clients, rounds, conversations))
+            cpu_after, rss_after = process_usage(process)
+        finally:
+            stop([server])
+
+    completed = stats.requests - stats.errors
+    return {
+        "requests": stats.requests,
+        "errors": stats.errors,
+        "wall_seconds": round(wall, 3),
+        "requests_per_sec": round(stats.requests / wall, 2) if wall else None,
+        "latency": latency_summary(stats.latencies),
+        "ttft": latency_summary(stats.ttfts),
+        "cpu_ms_per_request": round((cpu_after - cpu_before) * 1000 / completed, 3) if completed else None,
+        "rss_start_bytes": rss_before,
+        "rss_growth_bytes": rss_after - rss_before,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput and latency benchmarks")
+    parser.add_argument('--servers', nargs='+', default=list(SERVER_PORTS), choices=list(SERVER_PORTS))
+    parser.add_argument('--clients', type=int, default=20, help="Concurrent simulated clients")
+    parser.add_argument('--rounds', type=int, default=3, help="Conversations replayed per client")
+    parser.add_argument('--ttft-ms', type=int, default=200)
+    parser.add_argument('--tokens-per-sec', type=int, default=50)
+    parser.add_argument('--completion-tokens', type=int, default=60)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--server-env', nargs='*', default=[], metavar='KEY=VALUE',
+                        help="Extra environment variables for the servers, e.g. CHAT_LOG_LEVEL=DEBUG")
+    parser.add_argument('--output', help="Write the results to this JSON file instead of stdout")
+    args = parser.parse_args()
+
+    conversations = load_recorded_conversations()
+    if not conversations:
+        parser.error("No recorded conversations found under server/chat_history/")
+
+    fake_settings = {
+        "FAKE_TTFT_MS": args.ttft_ms,
+        "FAKE_TOKENS_PER_SEC": args.tokens_per_sec,
+        "FAKE_COMPLETION_TOKENS": args.completion_tokens,
+        "FAKE_ERROR_RATE": args.error_rate,
+    }
+    env = upstream_env(**fake_settings)
+    server_env = dict(item.split('=', 1) for item in args.server_env)
+    env.update(server_env)
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "python": platform.python_version(),
+            "clients": args.clients,
+            "rounds": args.rounds,
+            "recorded_conversations": len(conversations),
+            "upstream": fake_settings,
+            "server_env": server_env,
+        },
+        "servers": {},
+    }
+
+    upstream = start_upstream(env)
+    try:
+        for name in args.servers:
+            results["servers"][name] = benchmark_server(name, env, args.clients, args.rounds, conversations)
+    finally:
+        stop([upstream])
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
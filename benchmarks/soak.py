@@ -0,0 +1,314 @@
+# Soak and memory-regression test for long-running servers. Starts the fake upstream, then runs
+# each server for --duration seconds (hours for a real soak) under simulated traffic from
+# --clients concurrent clients. Every simulated chat is a new session with --turns distinct
+# questions. It then ends the chat the way the clients do, or, for an --abandon share of
+# chats, just leaves it.
+#
+# Every --sample-seconds the suite records:
+#   - the server's RSS
+#   - its traced memory, when the server runs with CHAT_TRACEMALLOC=1 (see server/memory_tracker.py)
+#   - files and bytes in its session, conversation and history directories, which are temporary
+#     directories created for the run
+# Once --warmup-requests requests are done, the current sample becomes the baseline, and the
+# server takes a tracemalloc baseline snapshot. At the end the server reports the allocation
+# sites that grew the most since then.
+#
+# A server fails when, after the warmup:
+#   - its memory growth per session started is above --max-session-kb (traced memory when
+#     tracemalloc is on, RSS otherwise)
+#   - its RSS grows faster than --max-growth-mb-per-10k per 10k requests (least-squares slope
+#     over the samples)
+#   - its directories grow faster than --max-disk-mb-per-10k per 10k requests, when that is set
+#   - more than --max-error-rate of its requests failed, over the whole run (failed requests
+#     allocate next to nothing, so a failing server would otherwise pass the memory checks)
+# The defaults come from SOAK_MAX_SESSION_KB, SOAK_MAX_GROWTH_MB_PER_10K, SOAK_MAX_DISK_MB_PER_10K
+# and SOAK_MAX_ERROR_RATE.
+#
+# Usage: python benchmarks/soak.py [--servers default stream asgi] [--duration 3600] [--requests N]
+#                                  [--clients 20] [--turns 4] [--abandon 0.3] [--sample-seconds 30]
+#                                  [--warmup-requests 1000] [--max-error-rate 0.01] [--no-tracemalloc]
+#                                  [--output soak.json]
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import httpx
+import psutil
+
+from harness import start_server, start_upstream, stop, upstream_env
+from run_benchmarks import git_revision, process_usage
+
+SERVER_PORTS = {"default": 5141, "stream": 5142, "asgi": 5143}
+# Directories each server writes to, by the variable that points it at one
+DIRECTORIES = {"sessions": "CHAT_SESSION_DIR", "conversations": "CHAT_CONVERSATION_DIR", "history": "CHAT_HISTORY_DIR"}
+TOP_SITES = 25
+QUESTION = "Can you tell me more about the MAINSTREAM AIIO Framework and how it helps with project management?"
+
+
+class Traffic:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.sessions = 0
+        self.ended = 0
+
+
+async def send_turn(client, base_url, user_input, user_name, traffic):
+    # The conversation id and sequence number of the server's copy after this turn, None for
+    # either when the turn failed or the server did not report them
+    sync = {"conversation_id": None, "seq": None}
+    failed = False
+    try:
+        async with client.stream('POST', f"{base_url}/api/chat", json={"input": user_input, "user_name": user_name}) as response:
+            response.raise_for_status()
+            sync["conversation_id"] = response.headers.get('X-Conversation-Id')
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                payload = json.loads(line)
+                if 'error' in payload or str(payload.get('response', '')).startswith(("An OpenAI error", "An error")):
+                    failed = True
+                sync["conversation_id"] = payload.get('conversation_id', sync["conversation_id"])
+                sync["seq"] = payload.get('seq', sync["seq"])
+    except (httpx.HTTPError, ValueError):
+        failed = True
+    traffic.requests += 1
+    if failed:
+        traffic.errors += 1
+        return None
+    return sync
+
+
+async def simulated_client(base_url, index, args, traffic, deadline):
+    user_name = f"soak{index}"
+    async with httpx.AsyncClient(timeout=60) as client:
+        while time.monotonic() < deadline and (args.requests is None or traffic.requests < args.requests):
+            # A new session for every chat, like a new visitor
+            client.cookies.clear()
+            traffic.sessions += 1
+            chat = traffic.sessions
+            transcript = []
+            sync = None
+            for turn in range(args.turns):
+                user_input = f"{QUESTION} ({chat}.{turn})"
+                sync = await send_turn(client, base_url, user_input, user_name, traffic)
+                transcript.append({"role": "user", "content": user_input})
+                if sync is None:
+                    break
+            if random.random() < args.abandon:
+                continue
+            if sync and sync["conversation_id"] and sync["seq"] is not None:
+                # Everything is on the server already, only finalize it
+                payload = {"conversation_id": sync["conversation_id"], "base_seq": sync["seq"]}
+            else:
+                payload = {"conversation": transcript, "user_name": user_name}
+            try:
+                response = await client.post(f"{base_url}/api/chat/end", json=payload)
+                traffic.ended += response.status_code == 200
+                traffic.errors += response.status_code != 200
+            except httpx.HTTPError:
+                traffic.errors += 1
+
+
+def disk_usage(directory):
+    files = size = 0
+    for path, _, names in os.walk(directory):
+        for name in names:
+            try:
+                size += os.path.getsize(os.path.join(path, name))
+                files += 1
+            except OSError:
+                # Replaced or removed while walking
+                pass
+    return {"files": files, "bytes": size}
+
+
+async def memory_api(client, base_url, method='GET', **kwargs):
+    # The server's tracemalloc report, None when it runs without CHAT_TRACEMALLOC=1
+    try:
+        response = await client.request(method, f"{base_url}/api/memory", **kwargs)
+    except httpx.HTTPError:
+        return None
+    return response.json() if response.status_code == 200 else None
+
+
+async def take_sample(client, base_url, process, directories, traffic, started):
+    _, rss = process_usage(process)
+    memory = await memory_api(client, base_url, params={"limit": 0})
+    disk = {name: await asyncio.to_thread(disk_usage, path) for name, path in directories.items()}
+    return {"seconds": round(time.monotonic() - started, 1), "requests": traffic.requests, "errors": traffic.errors,
+            "sessions": traffic.sessions, "rss_bytes": rss, "traced_bytes": memory and memory['traced_bytes'],
+            "disk": disk}
+
+
+async def soak(base_url, process, directories, args):
+    traffic = Traffic()
+    samples = []
+    baseline = None
+    started = time.monotonic()
+    deadline = started + args.duration
+    clients = [asyncio.create_task(simulated_client(base_url, i, args, traffic, deadline)) for i in range(args.clients)]
+    async with httpx.AsyncClient(timeout=300) as client:
+        next_sample = started
+        while not all(task.done() for task in clients):
+            await asyncio.sleep(1)
+            if baseline is None and traffic.requests >= args.warmup_requests:
+                await memory_api(client, base_url, 'POST', json={"baseline": True})
+                baseline = await take_sample(client, base_url, process, directories, traffic, started)
+                samples.append(baseline)
+            elif time.monotonic() >= next_sample:
+                samples.append(await take_sample(client, base_url, process, directories, traffic, started))
+                next_sample = time.monotonic() + args.sample_seconds
+        await asyncio.gather(*clients)
+        final = await take_sample(client, base_url, process, directories, traffic, started)
+        samples.append(final)
+        report = await memory_api(client, base_url, params={"limit": TOP_SITES})
+    return traffic, samples, baseline, final, report
+
+
+def slope(points):
+    # Least-squares slope of y over x
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    spread = sum((x - mean_x) ** 2 for x, _ in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread if spread else None
+
+
+def disk_bytes(sample):
+    return sum(usage['bytes'] for usage in sample['disk'].values())
+
+
+def evaluate(samples, baseline, final, args):
+    # Growth after the warmup and the thresholds it breaks
+    failures = []
+    error_rate = final['errors'] / final['requests'] if final['requests'] else 1.0
+    if error_rate > args.max_error_rate:
+        failures.append(f"{error_rate:.1%} of requests failed > {args.max_error_rate:.1%}")
+    if baseline is None:
+        return None, failures + [f"never reached --warmup-requests {args.warmup_requests}"]
+    after = [sample for sample in samples if sample['requests'] >= baseline['requests']]
+    requests = final['requests'] - baseline['requests']
+    sessions = final['sessions'] - baseline['sessions']
+    traced = final['traced_bytes'] is not None and baseline['traced_bytes'] is not None
+    memory_growth = (final['traced_bytes'] - baseline['traced_bytes'] if traced
+                     else final['rss_bytes'] - baseline['rss_bytes'])
+    rss_slope = slope([(sample['requests'], sample['rss_bytes']) for sample in after])
+    disk_slope = slope([(sample['requests'], disk_bytes(sample)) for sample in after])
+    growth = {
+        "requests": requests,
+        "sessions": sessions,
+        "measured_by": "tracemalloc" if traced else "rss",
+        "session_kb": round(memory_growth / sessions / 1024, 2) if sessions else None,
+        "rss_growth_mb": round((final['rss_bytes'] - baseline['rss_bytes']) / 2**20, 2),
+        "rss_mb_per_10k": round(rss_slope * 10000 / 2**20, 2) if rss_slope is not None else None,
+        "disk_growth_mb": {name: round((usage['bytes'] - baseline['disk'][name]['bytes']) / 2**20, 2)
+                           for name, usage in final['disk'].items()},
+        "disk_mb_per_10k": round(disk_slope * 10000 / 2**20, 2) if disk_slope is not None else None,
+    }
+    if growth['session_kb'] is not None and growth['session_kb'] > args.max_session_kb:
+        failures.append(f"{growth['session_kb']} KB per session > {args.max_session_kb}")
+    if growth['rss_mb_per_10k'] is not None and growth['rss_mb_per_10k'] > args.max_growth_mb_per_10k:
+        failures.append(f"RSS grows {growth['rss_mb_per_10k']} MB per 10k requests > {args.max_growth_mb_per_10k}")
+    if (args.max_disk_mb_per_10k is not None and growth['disk_mb_per_10k'] is not None
+            and growth['disk_mb_per_10k'] > args.max_disk_mb_per_10k):
+        failures.append(f"disk grows {growth['disk_mb_per_10k']} MB per 10k requests > {args.max_disk_mb_per_10k}")
+    return growth, failures
+
+
+def soak_server(name, env, args):
+    port = SERVER_PORTS[name]
+    with tempfile.TemporaryDirectory() as root:
+        directories = {directory: os.path.join(root, directory) for directory in DIRECTORIES}
+        server_env = dict(env, **{variable: directories[directory] for directory, variable in DIRECTORIES.items()})
+        for path in directories.values():
+            os.makedirs(path, exist_ok=True)
+        with tempfile.TemporaryFile() as server_output:
+            server = start_server(name, port, server_env, server_output)
+            try:
+                traffic, samples, baseline, final, report = asyncio.run(
+                    soak(f"http://127.0.0.1:{port}", psutil.Process(server.pid), directories, args))
+            finally:
+                stop([server])
+
+    growth, failures = evaluate(samples, baseline, final, args)
+    return {
+        "requests": traffic.requests,
+        "errors": traffic.errors,
+        "sessions": traffic.sessions,
+        "ended": traffic.ended,
+        "growth_after_warmup": growth,
+        "top_growth_sites": report['sites'] if report else None,
+        "samples": samples,
+        "failures": failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test with memory and disk growth thresholds")
+    parser.add_argument('--servers', nargs='+', default=list(SERVER_PORTS), choices=list(SERVER_PORTS))
+    parser.add_argument('--duration', type=float, default=600, help="seconds of traffic per server")
+    parser.add_argument('--requests', type=int, help="stop after this many chat requests instead")
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--turns', type=int, default=4, help="questions per chat")
+    parser.add_argument('--abandon', type=float, default=0.3, help="share of chats that are never ended")
+    parser.add_argument('--sample-seconds', type=float, default=30)
+    parser.add_argument('--warmup-requests', type=int, default=1000)
+    parser.add_argument('--no-tracemalloc', action='store_true', help="measure RSS only, without tracing overhead")
+    parser.add_argument('--max-session-kb', type=float, default=float(os.getenv("SOAK_MAX_SESSION_KB", "32")))
+    parser.add_argument('--max-growth-mb-per-10k', type=float, default=float(os.getenv("SOAK_MAX_GROWTH_MB_PER_10K", "32")))
+    parser.add_argument('--max-disk-mb-per-10k', type=float,
+                        default=float(os.environ["SOAK_MAX_DISK_MB_PER_10K"]) if os.getenv("SOAK_MAX_DISK_MB_PER_10K") else None)
+    parser.add_argument('--max-error-rate', type=float, default=float(os.getenv("SOAK_MAX_ERROR_RATE", "0.01")),
+                        help="failed chat turns and chat ends allowed per chat request")
+    parser.add_argument('--server-env', nargs='*', default=[], metavar='KEY=VALUE',
+                        help="Extra environment variables for the servers, e.g. CHAT_SESSION_BACKEND=filesystem")
+    parser.add_argument('--output', help="Write the results to this JSON file instead of stdout")
+    args = parser.parse_args()
+
+    env = upstream_env(FAKE_TTFT_MS=20, FAKE_TOKENS_PER_SEC=2000, FAKE_COMPLETION_TOKENS=40,
+                       CHAT_LOG_LEVEL="WARNING", CHAT_TRACEMALLOC="0" if args.no_tracemalloc else "1")
+    server_env = dict(item.split('=', 1) for item in args.server_env)
+    env.update(server_env)
+
+    results = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "git_revision": git_revision(),
+            "duration_seconds": args.duration,
+            "clients": args.clients,
+            "turns": args.turns,
+            "abandon": args.abandon,
+            "thresholds": {"session_kb": args.max_session_kb, "rss_mb_per_10k": args.max_growth_mb_per_10k,
+                           "disk_mb_per_10k": args.max_disk_mb_per_10k, "error_rate": args.max_error_rate},
+            "server_env": server_env,
+        },
+        "servers": {},
+    }
+    upstream = start_upstream(env)
+    try:
+        for name in args.servers:
+            results["servers"][name] = soak_server(name, env, args)
+    finally:
+        stop([upstream])
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    failures = [f"{name}: {failure}" for name, result in results["servers"].items() for failure in result["failures"]]
+    if failures:
+        sys.exit("; ".join(failures))
+
+
+if __name__ == '__main__':
+    main()
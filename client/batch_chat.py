@@ -0,0 +1,240 @@
+import requests
+from requests.adapters import HTTPAdapter
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+# Batch mode for bulk jobs: reads prompts from a JSONL file and sends them to /api/chat/batch, a
+# few batches at a time over one pooled keep-alive session. Results are appended to the output
+# file as the server streams them, one JSON line per prompt with the prompt's line number as its
+# index, and throughput is reported as it goes.
+#
+# Each input line is a JSON string, an object with "input" or "messages" (and an optional "id"),
+# or plain text. Other JSON values (numbers, true, arrays) are sent as their text. Objects the
+# server would reject get an error line of their own instead of failing their batch. Prompts the
+# server sheds (429/503 with retry_after) are sent again later, a batch it rejects (4xx) is not.
+#
+# Usage: python client/batch_chat.py prompts.jsonl results.jsonl [--batch-size 50] [--parallel 4]
+
+BATCH_ENDPOINT = "http://127.0.0.1:5000/api/chat/batch"
+# (connect, read) timeouts in seconds. The read timeout is the longest wait for the next result.
+CONNECT_TIMEOUT = float(os.getenv("CHAT_CLIENT_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("CHAT_CLIENT_READ_TIMEOUT", "90"))
+# Times a shed or unanswered prompt is sent again before its error is written
+RETRIES = int(os.getenv("CHAT_CLIENT_BATCH_RETRIES", "3"))
+RETRY_BACKOFF = 1.0
+REPORT_INTERVAL = 5.0
+ROLES = ("user", "assistant")
+
+user_name = "User123"  # Hardcoded user name for this example
+
+
+def make_session(pool_size):
+    # One session for every batch, its connections are kept alive and reused
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class BatchRejected(Exception):
+    # The server refused the whole batch, sending it again would not help
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def read_prompts(path):
+    # (line number, item) for every non-blank line
+    with open(path) as prompts_file:
+        for index, line in enumerate(prompts_file):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = line
+            # Only strings and objects are items, any other JSON is a prompt that happens to parse
+            yield index, item if isinstance(item, (str, dict)) else line
+
+
+def item_problem(item):
+    # Why the server would reject this item, the same checks as its parse_item, or None
+    if isinstance(item, str) or isinstance(item.get('input'), str):
+        return None
+    if 'messages' not in item:
+        return "The item needs an input or messages."
+    messages = item['messages']
+    if not isinstance(messages, list) or not all(
+            isinstance(message, dict) and message.get('role') in ROLES and isinstance(message.get('content'), str)
+            for message in messages):
+        return "Each message needs a user or assistant role and a string content."
+    if not messages or messages[-1]['role'] != 'user':
+        return "The messages must end with a user message."
+    return None
+
+
+def read_batches(prompts, batch_size):
+    batch = []
+    for prompt in prompts:
+        batch.append(prompt)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class Progress:
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.done = 0
+        self.errors = 0
+        self.retried = 0
+        self.completion_tokens = 0
+        self.started = time.perf_counter()
+        self._reported = self.started
+        self._lock = threading.Lock()
+
+    def write(self, result):
+        # Results are written and flushed as they arrive, so a job that stops keeps what it got
+        with self._lock:
+            self.output_file.write(json.dumps(result) + "\n")
+            self.output_file.flush()
+            self.done += 1
+            self.errors += 'error' in result
+            self.completion_tokens += result.get('usage', {}).get('completion_tokens', 0)
+            now = time.perf_counter()
+            if now - self._reported >= REPORT_INTERVAL:
+                self._reported = now
+                print(self.report(), file=sys.stderr)
+
+    def retrying(self, count):
+        with self._lock:
+            self.retried += count
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        return (f"{self.done} prompts, {self.errors} errors, {self.retried} retried in {elapsed:.1f}s: "
+                f"{self.done / elapsed:.1f} prompts/s, {self.completion_tokens / elapsed:.0f} completion tokens/s")
+
+
+def stream_batch(session, batch, concurrency):
+    # Yield the results of one batch as the server streams them
+    payload = {"user_name": user_name, "items": [item for _, item in batch]}
+    if concurrency:
+        payload["concurrency"] = concurrency
+    with session.post(BATCH_ENDPOINT, json=payload, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+        if 400 <= response.status_code < 500 and response.status_code != 429:
+            try:
+                message = response.json().get('error', response.reason)
+            except ValueError:
+                message = response.text or response.reason
+            raise BatchRejected(response.status_code, message)
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def run_batch(session, batch, concurrency, progress):
+    pending = []
+    for index, item in batch:
+        problem = item_problem(item)
+        if problem:
+            progress.write({"index": index, "error": problem, "status": 400})
+        else:
+            pending.append((index, item))
+    if not pending:
+        return
+    for attempt in range(RETRIES + 1):
+        last_attempt = attempt == RETRIES
+        # Line number -> item of the prompts not answered yet in this attempt
+        unanswered = dict(pending)
+        retry_after = 0
+        retry = []
+        try:
+            for result in stream_batch(session, pending, concurrency):
+                if result.get('done'):
+                    break
+                # The server numbers the items of the batch, the output uses the input's line numbers
+                index = pending[result['index']][0]
+                result['index'] = index
+                item = unanswered.pop(index)
+                if 'retry_after' in result and not last_attempt:
+                    retry.append((index, item))
+                    retry_after = max(retry_after, result['retry_after'])
+                else:
+                    progress.write(result)
+        except BatchRejected as e:
+            for index in unanswered:
+                progress.write({"index": index, "error": str(e), "status": e.status})
+            return
+        except (requests.exceptions.RequestException, ValueError) as e:
+            # The batch failed or was cut off, the prompts without a result are sent again
+            error = f"An error occurred: {e}"
+        else:
+            error = "No result from the server."
+        if last_attempt:
+            for index in unanswered:
+                progress.write({"index": index, "error": error})
+            return
+        retry += unanswered.items()
+        if not retry:
+            return
+        progress.retrying(len(retry))
+        pending = sorted(retry)
+        time.sleep(max(retry_after, RETRY_BACKOFF * (attempt + 1)))
+
+
+def run(prompts_path, output_path, batch_size, parallel, concurrency):
+    session = make_session(parallel)
+    batches = read_batches(read_prompts(prompts_path), batch_size)
+    batches_lock = threading.Lock()
+
+    with open(output_path, "a") as output_file:
+        progress = Progress(output_file)
+
+        def worker():
+            while True:
+                with batches_lock:
+                    batch = next(batches, None)
+                if batch is None:
+                    return
+                run_batch(session, batch, concurrency, progress)
+
+        threads = [threading.Thread(target=worker) for _ in range(parallel)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        print(progress.report())
+    return progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a JSONL file of prompts to /api/chat/batch")
+    parser.add_argument('prompts', help="JSONL file with one prompt per line")
+    parser.add_argument('output', help="JSONL file the results are appended to")
+    parser.add_argument('--batch-size', type=int, default=50, help="prompts per request")
+    parser.add_argument('--parallel', type=int, default=4, help="batches in flight at once")
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help="prompts answered at once per batch, capped by the server")
+    args = parser.parse_args()
+    try:
+        progress = run(args.prompts, args.output, args.batch_size, args.parallel, args.concurrency)
+    except KeyboardInterrupt:
+        print("\nBatch interrupted by user.")
+        return
+    if progress.errors:
+        sys.exit(f"{progress.errors} prompts failed, see {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,24 @@ import os
 from datetime import datetime
 
 SERVER_ENDPOINT = "http://127.0.0.1:5000/api/chat"
+END_CHAT_ENDPOINT = "http://127.0.0.1:5000/api/chat/end"
+# (connect, read) timeouts in seconds. The read timeout covers the whole answer, which the server
+# may spend waiting for a free slot or upstream budget before the model starts.
+CONNECT_TIMEOUT = float(os.getenv("CHAT_CLIENT_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("CHAT_CLIENT_READ_TIMEOUT", "90"))
 
 # Initialize a session object to store the conversation history
 session = requests.Session()
 conversation = []  # Local storage for the conversation
 user_name = "User123"  # Hardcoded user name for this example
+# Delta sync: the server's id for this conversation, the sequence number of the last message it
+# acknowledged, and how many of our local messages that covers
+conversation_id = None
+acked_seq = 0
+acked_length = 0
 
 def chat():
+    global conversation_id, acked_seq, acked_length
     print("-" * 40)  # Print the separator before the conversation starts
     try:
         while True:
@@ -25,12 +36,16 @@ def chat():
 
             try:
                 # Send the user's input to the server, including the hardcoded user name
-                response = session.post(SERVER_ENDPOINT, json={"input": user_input, "user_name": user_name}, timeout=10)
+                response = session.post(SERVER_ENDPOINT, json={"input": user_input, "user_name": user_name}, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
                 response.raise_for_status()  # Raise an HTTPError if the HTTP request returned an unsuccessful status code
                 
-                chatbot_response = response.json()["response"]
+                response_data = response.json()
+                chatbot_response = response_data["response"]
                 # Append the assistant's response to the local conversation history
                 conversation.append({"role": "assistant", "content": chatbot_response})
+                if "seq" in response_data:
+                    # The server holds everything up to this answer
+                    conversation_id, acked_seq, acked_length = response_data["conversation_id"], response_data["seq"], len(conversation)
                 
                 print("-" * 40)  # Separator after user input
                 print("Streamy:", chatbot_response)
@@ -57,6 +72,21 @@ def chat():
         # Save the conversation when the chat ends or is interrupted
         save_conversation()
 
+def end_chat_payload():
+    # Only the messages after the last one the server acknowledged. Servers that don't report
+    # sequence numbers get the whole conversation.
+    if conversation_id is None:
+        return {"conversation": conversation, "user_name": user_name}
+    return {"conversation_id": conversation_id, "base_seq": acked_seq, "messages": conversation[acked_length:],
+            "user_name": user_name}
+
+def post_end_chat():
+    response = session.post(END_CHAT_ENDPOINT, json=end_chat_payload(), timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    if response.status_code == 409:
+        # The server's copy doesn't match ours, upload the whole conversation instead
+        response = session.post(END_CHAT_ENDPOINT, json={"conversation": conversation, "user_name": user_name}, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    return response
+
 def save_conversation():
     # Define the directory for saving chat history
     chat_history_dir = './client/chat_history'
@@ -77,7 +107,7 @@ def save_conversation():
 
     try:
         # Request the server to save the conversation, including the hardcoded user name
-        response = session.post("http://127.0.0.1:5000/api/chat/end", json={"conversation": conversation, "user_name": user_name}, timeout=10)
+        response = post_end_chat()
         response.raise_for_status()  # Raise an HTTPError if the HTTP request returned an unsuccessful status code
         print("Conversation saved on the server side.")
     except requests.exceptions.HTTPError as http_err:
@@ -1,17 +1,66 @@
 import requests
 import json
 import os
+import time
 from datetime import datetime
 
 SERVER_ENDPOINT = "http://127.0.0.1:5000/api/chat"
 END_CHAT_ENDPOINT = "http://127.0.0.1:5000/api/chat/end"
+STREAM_ENDPOINT = "http://127.0.0.1:5000/api/chat/stream/"
+# (connect, read) timeouts in seconds. While streaming, the read timeout is the longest gap
+# between two chunks, so a stalled stream fails instead of hanging.
+CONNECT_TIMEOUT = float(os.getenv("CHAT_CLIENT_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("CHAT_CLIENT_READ_TIMEOUT", "90"))
+# Reconnects to an answer whose connection dropped, waiting a little longer before each one
+RESUME_ATTEMPTS = int(os.getenv("CHAT_CLIENT_RESUME_ATTEMPTS", "3"))
+RESUME_BACKOFF = 0.5
 
 # Initialize a session object to store the conversation history
 session = requests.Session()
 conversation = []  # Local storage for the conversation
 user_name = "User123"  # Hardcoded user name for this example
+# Delta sync: the server's id for this conversation, the sequence number of the last message it
+# acknowledged, and how many of our local messages that covers
+conversation_id = None
+acked_seq = 0
+acked_length = 0
+
+def read_stream(response, answer):
+    # Print the streamed chunks and collect them in `answer`. Returns True once the server has
+    # ended the stream, False if the connection dropped before that.
+    try:
+        for chunk in response.iter_lines():
+            # Servers running in Server-Sent Events mode prefix the payload with "data: ", and
+            # number chunks in the event id
+            if chunk.startswith(b"id: "):
+                answer["chunk"] = int(chunk[len(b"id: "):])
+                continue
+            if chunk.startswith(b"data: "):
+                chunk = chunk[len(b"data: "):]
+            if chunk:
+                try:
+                    chunk_data = json.loads(chunk.decode('utf-8'))
+                except json.JSONDecodeError:
+                    # If a chunk is not valid JSON, skip it
+                    continue
+                if "error" in chunk_data:
+                    return True
+                if "seq" in chunk_data:
+                    # The last frame tells which sequence number the answer was stored as
+                    answer["seq"] = chunk_data["seq"]
+                    return True
+                # Numbered chunks let a dropped stream resume where it stopped
+                answer["chunk"] = chunk_data.get("chunk", answer["chunk"])
+                chunk_content = chunk_data.get("choices", [{}])[0].get("delta", {}).get("content", "")
+                if chunk_content:
+                    answer["content"] += chunk_content
+                    print(chunk_content, end='', flush=True)  # Print the response as it streams
+    except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError):
+        pass
+    return False
 
 def chat():
+    global conversation_id, acked_seq, acked_length
     print("-" * 40)  # Print the separator before the conversation starts
     try:
         while True:
@@ -26,29 +75,38 @@ def chat():
 
             try:
                 # Send the user's input to the server, including the hardcoded user name
-                with session.post(SERVER_ENDPOINT, json={"input": user_input, "user_name": user_name}, stream=True) as response:
+                with session.post(SERVER_ENDPOINT, json={"input": user_input, "user_name": user_name}, stream=True,
+                                  timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
                     response.raise_for_status()  # Raise an HTTPError if the HTTP request returned an unsuccessful status code
-                    
-                    chatbot_response = ""
+                    if "X-Conversation-Seq" in response.headers:
+                        # The server holds everything up to our message
+                        conversation_id = response.headers["X-Conversation-Id"]
+                        acked_seq, acked_length = int(response.headers["X-Conversation-Seq"]), len(conversation)
+                    stream_id = response.headers.get("X-Stream-Id")
+
+                    answer = {"content": "", "chunk": 0, "seq": None}
                     print("Streamy:", end='', flush=True)  # Prefix for Streamy's response
+                    complete = read_stream(response, answer)
 
-                    # Process the streamed chunks
-                    for chunk in response.iter_lines():
-                        if chunk:
-                            try:
-                                chunk_data = json.loads(chunk.decode('utf-8'))
-                                chunk_content = chunk_data.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                                if chunk_content:
-                                    chatbot_response += chunk_content
-                                    print(chunk_content, end='', flush=True)  # Print the response as it streams
-                            except json.JSONDecodeError:
-                                # If a chunk is not valid JSON, skip it
-                                continue
+                # The connection dropped mid-answer, pick up after the last chunk we got instead of asking again
+                attempt = 0
+                while not complete and stream_id and attempt < RESUME_ATTEMPTS:
+                    attempt += 1
+                    try:
+                        with session.get(STREAM_ENDPOINT + stream_id, params={"after": answer["chunk"]}, stream=True,
+                                         timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+                            response.raise_for_status()
+                            complete = read_stream(response, answer)
+                    except requests.exceptions.ConnectionError:
+                        time.sleep(RESUME_BACKOFF * attempt)
 
-                    # Append the assistant's response to the local conversation history
-                    conversation.append({"role": "assistant", "content": chatbot_response})
+                # Append the assistant's response to the local conversation history
+                conversation.append({"role": "assistant", "content": answer["content"]})
+                if answer["seq"] == acked_seq + 1:
+                    # The server stored the answer too (it doesn't keep answers cut off by the token limit)
+                    acked_seq, acked_length = answer["seq"], len(conversation)
 
-                    print("\n" + "-" * 40)  # Separator after Streamy's response
+                print("\n" + "-" * 40)  # Separator after Streamy's response
 
             except requests.exceptions.HTTPError as http_err:
                 # Handle HTTP errors
@@ -71,6 +129,20 @@ def chat():
         # Save the conversation when the chat ends or is interrupted
         save_conversation()
 
+def end_chat_payload():
+    # Only the messages after the last one the server acknowledged. Servers that don't report
+    # sequence numbers get the whole conversation.
+    if conversation_id is None:
+        return conversation
+    return {"conversation_id": conversation_id, "base_seq": acked_seq, "messages": conversation[acked_length:]}
+
+def post_end_chat():
+    response = session.post(END_CHAT_ENDPOINT, json=end_chat_payload(), timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    if response.status_code == 409:
+        # The server's copy doesn't match ours, upload the whole conversation instead
+        response = session.post(END_CHAT_ENDPOINT, json=conversation, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    return response
+
 def save_conversation():
     # Define the directory for saving chat history
     chat_history_dir = './client/chat_history'
@@ -86,7 +158,7 @@ def save_conversation():
 
     try:
         # Request the server to save the conversation
-        response = session.post(END_CHAT_ENDPOINT, json=conversation, timeout=10)
+        response = post_end_chat()
         response.raise_for_status()  # Raise an HTTPError if the HTTP request returned an unsuccessful status code
         print("Conversation saved on the server side.")
     except requests.exceptions.HTTPError as http_err:
@@ -0,0 +1,272 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from collections import deque
+from chat_logging import event, get_logger
+
+# Admission control for /api/chat. At most CHAT_MAX_CONCURRENT requests are answered at once,
+# the others wait in a queue ordered by start-time fair queuing on user_name: every request is
+# tagged with its user's virtual finish time (cost divided by the user's weight), so a user with
+# many requests or long histories only gets their share of the slots while others are waiting.
+# The cost of a request is its prompt tokens.
+#
+# Requests are shed straight away instead of slowing everyone down: 429 when the user already
+# has CHAT_MAX_QUEUE_PER_USER requests waiting, 503 when the queue is full or the expected wait
+# is over CHAT_SHED_AFTER_MS, and 503 when a queued request is still waiting after
+# CHAT_QUEUE_TIMEOUT. Every rejection carries a Retry-After estimate.
+#
+# Configuration:
+#   CHAT_MAX_CONCURRENT      requests answered at the same time, 0 to admit everything (default 32
+#                            for the Flask servers, where every request holds a thread; 0 for the
+#                            async server, where a stream holds its slot for the whole answer)
+#   CHAT_MAX_QUEUE           requests waiting for a slot (default 256)
+#   CHAT_MAX_QUEUE_PER_USER  requests one user may have waiting (default 8)
+#   CHAT_QUEUE_TIMEOUT       seconds a request may wait for a slot (default 10)
+#   CHAT_SHED_AFTER_MS       expected queueing delay above which new requests are rejected (default 2000)
+#   CHAT_USER_WEIGHTS        share of the slots per user, e.g. "alice=2,batch=0.5" (default 1)
+
+DEFAULT_MAX_CONCURRENT = 32
+DEFAULT_MAX_QUEUE = 256
+DEFAULT_MAX_QUEUE_PER_USER = 8
+DEFAULT_QUEUE_TIMEOUT = 10.0
+DEFAULT_SHED_AFTER = 2.0
+# Recent queue waits kept for the percentiles in stats()
+WAIT_SAMPLES = 1000
+# Weight of the latest request in the moving average of the time a slot is held
+SERVICE_TIME_SMOOTHING = 0.1
+# Users remembered for their finish tag before the ones that no longer matter are dropped
+MAX_TRACKED_USERS = 10000
+
+logger = get_logger("admission")
+
+
+class Overloaded(Exception):
+    # The request was not admitted, status is 429 or 503 and retry_after is in seconds
+
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    def headers(self):
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class Ticket:
+    # One request's place in the queue, and later its slot
+
+    def __init__(self, user_name, start_tag, sequence, wake, enqueued_at):
+        self.user_name = user_name
+        self.start_tag = start_tag
+        self.sequence = sequence
+        self.wake = wake
+        self.enqueued_at = enqueued_at
+        self.admitted_at = None
+        self.cancelled = False
+        self.released = False
+
+    def __lt__(self, other):
+        return (self.start_tag, self.sequence) < (other.start_tag, other.sequence)
+
+
+def parse_weights(spec):
+    weights = {}
+    for item in spec.split(','):
+        if '=' in item:
+            user_name, weight = item.rsplit('=', 1)
+            weights[user_name.strip()] = float(weight)
+    return weights
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent=DEFAULT_MAX_CONCURRENT, max_queue=DEFAULT_MAX_QUEUE,
+                 max_queue_per_user=DEFAULT_MAX_QUEUE_PER_USER, queue_timeout=DEFAULT_QUEUE_TIMEOUT,
+                 shed_after=DEFAULT_SHED_AFTER, weights=None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.queue_timeout = queue_timeout
+        self.shed_after = shed_after
+        self.weights = weights or {}
+        self.active = 0
+        self.queued = 0
+        self.admitted = 0
+        self.shed = {"user_queue_full": 0, "queue_full": 0, "expected_delay": 0, "timeout": 0}
+        self._queue = []
+        self._queued_by_user = {}
+        self._finish_tags = {}
+        self._virtual_time = 0.0
+        self._sequence = itertools.count()
+        self._service_time = None
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self._lock = threading.Lock()
+
+    def _expected_wait(self, position):
+        # Rough wait of the request at `position` in the queue, from the average slot time
+        if not self._service_time:
+            return 0.0
+        return (position + 1) * self._service_time / self.max_concurrent
+
+    def _reject(self, reason, status, message, retry_after):
+        self.shed[reason] += 1
+        logger.warning("Request shed (%s): %s", reason, message, extra=event('admission'))
+        return Overloaded(status, message, retry_after)
+
+    def _dispatch(self, ticket, now):
+        ticket.admitted_at = now
+        self.active += 1
+        self.admitted += 1
+        self._virtual_time = max(self._virtual_time, ticket.start_tag)
+        self._waits.append(now - ticket.enqueued_at)
+
+    def _enqueue(self, user_name, cost, wake):
+        # Admit the request or queue it, raises Overloaded if it is shed
+        with self._lock:
+            now = time.monotonic()
+            start_tag = max(self._virtual_time, self._finish_tags.get(user_name, 0.0))
+            ticket = Ticket(user_name, start_tag, next(self._sequence), wake, now)
+            if self.active < self.max_concurrent and not self.queued:
+                self._dispatch(ticket, now)
+            else:
+                user_queued = self._queued_by_user.get(user_name, 0)
+                if user_queued >= self.max_queue_per_user:
+                    raise self._reject("user_queue_full", 429, f"Too many queued requests for {user_name}",
+                                       self._expected_wait(self.queued))
+                if self.queued >= self.max_queue:
+                    raise self._reject("queue_full", 503, "Server busy, the request queue is full",
+                                       self._expected_wait(self.queued))
+                expected_wait = self._expected_wait(self.queued)
+                if expected_wait > self.shed_after:
+                    raise self._reject("expected_delay", 503, "Server busy, try again later", expected_wait)
+                heapq.heappush(self._queue, ticket)
+                self.queued += 1
+                self._queued_by_user[user_name] = user_queued + 1
+            self._finish_tags[user_name] = start_tag + max(cost, 1) / self.weights.get(user_name, 1.0)
+            return ticket
+
+    def _dequeued(self, ticket):
+        self.queued -= 1
+        remaining = self._queued_by_user[ticket.user_name] - 1
+        if remaining:
+            self._queued_by_user[ticket.user_name] = remaining
+        else:
+            del self._queued_by_user[ticket.user_name]
+
+    def _abandon(self, ticket, timed_out=True):
+        # Give up on a queued ticket, False if it was admitted in the meantime
+        with self._lock:
+            if ticket.admitted_at is not None:
+                return False
+            ticket.cancelled = True
+            self._dequeued(ticket)
+            if timed_out:
+                self.shed["timeout"] += 1
+        if timed_out:
+            logger.warning("Request shed (timeout): %s waited %.1fs", ticket.user_name, self.queue_timeout,
+                           extra=event('admission'))
+        return True
+
+    def _timed_out(self):
+        return Overloaded(503, "Server busy, timed out waiting for a slot", self._expected_wait(self.queued))
+
+    def acquire(self, user_name, cost):
+        # Wait for a slot on the calling thread, release() the returned ticket when done
+        if not self.max_concurrent:
+            return None
+        ready = threading.Event()
+        ticket = self._enqueue(user_name, cost, ready.set)
+        if ticket.admitted_at is None and not ready.wait(self.queue_timeout) and self._abandon(ticket):
+            raise self._timed_out()
+        return ticket
+
+    async def acquire_async(self, user_name, cost):
+        if not self.max_concurrent:
+            return None
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: ready.done() or ready.set_result(None))
+
+        ticket = self._enqueue(user_name, cost, wake)
+        if ticket.admitted_at is None:
+            try:
+                await asyncio.wait_for(asyncio.shield(ready), self.queue_timeout)
+            except asyncio.TimeoutError:
+                if self._abandon(ticket):
+                    raise self._timed_out()
+            except asyncio.CancelledError:
+                # The client went away while waiting
+                if not self._abandon(ticket, timed_out=False):
+                    self.release(ticket)
+                raise
+        return ticket
+
+    def release(self, ticket):
+        if ticket is None:
+            return
+        woken = []
+        with self._lock:
+            if ticket.released or ticket.admitted_at is None:
+                return
+            ticket.released = True
+            now = time.monotonic()
+            self.active -= 1
+            held = now - ticket.admitted_at
+            if self._service_time is None:
+                self._service_time = held
+            else:
+                self._service_time += SERVICE_TIME_SMOOTHING * (held - self._service_time)
+            while self._queue and self.active < self.max_concurrent:
+                waiting = heapq.heappop(self._queue)
+                if waiting.cancelled:
+                    continue
+                self._dequeued(waiting)
+                self._dispatch(waiting, now)
+                woken.append(waiting)
+            if len(self._finish_tags) > MAX_TRACKED_USERS:
+                # Users whose last finish tag is behind the virtual time start from it anyway
+                self._finish_tags = {user_name: tag for user_name, tag in self._finish_tags.items()
+                                     if tag > self._virtual_time}
+        for waiting in woken:
+            waiting.wake()
+
+    def stats(self):
+        with self._lock:
+            waits = list(self._waits)
+            busiest = sorted(self._queued_by_user.items(), key=lambda item: -item[1])[:10]
+            return {
+                "enabled": bool(self.max_concurrent),
+                "active": self.active,
+                "max_concurrent": self.max_concurrent,
+                "queued": self.queued,
+                "queued_users": len(self._queued_by_user),
+                "queued_by_user": dict(busiest),
+                "admitted": self.admitted,
+                "shed": dict(self.shed),
+                "wait_p50_ms": round(percentile(waits, 0.5) * 1000, 2) if waits else None,
+                "wait_p99_ms": round(percentile(waits, 0.99) * 1000, 2) if waits else None,
+                "service_ms": round(self._service_time * 1000, 2) if self._service_time else None,
+            }
+
+
+def admission_from_env(default_max_concurrent=DEFAULT_MAX_CONCURRENT):
+    return AdmissionController(
+        max_concurrent=int(os.getenv("CHAT_MAX_CONCURRENT", str(default_max_concurrent))),
+        max_queue=int(os.getenv("CHAT_MAX_QUEUE", str(DEFAULT_MAX_QUEUE))),
+        max_queue_per_user=int(os.getenv("CHAT_MAX_QUEUE_PER_USER", str(DEFAULT_MAX_QUEUE_PER_USER))),
+        queue_timeout=float(os.getenv("CHAT_QUEUE_TIMEOUT", str(DEFAULT_QUEUE_TIMEOUT))),
+        shed_after=float(os.getenv("CHAT_SHED_AFTER_MS", str(DEFAULT_SHED_AFTER * 1000))) / 1000,
+        weights=parse_weights(os.getenv("CHAT_USER_WEIGHTS", "")),
+    )
@@ -0,0 +1,785 @@
+import openai
+from openai import AsyncOpenAI, OpenAI
+import asyncio
+import httpx
+import os
+import json
+import queue
+import secrets
+import time
+import uuid
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qsl
+from token_counter import TokenCounter
+from compaction import make_compactor, openai_summarizer
+from response_cache import cache_from_env, cache_key, replay_chunks
+from single_flight import AsyncStreamCoalescer
+from upstream_scheduler import UpstreamBusy, scheduler_from_env
+from upstream_hedging import UpstreamTimeout, hedger_from_env
+from admission import Overloaded, admission_from_env
+from stream_framing import DeltaCoalescer, flush_policy_from_env, make_framer
+from chat_logging import event, get_logger
+from history_writer import writer_from_env
+from system_context import SystemContextProvider
+from startup import LazyEncoding, Warmup, warmup_steps
+from session_backend import VALID_SESSION_ID, session_store_from_env
+from compact_conversation import CompactConversation, SessionCodec
+from history_index import HistoryIndex, accepts_gzip, export_chunks, filters_from_query, resume_conversation_id, API_ENABLED as HISTORY_API_ENABLED
+from chat_sync import SyncError, decode_body, missing_messages, parse_end_request, sync_state
+from batch_chat import CONTENT_TYPE as BATCH_CONTENT_TYPE, item_result, parse_batch, result_line, run_batch_async, summary_line
+import metrics
+from metrics import stage
+from profiler import profiler, ENABLED as PROFILER_ENABLED
+from memory_tracker import memory_tracker, DEFAULT_LIMIT as DEFAULT_MEMORY_SITES, ENABLED as TRACEMALLOC_ENABLED
+
+# Async serving mode for the streaming chat. It exposes the same /api/chat and /api/chat/end
+# contract as flask_stream_chat.py, but every stream is a coroutine on one event loop instead
+# of a WSGI thread, so a single worker can hold thousands of concurrent streams.
+#
+# Run with: uvicorn asgi_stream_chat:app --port 5000 (from the /server directory)
+
+# Constants and Initializations
+MAX_ALLOWED_TOKENS = 4096
+MODEL_NAME = "gpt-4o"
+BOT_RESPONSE_BUFFER = 500
+PROMPT_TOKEN_BUDGET = int(os.getenv("CHAT_PROMPT_TOKEN_BUDGET", "2048"))
+COMPACTION_POLICY = os.getenv("CHAT_COMPACTION_POLICY", "drop_oldest")  # drop_oldest, sliding_window or summary
+SAMPLING_PARAMS = {"temperature": 1, "top_p": 1, "frequency_penalty": 1, "presence_penalty": 1}
+# Pause between chunks when replaying a cached response
+CACHE_REPLAY_DELAY = float(os.getenv("CHAT_RESPONSE_CACHE_REPLAY_MS", "20")) / 1000
+# Upstream deltas are coalesced into fewer writes, see CHAT_STREAM_FLUSH_BYTES / CHAT_STREAM_FLUSH_MS
+FLUSH_POLICY = flush_policy_from_env()
+MAX_SESSIONS = int(os.getenv("CHAT_MAX_SESSIONS", "100000"))
+MAX_UPSTREAM_CONNECTIONS = int(os.getenv("CHAT_MAX_UPSTREAM_CONNECTIONS", "5000"))
+SESSION_COOKIE = "chat_session"
+
+logger = get_logger("asgi")
+# The tokenizer loads on a background thread (from a local BPE cache if present), see startup.py
+enc = LazyEncoding(MODEL_NAME).start()
+token_counter = TokenCounter(enc)
+# system_context.txt is parsed and tokenized once, and again only when the file changes
+system_context = SystemContextProvider(token_counter.count)
+
+# The default httpx pool caps concurrent upstream connections at 1000, raise it to match the
+# number of streams we expect to hold open
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    # Retries are done with jitter by upstream_hedging, and rate limits by upstream_scheduler
+    max_retries=0,
+    http_client=openai.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=MAX_UPSTREAM_CONNECTIONS, max_keepalive_connections=100)
+    ),
+)
+
+
+async def open_upstream():
+    await client.models.list()
+
+
+# Tokenize the system context and open an upstream connection during lifespan startup, so
+# uvicorn only accepts requests once they are done
+warmup = Warmup(warmup_steps(enc, system_context, open_upstream))
+
+# History sent upstream is fitted into PROMPT_TOKEN_BUDGET, the system context is always kept. The
+# summary policy makes blocking upstream calls, so it gets a sync client and runs on a worker thread.
+compactor = make_compactor(COMPACTION_POLICY, PROMPT_TOKEN_BUDGET, token_counter.count,
+                           summarize=openai_summarizer(OpenAI(api_key=os.getenv("OPENAI_API_KEY")), MODEL_NAME))
+# Finished conversations are written by a background thread, see history_writer.py
+CHAT_HISTORY_DIR = os.getenv("CHAT_HISTORY_DIR", './server/chat_history')
+# Saved conversations are indexed as they are written, for listing, resume and export
+history_index = HistoryIndex(CHAT_HISTORY_DIR)
+history_writer = writer_from_env(CHAT_HISTORY_DIR, history_index)
+
+# Opt-in cache of completions for repeated prompts, None unless CHAT_RESPONSE_CACHE=1
+response_cache = cache_from_env()
+# Identical prompts that are in flight at the same time share one upstream stream
+stream_coalescer = AsyncStreamCoalescer()
+# Upstream calls wait for requests/tokens-per-minute budget instead of failing on rate limits
+upstream_scheduler = scheduler_from_env()
+# Deadlines, hedging and jittered retries for every upstream stream
+upstream_hedger = hedger_from_env()
+# Chat requests in progress, shared fairly between users. Off unless CHAT_MAX_CONCURRENT is set:
+# a stream holds its slot for the whole answer, and this server is meant to hold thousands of them.
+admission = admission_from_env(default_max_concurrent=0)
+# Stats kept by the components above, read when /metrics is scraped
+metrics.register_stats('admission', admission.stats, exclude=('queued_by_user',))
+metrics.register_stats('scheduler', upstream_scheduler.stats)
+metrics.register_stats('hedging', upstream_hedger.stats)
+metrics.register_stats('history', history_writer.stats)
+if response_cache:
+    metrics.register_stats('cache', response_cache.stats)
+
+# Session id -> {"conversation": CompactConversation, "conversation_id": ..., "user_name": ...}. In memory by
+# default, CHAT_SESSION_BACKEND=redis or filesystem shares sessions between workers and hosts, in
+# the binary format of compact_conversation.py.
+session_store = session_store_from_env(MAX_SESSIONS, SessionCodec(system_context, token_counter.count))
+
+
+def load_system_context():
+    # A session's own message list, starting from the shared parsed system context
+    return system_context.get().session_messages()
+
+
+async def get_session(session_id):
+    # Shared stores do I/O, keep it off the event loop
+    with stage('session_load'):
+        if session_store.blocking:
+            chat_session = await asyncio.to_thread(session_store.load, session_id)
+        else:
+            chat_session = session_store.load(session_id)
+    if chat_session is None:
+        chat_session = new_session()
+    # Sessions saved before conversations had ids
+    chat_session.setdefault('conversation_id', uuid.uuid4().hex)
+    return chat_session
+
+
+def new_session(user_name="unknown_user"):
+    # Starts from a reference to the shared system context, not a copy of it
+    return {"conversation": CompactConversation(system_context.get()), "conversation_id": uuid.uuid4().hex,
+            "user_name": user_name}
+
+
+def conversation_state(chat_session):
+    # Delta sync state of the session's conversation, see chat_sync.py
+    return {"conversation_id": chat_session['conversation_id'], "seq": chat_session['conversation'].seq}
+
+
+async def save_session(session_id, chat_session):
+    with stage('session_save'):
+        if session_store.blocking:
+            await asyncio.to_thread(session_store.save, session_id, chat_session)
+        else:
+            session_store.save(session_id, chat_session)
+
+
+def get_header(scope, header_name):
+    for name, value in scope['headers']:
+        if name == header_name:
+            return value.decode('latin-1')
+    return None
+
+
+def get_session_id(scope):
+    cookie_header = get_header(scope, b'cookie')
+    if cookie_header:
+        cookie = SimpleCookie(cookie_header)
+        if SESSION_COOKIE in cookie and VALID_SESSION_ID.match(cookie[SESSION_COOKIE].value):
+            return cookie[SESSION_COOKIE].value
+    return None
+
+
+def get_query(scope):
+    return dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+
+
+def body_message(text):
+    return {'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True}
+
+
+async def read_body(receive):
+    # The whole request body, or None if the client disconnected first
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def read_json(receive):
+    # The request body as a JSON object, {} when it is empty and None if the client disconnected
+    # first. ValueError if it is not a JSON object.
+    body = await read_body(receive)
+    if body is None:
+        return None
+    try:
+        request_json = json.loads(body) if body else {}
+    except ValueError:
+        raise ValueError("Invalid JSON body.")
+    if not isinstance(request_json, dict):
+        raise ValueError("The body must be a JSON object.")
+    return request_json
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())] + list(headers),
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def chat_endpoint(scope, receive, send, session_id, cookie_headers):
+    try:
+        request_json = await read_json(receive)
+    except ValueError as e:
+        await send_json(send, {"error": str(e)}, status=400, headers=cookie_headers)
+        return
+    if request_json is None:
+        return
+    if not isinstance(request_json.get('input'), str):
+        await send_json(send, {"error": "input must be a string."}, status=400, headers=cookie_headers)
+        return
+    # Kept in the session, which is written in the binary format of compact_conversation.py
+    user_name = request_json.get('user_name')
+    if user_name is not None and not isinstance(user_name, str):
+        await send_json(send, {"error": "user_name must be a string."}, status=400, headers=cookie_headers)
+        return
+    chat_session = await get_session(session_id)
+    chat_session['user_name'] = user_name or 'unknown_user'
+
+    # Wait for a slot, or shed the request when the server is overloaded. Users are served in
+    # proportion to their prompt sizes, so long histories cost more of a user's share.
+    cost = min(chat_session['conversation'].total_tokens + token_counter.count(request_json.get('input')), MAX_ALLOWED_TOKENS)
+    try:
+        with stage('admission_wait'):
+            ticket = await admission.acquire_async(chat_session['user_name'], cost)
+    except Overloaded as e:
+        headers = [(name.lower().encode(), value.encode()) for name, value in e.headers().items()]
+        await send_json(send, {"error": str(e)}, status=e.status, headers=cookie_headers + headers)
+        return
+    try:
+        await answer_chat(scope, receive, send, session_id, cookie_headers, request_json, chat_session)
+    finally:
+        admission.release(ticket)
+
+
+async def answer_chat(scope, receive, send, session_id, cookie_headers, request_json, chat_session):
+    user_input = request_json.get('input')
+
+    conversation = chat_session['conversation']
+    with stage('tokenize'):
+        conversation.append("user", user_input, token_counter.count(user_input))
+    await save_session(session_id, chat_session)
+    # The message list the compactor and the API take, built from the compact conversation
+    messages, token_counts = conversation.to_messages(), conversation.token_counts()
+    with stage('compaction'):
+        if compactor.policy.blocking:
+            compacted = await asyncio.to_thread(compactor.compact, messages, token_counts)
+        else:
+            compacted = compactor.compact(messages, token_counts)
+    if compacted.saved_tokens:
+        logger.info("Context compaction saved %d prompt tokens this turn.", compacted.saved_tokens, extra=event('compaction'))
+    max_response_tokens = MAX_ALLOWED_TOKENS - compacted.prompt_tokens - BOT_RESPONSE_BUFFER
+    params = dict(SAMPLING_PARAMS, max_completion_tokens=max_response_tokens)
+    key = cache_key(MODEL_NAME, params, compacted.messages)
+    # Budgeted as the prompt plus the longest answer allowed, corrected with the real usage
+    estimated_tokens = compacted.prompt_tokens + max_response_tokens
+
+    # NDJSON by default, Server-Sent Events when the client sends Accept: text/event-stream
+    framer = make_framer(get_header(scope, b'accept'))
+    coalescer = DeltaCoalescer(FLUSH_POLICY)
+
+    # The user message is acknowledged up front, the final frame acknowledges the answer
+    conversation_id = chat_session['conversation_id']
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', framer.content_type.encode('latin-1')),
+                    (b'x-conversation-id', conversation_id.encode('latin-1')),
+                    (b'x-conversation-seq', str(conversation.seq).encode())] + cookie_headers,
+    })
+
+    def drain():
+        # Frame whatever deltas are still waiting to be flushed
+        text = coalescer.flush()
+        return framer.delta(text) if text else ""
+
+    async def relay():
+        temp_response = ""
+        try:
+            cached_response = response_cache.get(key) if response_cache else None
+            if cached_response is not None:
+                # Replay the cached answer with the same framing as a live stream
+                for chunk_content in replay_chunks(cached_response):
+                    await send(body_message(framer.delta(chunk_content)))
+                    await asyncio.sleep(CACHE_REPLAY_DELAY)
+                conversation.append("assistant", cached_response, token_counter.count(cached_response))
+                await save_session(session_id, chat_session)
+                await send(body_message(framer.end(conversation_state(chat_session))))
+                await send({'type': 'http.response.body', 'body': b''})
+                return
+
+            async def open_stream(admitted):
+                # The hedger's deadlines start when the scheduler admits the call
+                return await upstream_scheduler.call_async(lambda: client.chat.completions.with_raw_response.create(
+                    model=MODEL_NAME,
+                    messages=compacted.messages,
+                    stream=True,
+                    # The last chunk reports the usage, which settles the token budget
+                    stream_options={"include_usage": True},
+                    timeout=upstream_hedger.timeout(),
+                    **params
+                ), estimated_tokens, admitted)
+
+            async def start_upstream():
+                # Bounded by the first-token and idle deadlines, and hedged when slow to start.
+                # Closing this generator closes the stream, which cancels the generation.
+                first_token_at = None
+                async for chunk in upstream_hedger.stream_async(open_stream):
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    if chunk.usage:
+                        upstream_scheduler.settle(estimated_tokens, chunk.usage.total_tokens)
+                        metrics.record_usage(chunk.usage, first_token_at)
+                    if chunk.choices:
+                        yield chunk.choices[0].delta.content, chunk.choices[0].finish_reason
+
+            # The upstream stream is shared with any identical request already in flight, and is
+            # cancelled once every client reading it has gone away. Chunks go through a small
+            # queue so pending deltas can be flushed on a timer while no new chunk arrives.
+            queue = asyncio.Queue(maxsize=64)
+
+            async def pump():
+                try:
+                    async for item in stream_coalescer.subscribe(key, start_upstream):
+                        await queue.put(item)
+                    await queue.put(None)
+                except Exception as e:
+                    await queue.put(e)
+
+            pump_task = asyncio.create_task(pump())
+            upstream_started = time.perf_counter()
+            first_chunk_at = None
+            try:
+                while True:
+                    try:
+                        item = await asyncio.wait_for(queue.get(), coalescer.time_until_due())
+                    except asyncio.TimeoutError:
+                        await send(body_message(drain()))
+                        continue
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    if first_chunk_at is None:
+                        first_chunk_at = time.perf_counter()
+                        metrics.STAGE_SECONDS.observe(first_chunk_at - upstream_started, 'first_token')
+
+                    chunk_content, finish_reason = item
+                    if chunk_content:
+                        temp_response += chunk_content
+                        text = coalescer.add(chunk_content)
+                        if text:
+                            # send() only returns once the server has room for more data, so a
+                            # slow client does not pile up writes
+                            await send(body_message(framer.delta(text)))
+                    if finish_reason == 'stop':
+                        conversation.append("assistant", temp_response, token_counter.count(temp_response))
+                        await save_session(session_id, chat_session)
+                        if response_cache:
+                            response_cache.put(key, temp_response)
+            finally:
+                pump_task.cancel()
+            if first_chunk_at is not None:
+                metrics.STAGE_SECONDS.observe(time.perf_counter() - first_chunk_at, 'streaming')
+            await send(body_message(drain() + framer.end(conversation_state(chat_session))))
+        except UpstreamBusy as e:
+            logger.warning("Request rejected: %s", e)
+            await send(body_message(drain() + framer.error(str(e))))
+        except UpstreamTimeout as e:
+            logger.warning("Upstream call timed out: %s", e)
+            await send(body_message(drain() + framer.error(str(e))))
+        except openai.OpenAIError as e:
+            error_message = f"An OpenAI error occurred: {e}"
+            logger.error(error_message)
+            await send(body_message(drain() + framer.error(error_message)))
+        except Exception as e:
+            error_message = f"An error occurred: {e}"
+            logger.exception(error_message)
+            await send(body_message(drain() + framer.error(error_message)))
+        await send({'type': 'http.response.body', 'body': b''})
+
+    relay_task = asyncio.create_task(relay())
+    disconnect_task = asyncio.create_task(wait_for_disconnect(receive))
+    metrics.ACTIVE_STREAMS.inc()
+    try:
+        done, _ = await asyncio.wait({relay_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+        if relay_task in done:
+            disconnect_task.cancel()
+            relay_task.result()
+        else:
+            # The client went away, stop generating tokens nobody will read
+            relay_task.cancel()
+            try:
+                await relay_task
+            except (asyncio.CancelledError, OSError):
+                pass
+    finally:
+        metrics.ACTIVE_STREAMS.dec()
+
+
+async def end_chat(scope, receive, send, session_id, cookie_headers):
+    body = await read_body(receive)
+    if body is None:
+        return
+    chat_session = await get_session(session_id)
+    user_name = chat_session['user_name']
+    conversation_id = chat_session['conversation_id']
+    try:
+        # gzip-encoded bodies are accepted
+        end_request = parse_end_request(decode_body(body, get_header(scope, b'content-encoding')))
+        if end_request.legacy:
+            # Whole conversation uploaded by an older client, saved after the current system context
+            context = system_context.get()
+            saved_conversation = context.session_messages() + end_request.messages
+            total_tokens = context.total_tokens + token_counter.count_messages(end_request.messages)
+        else:
+            # The session holds the conversation, only the messages it is missing are applied
+            conversation = chat_session['conversation']
+            missing = missing_messages(conversation_id, conversation.dialogue(), end_request)
+            saved_conversation = conversation.to_messages() + missing
+            total_tokens = conversation.total_tokens + token_counter.count_messages(missing)
+    except SyncError as e:
+        await send_json(send, e.payload(), status=e.status, headers=cookie_headers)
+        return
+
+    try:
+        # Never block the event loop on the history queue, shed the request if the writer is behind.
+        # Legacy uploads may end the same session more than once, each is saved on its own.
+        with stage('history_persist'):
+            history_writer.submit(user_name, saved_conversation, block=False,
+                                  conversation_id=None if end_request.legacy else conversation_id,
+                                  total_tokens=total_tokens)
+        logger.info("Chat history queued for %s", user_name)
+        response = {"message": "Conversation saved."}
+        if not end_request.legacy:
+            response.update(sync_state(conversation_id, saved_conversation))
+            # The conversation is finalized, the next request starts a new one
+            await save_session(session_id, new_session(user_name))
+        await send_json(send, response, headers=cookie_headers)
+    except queue.Full:
+        logger.error("Chat history queue is full, conversation for %s not saved", user_name)
+        await send_json(send, {"error": "Error saving conversation."}, status=503,
+                        headers=cookie_headers + [(b'retry-after', b'1')])
+
+
+async def answer_batch_item(item, user_name):
+    # One conversation of a batch, answered like a chat turn but not streamed and kept out of the
+    # session
+    context = system_context.get()
+    messages = context.session_messages() + item.messages
+    with stage('tokenize'):
+        token_counts = context.session_token_counts() + [token_counter.count(message['content']) for message in item.messages]
+    with stage('admission_wait'):
+        ticket = await admission.acquire_async(user_name, min(sum(token_counts), MAX_ALLOWED_TOKENS))
+    try:
+        with stage('compaction'):
+            if compactor.policy.blocking:
+                compacted = await asyncio.to_thread(compactor.compact, messages, token_counts)
+            else:
+                compacted = compactor.compact(messages, token_counts)
+        max_response_tokens = MAX_ALLOWED_TOKENS - compacted.prompt_tokens - BOT_RESPONSE_BUFFER
+        params = dict(SAMPLING_PARAMS, max_completion_tokens=max_response_tokens)
+        key = cache_key(MODEL_NAME, params, compacted.messages)
+        cached_response = response_cache.get(key) if response_cache else None
+        if cached_response is not None:
+            return item_result(item, cached_response, 'stop')
+        # Budgeted as the prompt plus the longest answer allowed, corrected with the real usage
+        estimated_tokens = compacted.prompt_tokens + max_response_tokens
+        with stage('upstream'):
+            response = await upstream_hedger.call_async(lambda: upstream_scheduler.call_async(
+                lambda: client.chat.completions.with_raw_response.create(
+                    model=MODEL_NAME,
+                    messages=compacted.messages,
+                    timeout=upstream_hedger.timeout(),
+                    **params
+                ), estimated_tokens))
+        if response.usage:
+            upstream_scheduler.settle(estimated_tokens, response.usage.total_tokens)
+            metrics.record_usage(response.usage)
+        choice = response.choices[0]
+        if response_cache and choice.finish_reason == 'stop':
+            response_cache.put(key, choice.message.content)
+        return item_result(item, choice.message.content, choice.finish_reason, response.usage)
+    finally:
+        admission.release(ticket)
+
+
+async def batch_chat(scope, receive, send, session_id, cookie_headers):
+    # Many independent prompts in one request, answered with bounded concurrency and streamed
+    # back as NDJSON in completion order, see batch_chat.py
+    body = await read_body(receive)
+    if body is None:
+        return
+    try:
+        request_json = json.loads(body) if body else None
+        items, concurrency = parse_batch(request_json)
+    except ValueError as e:
+        await send_json(send, {"error": str(e)}, status=400, headers=cookie_headers)
+        return
+    user_name = request_json.get('user_name', 'unknown_user')
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', BATCH_CONTENT_TYPE.encode('latin-1'))] + cookie_headers,
+    })
+
+    async def relay():
+        errors = 0
+        results = run_batch_async(items, lambda item: answer_batch_item(item, user_name), concurrency)
+        try:
+            async for result in results:
+                errors += 'error' in result
+                await send(body_message(result_line(result)))
+        finally:
+            await results.aclose()
+        await send(body_message(summary_line(len(items), errors)))
+        await send({'type': 'http.response.body', 'body': b''})
+
+    relay_task = asyncio.create_task(relay())
+    disconnect_task = asyncio.create_task(wait_for_disconnect(receive))
+    done, _ = await asyncio.wait({relay_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+    if relay_task in done:
+        disconnect_task.cancel()
+        relay_task.result()
+    else:
+        # The client went away, cancel the items in progress and drop the rest
+        relay_task.cancel()
+        try:
+            await relay_task
+        except (asyncio.CancelledError, OSError):
+            pass
+
+
+async def cache_stats(scope, receive, send, session_id, cookie_headers):
+    if response_cache is None:
+        await send_json(send, {"enabled": False}, headers=cookie_headers)
+        return
+    await send_json(send, dict(response_cache.stats(), enabled=True), headers=cookie_headers)
+
+
+async def list_history(scope, receive, send, session_id, cookie_headers):
+    # Saved conversations, newest first, filtered by user_name, since/until and min/max_tokens
+    if not HISTORY_API_ENABLED:
+        await send_json(send, {"error": "Not found."}, status=404, headers=cookie_headers)
+        return
+    query = get_query(scope)
+    try:
+        filters = filters_from_query(query)
+        limit = int(query.get('limit', 50))
+    except ValueError:
+        await send_json(send, {"error": "Token filters and limit must be integers."}, status=400, headers=cookie_headers)
+        return
+    # SQLite calls run on a worker thread so they never stall the streams on the loop
+    conversations = await asyncio.to_thread(history_index.list, limit=limit, **filters)
+    await send_json(send, {"conversations": conversations}, headers=cookie_headers)
+
+
+async def resume_history(scope, receive, send, session_id, cookie_headers):
+    # Load a saved conversation into this session so the chat continues where it ended
+    if not HISTORY_API_ENABLED:
+        await send_json(send, {"error": "Not found."}, status=404, headers=cookie_headers)
+        return
+    try:
+        request_json = await read_json(receive)
+        if request_json is None:
+            return
+        conversation_id = resume_conversation_id(request_json)
+    except ValueError as e:
+        await send_json(send, {"error": str(e)}, status=400, headers=cookie_headers)
+        return
+    record = await asyncio.to_thread(history_index.load, conversation_id)
+    if record is None:
+        await send_json(send, {"error": "Conversation not found."}, status=404, headers=cookie_headers)
+        return
+    chat_session = await get_session(session_id)
+    # Shares the current system context if the saved conversation started with it
+    try:
+        chat_session['conversation'] = CompactConversation.from_messages(system_context.get(), record['messages'],
+                                                                         token_counter.count)
+    except ValueError as e:
+        # Whole-conversation uploads are saved as sent, with roles a live conversation can't hold
+        await send_json(send, {"error": f"The conversation can't be resumed: {e}"}, status=400, headers=cookie_headers)
+        return
+    # The resumed chat is saved as a new conversation when it ends
+    chat_session['conversation_id'] = uuid.uuid4().hex
+    await save_session(session_id, chat_session)
+    await send_json(send, {"conversation_id": record['conversation_id'], "messages": record['messages']},
+                    headers=cookie_headers)
+
+
+async def export_history(scope, receive, send, session_id, cookie_headers):
+    # Matching conversations as streamed NDJSON, gzip-encoded when the client accepts it
+    if not HISTORY_API_ENABLED:
+        await send_json(send, {"error": "Not found."}, status=404, headers=cookie_headers)
+        return
+    try:
+        filters = filters_from_query(get_query(scope))
+    except ValueError:
+        await send_json(send, {"error": "Token filters must be integers."}, status=400, headers=cookie_headers)
+        return
+    compress = accepts_gzip(get_header(scope, b'accept-encoding'))
+    headers = [(b'content-type', b'application/x-ndjson')] + cookie_headers
+    if compress:
+        headers.append((b'content-encoding', b'gzip'))
+    await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+    chunks = export_chunks(history_index.export(**filters), compress)
+    try:
+        while True:
+            # Reading and decompressing segments happens off the loop, one chunk at a time
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+    finally:
+        await asyncio.to_thread(chunks.close)
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def ready(scope, receive, send, session_id, cookie_headers):
+    # Readiness probe, 503 until the startup warmup has finished
+    await send_json(send, warmup.status(), status=200 if warmup.is_ready() else 503, headers=cookie_headers)
+
+
+async def upstream_stats(scope, receive, send, session_id, cookie_headers):
+    await send_json(send, dict(upstream_scheduler.stats(), hedging=upstream_hedger.stats()), headers=cookie_headers)
+
+
+async def admission_stats(scope, receive, send, session_id, cookie_headers):
+    await send_json(send, admission.stats(), headers=cookie_headers)
+
+
+async def prometheus_metrics(scope, receive, send, session_id, cookie_headers):
+    body = metrics.render().encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', metrics.CONTENT_TYPE.encode('latin-1'))],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def profiler_status(scope, receive, send, session_id, cookie_headers):
+    # Collapsed stacks of the sampling profiler, only when the server runs with CHAT_PROFILER=1
+    if not PROFILER_ENABLED:
+        await send_json(send, {"error": "Not found."}, status=404)
+        return
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/plain'), (b'x-profiler-samples', str(profiler.samples).encode())],
+    })
+    await send({'type': 'http.response.body', 'body': profiler.collapsed().encode('utf-8')})
+
+
+async def profiler_configure(scope, receive, send, session_id, cookie_headers):
+    # Start or stop the sampling profiler at runtime
+    body = await read_body(receive)
+    if body is None:
+        return
+    if not PROFILER_ENABLED:
+        await send_json(send, {"error": "Not found."}, status=404)
+        return
+    # Stopping waits for the sampling thread, keep it off the event loop
+    try:
+        status = await asyncio.to_thread(profiler.configure, json.loads(body) if body else {})
+    except ValueError as e:
+        await send_json(send, {"error": str(e)}, status=400)
+        return
+    await send_json(send, status)
+
+
+async def memory_report(scope, receive, send, session_id, cookie_headers):
+    # tracemalloc report, only when the server runs with CHAT_TRACEMALLOC=1
+    if not TRACEMALLOC_ENABLED:
+        await send_json(send, {"error": "Not found."}, status=404)
+        return
+    try:
+        limit = int(get_query(scope).get('limit', DEFAULT_MEMORY_SITES))
+    except ValueError:
+        limit = DEFAULT_MEMORY_SITES
+    # Taking a snapshot walks every traced allocation, keep it off the event loop
+    await send_json(send, await asyncio.to_thread(memory_tracker.report, limit))
+
+
+async def memory_configure(scope, receive, send, session_id, cookie_headers):
+    # Take a new baseline snapshot or reset the traced peak
+    body = await read_body(receive)
+    if body is None:
+        return
+    if not TRACEMALLOC_ENABLED:
+        await send_json(send, {"error": "Not found."}, status=404)
+        return
+    try:
+        status = await asyncio.to_thread(memory_tracker.configure, json.loads(body) if body else {})
+    except ValueError as e:
+        await send_json(send, {"error": str(e)}, status=400)
+        return
+    await send_json(send, status)
+
+
+routes = {
+    ('POST', '/api/chat'): chat_endpoint,
+    ('GET', '/api/ready'): ready,
+    ('POST', '/api/chat/end'): end_chat,
+    ('POST', '/api/chat/batch'): batch_chat,
+    ('GET', '/api/cache/stats'): cache_stats,
+    ('GET', '/api/upstream/stats'): upstream_stats,
+    ('GET', '/api/admission/stats'): admission_stats,
+    ('GET', '/metrics'): prometheus_metrics,
+    ('GET', '/api/profiler'): profiler_status,
+    ('POST', '/api/profiler'): profiler_configure,
+    ('GET', '/api/memory'): memory_report,
+    ('POST', '/api/memory'): memory_configure,
+    ('GET', '/api/history'): list_history,
+    ('POST', '/api/history/resume'): resume_history,
+    ('GET', '/api/history/export'): export_history,
+}
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await warmup.run_async()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await client.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    handler = routes.get((scope['method'], scope['path']))
+    if handler is None:
+        await send_json(send, {"error": "Not found."}, status=404)
+        return
+
+    session_id = get_session_id(scope)
+    cookie_headers = []
+    if session_id is None:
+        session_id = secrets.token_urlsafe(24)
+        cookie_headers.append((b'set-cookie', f"{SESSION_COOKIE}={session_id}; HttpOnly; Path=/".encode('latin-1')))
+
+    # Count every response by route and status, and time it to the last byte
+    started = time.perf_counter()
+    status = []
+
+    async def send_and_record(message):
+        if message['type'] == 'http.response.start':
+            status.append(message['status'])
+        await send(message)
+
+    try:
+        await handler(scope, receive, send_and_record, session_id, cookie_headers)
+    finally:
+        metrics.REQUESTS.inc(1, handler.__name__, str(status[0]) if status else "none")
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, handler.__name__)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, port=5000)
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import openai
+from admission import Overloaded
+from chat_logging import event, get_logger
+from chat_sync import SyncError, validate_messages
+from upstream_hedging import UpstreamTimeout
+from upstream_scheduler import UpstreamBusy
+
+# Batch chat for /api/chat/batch: many independent conversations in one request, for offline
+# jobs that would otherwise send thousands of /api/chat requests one by one.
+#   {"user_name": "...", "concurrency": 4, "items": [{"id": "q1", "input": "..."},
+#                                                    {"messages": [{"role": "user", ...}, ...]}]}
+# An item is one prompt (input, or a plain string) or a conversation of user and assistant
+# messages ending with a user message. The server adds the system context. At most
+# CHAT_BATCH_CONCURRENCY items are answered at once, each admitted under the batch's user_name
+# like a chat request, so a batch gets the user's fair share of the slots and no more.
+#
+# The response is NDJSON, one line per item as soon as it is answered (completion order, not
+# input order), then a summary line:
+#   {"index": 2, "id": "q3", "response": "...", "finish_reason": "stop", "usage": {...}}
+#   {"index": 0, "id": "q1", "error": "Server busy, try again later", "status": 503, "retry_after": 1.5}
+#   {"done": true, "items": 3, "errors": 1}
+# A failed item does not fail the batch. Batches are not added to the session or saved to history.
+
+MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "1000"))
+MAX_CONCURRENCY = int(os.getenv("CHAT_BATCH_CONCURRENCY", "4"))
+CONTENT_TYPE = 'application/x-ndjson'
+
+logger = get_logger("batch")
+
+
+class BatchItem:
+    def __init__(self, index, messages, item_id=None):
+        self.index = index
+        self.messages = messages
+        self.item_id = item_id
+
+
+def parse_item(index, item):
+    if isinstance(item, str):
+        return BatchItem(index, [{"role": "user", "content": item}])
+    if not isinstance(item, dict):
+        raise ValueError(f"Item {index} must be a string or an object.")
+    if isinstance(item.get('input'), str):
+        messages = [{"role": "user", "content": item['input']}]
+    elif 'messages' in item:
+        try:
+            messages = validate_messages(item['messages'])
+        except SyncError as e:
+            raise ValueError(f"Item {index}: {e}")
+        if not messages or messages[-1]['role'] != 'user':
+            raise ValueError(f"Item {index}: the messages must end with a user message.")
+    else:
+        raise ValueError(f"Item {index} needs an input or messages.")
+    return BatchItem(index, messages, item.get('id'))
+
+
+def parse_batch(data):
+    # (items, concurrency) of a batch request, ValueError if it is malformed
+    if not isinstance(data, dict) or not isinstance(data.get('items'), list) or not data['items']:
+        raise ValueError("A batch needs a non-empty items array.")
+    if len(data['items']) > MAX_ITEMS:
+        raise ValueError(f"A batch may have at most {MAX_ITEMS} items.")
+    items = [parse_item(index, item) for index, item in enumerate(data['items'])]
+    concurrency = data.get('concurrency', MAX_CONCURRENCY)
+    if not isinstance(concurrency, int) or isinstance(concurrency, bool) or concurrency < 1:
+        raise ValueError("concurrency must be a positive integer.")
+    return items, min(concurrency, MAX_CONCURRENCY)
+
+
+def item_result(item, response, finish_reason=None, usage=None):
+    result = {"index": item.index}
+    if item.item_id is not None:
+        result["id"] = item.item_id
+    result["response"] = response
+    result["finish_reason"] = finish_reason
+    if usage is not None:
+        result["usage"] = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+    return result
+
+
+def item_error(item, error):
+    # A failed item, with the status /api/chat would have answered the same failure with
+    result = {"index": item.index}
+    if item.item_id is not None:
+        result["id"] = item.item_id
+    if isinstance(error, (Overloaded, UpstreamBusy)):
+        logger.warning("Batch item %d rejected: %s", item.index, error, extra=event('batch'))
+        status = error.status if isinstance(error, Overloaded) else 503
+        result.update(error=str(error), status=status, retry_after=round(error.retry_after, 3))
+    elif isinstance(error, UpstreamTimeout):
+        logger.warning("Batch item %d timed out: %s", item.index, error, extra=event('batch'))
+        result.update(error=str(error), status=504)
+    elif isinstance(error, openai.OpenAIError):
+        logger.error("OpenAI Error on batch item %d: %s.", item.index, error, extra=event('batch'))
+        result.update(error=f"An OpenAI error occurred: {error}", status=502)
+    else:
+        logger.error("Batch item %d failed: %s", item.index, error, exc_info=error, extra=event('batch'))
+        result.update(error=f"An error occurred: {error}", status=500)
+    return result
+
+
+def run_batch(items, answer, concurrency):
+    # Yield the result of answer(item) for every item as it completes, `concurrency` at a time on
+    # worker threads. Closing the generator (the client went away) drops the items not started yet.
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch')
+    try:
+        futures = {executor.submit(answer, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as e:
+                yield item_error(futures[future], e)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def run_batch_async(items, answer, concurrency):
+    # The same for a coroutine answer(item). Closing the generator cancels the items in progress.
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(item):
+        async with semaphore:
+            try:
+                return await answer(item)
+            except Exception as e:
+                return item_error(item, e)
+
+    tasks = [asyncio.create_task(limited(item)) for item in items]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def result_line(result):
+    return json.dumps(result) + "\n"
+
+
+def summary_line(items, errors):
+    return result_line({"done": True, "items": items, "errors": errors})
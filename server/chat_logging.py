@@ -0,0 +1,131 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+# Logging for the chat servers. Records are handed to a bounded queue and written by a
+# background thread, so a request never waits on stdout/stderr. High-volume events (per-chunk
+# logs, whole conversations) are sampled, and message bodies are truncated or redacted unless
+# CHAT_LOG_CONTENT=full.
+#
+# Configuration:
+#   CHAT_LOG_LEVEL     DEBUG, INFO, WARNING, ... (default INFO)
+#   CHAT_LOG_SAMPLE    per-event sample rates, e.g. "chunk=0.01,conversation=0.1" (default "chunk=0.01")
+#   CHAT_LOG_CONTENT   redact, truncate or full (default truncate)
+#   CHAT_LOG_ASYNC     0 to write from the request thread instead of the background thread
+#   CHAT_LOG_QUEUE     maximum queued records before new ones are dropped (default 10000)
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s [%(event)s] %(message)s"
+TRUNCATE_CHARS = 80
+
+_configured = False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Drops records instead of blocking when the writer thread falls behind
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class EventSampler(logging.Filter):
+    # Keeps a fraction of the records for each event name, records without an event are always kept
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if not hasattr(record, 'event'):
+            record.event = '-'
+        rate = self.rates.get(record.event, 1.0)
+        return rate >= 1.0 or (rate > 0 and random.random() < rate)
+
+
+def parse_sample_rates(spec):
+    rates = {}
+    for item in spec.split(','):
+        if '=' in item:
+            event, rate = item.split('=', 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+def configure_logging():
+    global _configured
+    if _configured:
+        return
+    _configured = True
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    sampler = EventSampler(parse_sample_rates(os.getenv("CHAT_LOG_SAMPLE", "chunk=0.01")))
+
+    root = logging.getLogger("chat")
+    root.setLevel(os.getenv("CHAT_LOG_LEVEL", "INFO").upper())
+    root.propagate = False
+
+    if os.getenv("CHAT_LOG_ASYNC", "1") == "0":
+        stream_handler.addFilter(sampler)
+        root.addHandler(stream_handler)
+        return
+
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=int(os.getenv("CHAT_LOG_QUEUE", "10000"))))
+    # Sample before enqueueing so dropped events never cost a queue slot
+    queue_handler.addFilter(sampler)
+    listener = logging.handlers.QueueListener(queue_handler.queue, stream_handler)
+    listener.start()
+    # Flush whatever is still queued when the process exits
+    atexit.register(listener.stop)
+    root.addHandler(queue_handler)
+
+
+def get_logger(name):
+    configure_logging()
+    return logging.getLogger(f"chat.{name}")
+
+
+def event(name):
+    # extra= argument that tags a record with its event name for sampling
+    return {"event": name}
+
+
+class LoggedText:
+    # Defers truncating/redacting a message body until the record is actually formatted
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        mode = os.getenv("CHAT_LOG_CONTENT", "truncate")
+        text = self.text or ""
+        if mode == 'full':
+            return text
+        if mode == 'redact':
+            return f"<{len(text)} chars>"
+        return text if len(text) <= TRUNCATE_CHARS else text[:TRUNCATE_CHARS] + f"... <{len(text)} chars>"
+
+
+class LoggedConversation:
+    # Defers rendering a conversation, only the message count and last message unless CHAT_LOG_CONTENT=full
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def __str__(self):
+        if os.getenv("CHAT_LOG_CONTENT", "truncate") == 'full':
+            return str(self.messages)
+        if not self.messages:
+            return "<0 messages>"
+        last = self.messages[-1]
+        return f"<{len(self.messages)} messages, last {last['role']}: {LoggedText(last['content'])}>"
@@ -0,0 +1,119 @@
+import json
+import os
+import zlib
+
+# Delta sync for /api/chat/end. Every conversation has an id, and the messages after the system
+# context are numbered 1, 2, 3, ... Chat responses tell the client the id and the sequence number
+# of the last message the server holds, so when the chat ends the client only sends what came
+# after it, usually nothing:
+#   {"conversation_id": "...", "base_seq": 6, "messages": [...]}  messages 7, 8, ... to apply
+#   {"conversation_id": "...", "base_seq": 8}                      finalize what the server has
+# Older clients upload the whole conversation, as a list or as {"conversation": [...]}, and may
+# gzip it with Content-Encoding: gzip.
+
+# Largest request body accepted, after decompression
+MAX_BODY_BYTES = int(os.getenv("CHAT_MAX_BODY_BYTES", str(8 * 1024 * 1024)))
+ROLES = ("user", "assistant")
+
+
+class SyncError(Exception):
+    # A request that can't be applied. 409s carry the server's sequence number so the client can
+    # resend from there.
+
+    def __init__(self, status, message, seq=None):
+        super().__init__(message)
+        self.status = status
+        self.seq = seq
+
+    def payload(self):
+        payload = {"error": str(self)}
+        if self.seq is not None:
+            payload["seq"] = self.seq
+        return payload
+
+
+class EndRequest:
+    def __init__(self, messages, conversation_id=None, base_seq=None):
+        self.messages = messages
+        self.conversation_id = conversation_id
+        self.base_seq = base_seq
+
+    @property
+    def legacy(self):
+        # A whole-conversation upload from a client that doesn't know about sequence numbers
+        return self.conversation_id is None
+
+
+def decode_body(body, content_encoding=None):
+    # Parse a JSON request body, gunzipping it first when it was sent with Content-Encoding: gzip
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "gzip":
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            # Stop at the size limit instead of inflating a gzip bomb
+            body = decompressor.decompress(body, MAX_BODY_BYTES + 1)
+        except zlib.error:
+            raise SyncError(400, "Invalid gzip body.")
+        if not decompressor.eof:
+            raise SyncError(413 if len(body) > MAX_BODY_BYTES else 400, "Request body too large or truncated.")
+    elif encoding != "identity":
+        raise SyncError(415, f"Unsupported Content-Encoding: {encoding}.")
+    if len(body) > MAX_BODY_BYTES:
+        raise SyncError(413, "Request body too large.")
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        raise SyncError(400, "Invalid JSON body.")
+
+
+def dialogue(messages):
+    # The numbered messages, everything but the system context
+    return [message for message in messages if message['role'] != 'system']
+
+
+def dialogue_seq(messages):
+    return sum(1 for message in messages if message['role'] != 'system')
+
+
+def sync_state(conversation_id, messages):
+    return {"conversation_id": conversation_id, "seq": dialogue_seq(messages)}
+
+
+def validate_messages(messages):
+    if not isinstance(messages, list):
+        raise SyncError(400, "messages must be an array.")
+    validated = []
+    for message in messages:
+        if not isinstance(message, dict) or message.get('role') not in ROLES \
+                or not isinstance(message.get('content'), str):
+            raise SyncError(400, "Each message needs a user or assistant role and a string content.")
+        validated.append({"role": message['role'], "content": message['content']})
+    return validated
+
+
+def parse_end_request(data):
+    if isinstance(data, list):
+        return EndRequest(data)
+    if not isinstance(data, dict):
+        raise SyncError(400, "Conversation data must be an array or an object.")
+    if 'conversation_id' not in data:
+        return EndRequest(data.get('conversation') or [])
+    base_seq = data.get('base_seq')
+    if not isinstance(base_seq, int) or isinstance(base_seq, bool) or base_seq < 0:
+        raise SyncError(400, "base_seq must be a non-negative integer.")
+    return EndRequest(validate_messages(data.get('messages', [])), str(data['conversation_id']), base_seq)
+
+
+def missing_messages(conversation_id, messages, end_request):
+    # The messages of a delta request that the server does not have yet. `messages` is the
+    # server's copy of the conversation. Messages the client resends are checked against it.
+    if end_request.conversation_id != conversation_id:
+        raise SyncError(409, "Unknown conversation_id, the conversation has ended or belongs to another session.")
+    held = dialogue(messages)
+    seq = len(held)
+    if end_request.base_seq > seq:
+        raise SyncError(409, f"The server only holds {seq} messages.", seq)
+    overlap = min(seq - end_request.base_seq, len(end_request.messages))
+    if held[end_request.base_seq:end_request.base_seq + overlap] != end_request.messages[:overlap]:
+        raise SyncError(409, "The messages conflict with the server's copy.", seq)
+    return end_request.messages[overlap:]
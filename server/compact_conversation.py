@@ -0,0 +1,215 @@
+import json
+import struct
+import sys
+import uuid
+from chat_logging import get_logger
+from system_context import SystemContext
+
+# Compact form of a live conversation, for servers that hold many sessions in memory (the async
+# server keeps up to CHAT_MAX_SESSIONS). A session used to hold a list of message dicts that
+# started with its own copy of the system context, plus a parallel list of token counts.
+# CompactConversation holds instead:
+#   - a reference to the shared, immutable SystemContext it started from
+#   - one MessageRecord per user/assistant message, with __slots__ instead of a dict, its role
+#     one of the interned ROLES strings and its token count inline
+#   - the running token total
+# to_messages() and token_counts() build the exact lists that the compactor and
+# client.chat.completions.create take.
+#
+# SessionCodec serializes sessions for the file and Redis session stores in a binary format. The
+# system context is written as its digest and shared again on load; only a context that did not
+# come from system_context.txt (a resumed conversation's) is written out in full:
+#   magic, conversation id, user name, system digest (empty: inline messages follow), each a
+#   32-bit length and UTF-8 text
+#   messages: count, then per message a role code, token count and UTF-8 content length, content
+# Sessions written by the first version of the format (CS1, 16-bit string lengths) are still read.
+
+ROLES = tuple(sys.intern(role) for role in ("system", "user", "assistant"))
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+MAGIC = b'CS2'
+MAGIC_V1 = b'CS1'
+_COUNT = struct.Struct('<I')
+_RECORD = struct.Struct('<BII')
+_STRING = struct.Struct('<I')
+_STRING_V1 = struct.Struct('<H')
+
+logger = get_logger("session")
+
+
+def intern_role(role):
+    # The interned copy of a role, so every message shares one string per role
+    try:
+        return ROLES[ROLE_CODES[role]]
+    except KeyError:
+        raise ValueError(f"Unsupported message role: {role!r}")
+
+
+class MessageRecord:
+    __slots__ = ('role', 'content', 'tokens')
+
+    def __init__(self, role, content, tokens):
+        self.role = intern_role(role)
+        self.content = content
+        self.tokens = tokens
+
+    def as_dict(self):
+        return {"role": self.role, "content": self.content}
+
+
+class CompactConversation:
+    __slots__ = ('system', 'records', 'total_tokens')
+
+    def __init__(self, system, records=()):
+        self.system = system
+        self.records = list(records)
+        self.total_tokens = system.total_tokens + sum(record.tokens for record in self.records)
+
+    @classmethod
+    def from_messages(cls, context, messages, count_tokens, token_counts=()):
+        # A conversation from a message list that starts with a system prefix (a saved record, an
+        # older session). The prefix is shared with `context` when it is the same, token counts
+        # missing from `token_counts` are counted. ValueError if a message has an unsupported
+        # role or no string content.
+        for message in messages:
+            if not isinstance(message, dict) or not isinstance(message.get('content'), str):
+                raise ValueError("Each message needs a role and a string content.")
+            intern_role(message.get('role'))
+        counts = list(token_counts)[:len(messages)]
+        counts += [count_tokens(message['content']) for message in messages[len(counts):]]
+        prefix_length = 0
+        while prefix_length < len(messages) and messages[prefix_length]['role'] == 'system':
+            prefix_length += 1
+        prefix = messages[:prefix_length]
+        if prefix == list(context.messages):
+            system = context
+        else:
+            system = SystemContext(prefix, counts[:prefix_length], None)
+        return cls(system, (MessageRecord(message['role'], message['content'], tokens)
+                            for message, tokens in zip(messages[prefix_length:], counts[prefix_length:])))
+
+    @property
+    def seq(self):
+        # Sequence number of the last message, the system context is not numbered
+        return len(self.records)
+
+    def append(self, role, content, tokens):
+        self.records.append(MessageRecord(role, content, tokens))
+        self.total_tokens += tokens
+
+    def dialogue(self):
+        return [record.as_dict() for record in self.records]
+
+    def to_messages(self):
+        # The system context's own message dicts, then the dialogue
+        return list(self.system.messages) + self.dialogue()
+
+    def token_counts(self):
+        return list(self.system.token_counts) + [record.tokens for record in self.records]
+
+
+def _pack_string(parts, text):
+    data = text.encode('utf-8')
+    parts.append(_STRING.pack(len(data)))
+    parts.append(data)
+
+
+def _pack_messages(parts, messages):
+    # (role, content, tokens) triples
+    parts.append(_COUNT.pack(len(messages)))
+    for role, content, tokens in messages:
+        data = content.encode('utf-8')
+        parts.append(_RECORD.pack(ROLE_CODES[role], tokens, len(data)))
+        parts.append(data)
+
+
+class _Reader:
+    def __init__(self, data, string_layout=_STRING):
+        self.data = memoryview(data)
+        self.offset = len(MAGIC)
+        self.string_layout = string_layout
+
+    def unpack(self, layout):
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
+
+    def text(self, length):
+        text = str(self.data[self.offset:self.offset + length], 'utf-8')
+        self.offset += length
+        return text
+
+    def string(self):
+        length, = self.unpack(self.string_layout)
+        return self.text(length)
+
+    def messages(self):
+        # (role, content, tokens) triples, decoded straight from the buffer
+        count, = self.unpack(_COUNT)
+        data, offset, unpack_record, record_size = self.data, self.offset, _RECORD.unpack_from, _RECORD.size
+        messages = []
+        for _ in range(count):
+            code, tokens, length = unpack_record(data, offset)
+            offset += record_size
+            messages.append((ROLES[code], str(data[offset:offset + length], 'utf-8'), tokens))
+            offset += length
+        self.offset = offset
+        return messages
+
+
+class SessionCodec:
+    # Sessions of the async server, {"conversation": CompactConversation, "conversation_id": ...,
+    # "user_name": ...}, to and from bytes
+
+    def __init__(self, system_context, count_tokens):
+        self.system_context = system_context
+        # Counts the messages of older JSON sessions that have no stored count
+        self.count_tokens = count_tokens
+
+    def dumps(self, chat_session):
+        conversation = chat_session['conversation']
+        system = conversation.system
+        parts = [MAGIC]
+        _pack_string(parts, chat_session['conversation_id'])
+        _pack_string(parts, chat_session.get('user_name') or "")
+        _pack_string(parts, system.digest or "")
+        if not system.digest:
+            _pack_messages(parts, [(message['role'], message['content'], tokens)
+                                   for message, tokens in zip(system.messages, system.token_counts)])
+        _pack_messages(parts, [(record.role, record.content, record.tokens) for record in conversation.records])
+        return b''.join(parts)
+
+    def loads(self, data):
+        if data.startswith(MAGIC):
+            reader = _Reader(data)
+        elif data.startswith(MAGIC_V1):
+            reader = _Reader(data, _STRING_V1)
+        else:
+            return self._loads_json(data)
+        conversation_id = reader.string()
+        user_name = reader.string() or 'unknown_user'
+        digest = reader.string()
+        if digest:
+            system = self.system_context.version(digest)
+            if system is None:
+                # Saved before system_context.txt changed more than a few times, or by a worker
+                # that read another version of it. Continue with the current one.
+                logger.warning("System context %s of session %s is not loaded, using the current one",
+                               digest, conversation_id)
+                system = self.system_context.get()
+        else:
+            prefix = reader.messages()
+            system = SystemContext([{"role": role, "content": content} for role, content, _ in prefix],
+                                   [tokens for _, _, tokens in prefix], None)
+        records = [MessageRecord(role, content, tokens) for role, content, tokens in reader.messages()]
+        return {"conversation": CompactConversation(system, records), "conversation_id": conversation_id,
+                "user_name": user_name}
+
+    def _loads_json(self, data):
+        # A session saved as JSON before sessions were compact, with the whole message list
+        chat_session = json.loads(data)
+        conversation = CompactConversation.from_messages(
+            self.system_context.get(), chat_session['conversation'],
+            self.count_tokens, chat_session.get('token_counts', ()))
+        return {"conversation": conversation,
+                "conversation_id": chat_session.get('conversation_id') or uuid.uuid4().hex,
+                "user_name": chat_session.get('user_name', 'unknown_user')}
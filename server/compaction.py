@@ -0,0 +1,189 @@
+import hashlib
+import json
+from collections import OrderedDict
+from threading import Lock
+from chat_logging import get_logger
+
+logger = get_logger("compaction")
+
+# Prompt used by the summary checkpoint policy to fold old turns into one message
+SUMMARY_PROMPT = ("Summarize the conversation so far in a few sentences. Keep names, facts, decisions "
+                  "and open questions the assistant will need to continue the conversation.")
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+
+class CompactionResult:
+    # The messages to send upstream and how many prompt tokens compaction saved
+
+    def __init__(self, messages, prompt_tokens, saved_tokens):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.saved_tokens = saved_tokens
+
+
+def split_turns(messages, token_counts):
+    # Group messages into turns, each starting at a user message, as (messages, tokens) pairs
+    turns = []
+    for message, tokens in zip(messages, token_counts):
+        if message['role'] == 'user' or not turns:
+            turns.append(([], 0))
+        turn_messages, turn_tokens = turns[-1]
+        turn_messages.append(message)
+        turns[-1] = (turn_messages, turn_tokens + tokens)
+    return turns
+
+
+def join_turns(turns):
+    return [message for turn_messages, _ in turns for message in turn_messages]
+
+
+def drop_oldest_turns(turns, budget):
+    # Drop whole turns from the front until the rest fits, always keeping the latest turn
+    total = sum(turn_tokens for _, turn_tokens in turns)
+    start = 0
+    while start < len(turns) - 1 and total > budget:
+        total -= turns[start][1]
+        start += 1
+    return turns[start:], total
+
+
+class DropOldestPolicy:
+    # Sends as much recent history as fits the budget, dropping the oldest turns first
+    blocking = False
+
+    def fit(self, messages, token_counts, budget, count_tokens):
+        turns, total = drop_oldest_turns(split_turns(messages, token_counts), budget)
+        return join_turns(turns), total
+
+
+class SlidingWindowPolicy:
+    # Sends at most the last `window_turns` turns, then drops older ones if that is still over budget
+    blocking = False
+
+    def __init__(self, window_turns=10):
+        self.window_turns = window_turns
+
+    def fit(self, messages, token_counts, budget, count_tokens):
+        turns = split_turns(messages, token_counts)[-self.window_turns:]
+        turns, total = drop_oldest_turns(turns, budget)
+        return join_turns(turns), total
+
+
+class SummaryCheckpointPolicy:
+    # Replaces the oldest turns with a summary message once the history no longer fits. The
+    # summarized span only moves forward in steps of `checkpoint_turns`, and each summary
+    # builds on the previous checkpoint, so a long conversation is summarized incrementally
+    # instead of on every turn.
+    blocking = True
+
+    def __init__(self, summarize, checkpoint_turns=4, max_checkpoints=1024):
+        self.summarize = summarize
+        self.checkpoint_turns = checkpoint_turns
+        self.max_checkpoints = max_checkpoints
+        # Shared by every request thread. The lock is not held while summarizing, two requests
+        # may then build the same checkpoint and the second one wins.
+        self._checkpoints = OrderedDict()
+        self._lock = Lock()
+
+    def _span_key(self, turns, end):
+        span = json.dumps(join_turns(turns[:end]), sort_keys=True).encode('utf-8')
+        return hashlib.blake2b(span, digest_size=16).digest()
+
+    def _summary(self, turns, end):
+        # Summary of turns[:end], built from the checkpoint one step earlier
+        if end <= 0:
+            return None
+        key = self._span_key(turns, end)
+        with self._lock:
+            summary = self._checkpoints.get(key)
+            if summary is not None:
+                self._checkpoints.move_to_end(key)
+                return summary
+
+        start = ((end - 1) // self.checkpoint_turns) * self.checkpoint_turns
+        previous = self._summary(turns, start)
+        to_fold = join_turns(turns[start:end])
+        if previous is not None:
+            to_fold = [{"role": "system", "content": SUMMARY_PREFIX + previous}] + to_fold
+        summary = self.summarize(to_fold)
+
+        with self._lock:
+            self._checkpoints[key] = summary
+            self._checkpoints.move_to_end(key)
+            if len(self._checkpoints) > self.max_checkpoints:
+                self._checkpoints.popitem(last=False)
+        return summary
+
+    def fit(self, messages, token_counts, budget, count_tokens):
+        turns = split_turns(messages, token_counts)
+        total = sum(turn_tokens for _, turn_tokens in turns)
+        if total <= budget:
+            return messages, total
+
+        # Fold checkpoints until the summary plus the remaining turns fit, keeping the latest turn
+        end = 0
+        while end < len(turns) - 1:
+            end = min(end + self.checkpoint_turns, len(turns) - 1)
+            try:
+                summary = self._summary(turns, end)
+            except Exception as e:
+                logger.warning("Error summarizing conversation, dropping oldest turns instead: %s", e)
+                turns, total = drop_oldest_turns(turns, budget)
+                return join_turns(turns), total
+            summary_message = {"role": "system", "content": SUMMARY_PREFIX + summary}
+            summary_tokens = count_tokens(summary_message['content'])
+            rest, rest_tokens = drop_oldest_turns(turns[end:], budget - summary_tokens)
+            if summary_tokens + rest_tokens <= budget or end == len(turns) - 1:
+                return [summary_message] + join_turns(rest), summary_tokens + rest_tokens
+        return join_turns(turns), total
+
+
+class ContextCompactor:
+    # Fits a conversation into a prompt token budget before it is sent upstream. The leading
+    # system messages (the system context) are always kept, the policy decides what to do with
+    # the rest. The stored conversation itself is never modified.
+
+    def __init__(self, policy, budget, count_tokens):
+        self.policy = policy
+        self.budget = budget
+        self.count_tokens = count_tokens
+        self.saved_tokens = 0
+
+    def compact(self, messages, token_counts):
+        pinned = 0
+        while pinned < len(messages) and messages[pinned]['role'] == 'system':
+            pinned += 1
+        pinned_tokens = sum(token_counts[:pinned])
+        total = sum(token_counts)
+
+        history, history_tokens = self.policy.fit(
+            messages[pinned:], token_counts[pinned:], self.budget - pinned_tokens, self.count_tokens
+        )
+        prompt_tokens = pinned_tokens + history_tokens
+        saved_tokens = max(0, total - prompt_tokens)
+        self.saved_tokens += saved_tokens
+        return CompactionResult(messages[:pinned] + history, prompt_tokens, saved_tokens)
+
+
+def openai_summarizer(client, model, max_tokens=300):
+    # Summarize function for SummaryCheckpointPolicy backed by a synchronous OpenAI client
+    def summarize(messages):
+        response = client.chat.completions.create(
+            model=model,
+            messages=messages + [{"role": "user", "content": SUMMARY_PROMPT}],
+            max_completion_tokens=max_tokens,
+        )
+        return response.choices[0].message.content
+    return summarize
+
+
+def make_compactor(policy_name, budget, count_tokens, summarize=None, window_turns=10):
+    if policy_name == 'sliding_window':
+        policy = SlidingWindowPolicy(window_turns)
+    elif policy_name == 'drop_oldest':
+        policy = DropOldestPolicy()
+    elif policy_name == 'summary':
+        policy = SummaryCheckpointPolicy(summarize)
+    else:
+        raise ValueError(f"Unknown compaction policy: {policy_name}")
+    return ContextCompactor(policy, budget, count_tokens)
@@ -0,0 +1,222 @@
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+# Number of conversations kept in memory before the least recently used one is evicted
+DEFAULT_MAX_CACHED = 1024
+# Logs of conversations idle for longer than this are removed, chats that are never ended
+# would otherwise stay on disk forever
+DEFAULT_TTL = 86400
+# How often create() looks for expired logs
+CLEANUP_INTERVAL = 600
+
+
+class Conversation:
+    # A live conversation: the messages sent to the API and the token count of each message
+
+    def __init__(self):
+        self.messages = []
+        self.token_counts = []
+        self.total_tokens = 0
+        # How much of the stored log these messages cover (bytes or list items)
+        self.position = 0
+
+    def add(self, message, tokens):
+        self.messages.append(message)
+        self.token_counts.append(tokens)
+        self.total_tokens += tokens
+
+
+def encode_messages(messages, token_counts):
+    return [json.dumps({"role": message['role'], "content": message['content'], "tokens": tokens})
+            for message, tokens in zip(messages, token_counts)]
+
+
+def add_records(conversation, lines):
+    for line in lines:
+        record = json.loads(line)
+        conversation.add({"role": record['role'], "content": record['content']}, record['tokens'])
+
+
+class ConversationStore:
+    # Keeps each conversation as an append-only JSON Lines log, one message per line, so a turn
+    # only writes the messages it added instead of the whole history. Recently used
+    # conversations stay in memory and evicted ones are read back from their log on demand.
+    #
+    # Other processes may append to the same log (several workers behind a load balancer), so a
+    # cached conversation is checked against the size of its log and only the lines it is
+    # missing are read.
+
+    def __init__(self, directory, max_cached=DEFAULT_MAX_CACHED, ttl=DEFAULT_TTL, cleanup_interval=CLEANUP_INTERVAL):
+        self.directory = directory
+        self.max_cached = max_cached
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self.bytes_written = 0
+        self.expired = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+        self._next_cleanup = time.monotonic() + cleanup_interval
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, conversation_id):
+        return os.path.join(self.directory, f"{conversation_id}.jsonl")
+
+    def _remember(self, conversation_id, conversation):
+        self._cache[conversation_id] = conversation
+        self._cache.move_to_end(conversation_id)
+        if len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    # Storage primitives, overridden by RedisConversationStore
+
+    def _log_position(self, conversation_id):
+        # Current end of the log, or None if there is no log
+        try:
+            return os.path.getsize(self._path(conversation_id))
+        except FileNotFoundError:
+            return None
+
+    def _read_log(self, conversation_id, position):
+        # Lines after `position` and the position they end at
+        with open(self._path(conversation_id), 'rb') as f:
+            f.seek(position)
+            data = f.read()
+        # A line another worker is still writing is picked up next time
+        complete = data[:data.rfind(b"\n") + 1]
+        return complete.decode('utf-8').splitlines(), position + len(complete)
+
+    def _append_log(self, conversation_id, lines):
+        # Append lines and return (end position, length written)
+        data = "".join(line + "\n" for line in lines).encode('utf-8')
+        with open(self._path(conversation_id), 'ab') as f:
+            f.write(data)
+            end = f.tell()
+        self.bytes_written += len(data)
+        return end, len(data)
+
+    def _remove_log(self, conversation_id):
+        try:
+            os.remove(self._path(conversation_id))
+        except FileNotFoundError:
+            pass
+
+    def remove_expired(self):
+        # Delete the logs not appended to for longer than the TTL and return how many there were.
+        # Every append touches the log, so only abandoned conversations are removed.
+        cutoff = time.time() - self.ttl
+        removed = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.jsonl'):
+                    continue
+                try:
+                    if entry.stat().st_mtime >= cutoff:
+                        continue
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    # Ended or removed by another worker
+                    continue
+                with self._lock:
+                    self._cache.pop(entry.name[:-len('.jsonl')], None)
+                removed += 1
+        self.expired += removed
+        return removed
+
+    def _maybe_remove_expired(self):
+        now = time.monotonic()
+        if now < self._next_cleanup:
+            return
+        self._next_cleanup = now + self.cleanup_interval
+        self.remove_expired()
+
+    def _valid_id(self, conversation_id):
+        # Ids come from the client cookie, only accept the ones we could have generated
+        return bool(conversation_id) and all(c in '0123456789abcdef' for c in conversation_id)
+
+    def create(self, messages, token_counts):
+        self._maybe_remove_expired()
+        conversation_id = uuid.uuid4().hex
+        conversation = Conversation()
+        for message, tokens in zip(messages, token_counts):
+            conversation.add(message, tokens)
+        with self._lock:
+            conversation.position, _ = self._append_log(conversation_id, encode_messages(messages, token_counts))
+            self._remember(conversation_id, conversation)
+        return conversation_id
+
+    def get(self, conversation_id):
+        if not self._valid_id(conversation_id):
+            return None
+        with self._lock:
+            position = self._log_position(conversation_id)
+            if position is None:
+                # Deleted, possibly by another worker
+                self._cache.pop(conversation_id, None)
+                return None
+            conversation = self._cache.get(conversation_id)
+            if conversation is None:
+                conversation = Conversation()
+            if position > conversation.position:
+                lines, conversation.position = self._read_log(conversation_id, conversation.position)
+                add_records(conversation, lines)
+            self._remember(conversation_id, conversation)
+            return conversation
+
+    def append(self, conversation_id, message, tokens):
+        conversation = self.get(conversation_id)
+        with self._lock:
+            end, written = self._append_log(conversation_id, encode_messages([message], [tokens]))
+            if end == conversation.position + written:
+                conversation.add(message, tokens)
+                conversation.position = end
+        if conversation.messages[-1] is not message:
+            # Another worker appended in between, read everything up to our message
+            conversation = self.get(conversation_id)
+        return conversation
+
+    def delete(self, conversation_id):
+        with self._lock:
+            self._cache.pop(conversation_id, None)
+            self._remove_log(conversation_id)
+
+
+class RedisConversationStore(ConversationStore):
+    # The same log kept in a Redis list per conversation, shared by every worker and host
+
+    def __init__(self, client, ttl, max_cached=DEFAULT_MAX_CACHED, prefix="chat:conversation:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.max_cached = max_cached
+        self.bytes_written = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def _maybe_remove_expired(self):
+        # Keys expire on their own
+        pass
+
+    def _log_position(self, conversation_id):
+        length = self.client.llen(self.prefix + conversation_id)
+        return length or None
+
+    def _read_log(self, conversation_id, position):
+        items = self.client.lrange(self.prefix + conversation_id, position, -1)
+        return [item.decode('utf-8') for item in items], position + len(items)
+
+    def _append_log(self, conversation_id, lines):
+        key = self.prefix + conversation_id
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.rpush(key, *lines)
+        # Idle conversations expire, every turn extends the deadline
+        pipeline.expire(key, self.ttl)
+        length, _ = pipeline.execute()
+        self.bytes_written += sum(len(line.encode('utf-8')) for line in lines)
+        return length, len(lines)
+
+    def _remove_log(self, conversation_id):
+        self.client.delete(self.prefix + conversation_id)
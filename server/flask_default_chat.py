@@ -1,131 +1,382 @@
-from flask import Flask, request, jsonify, session
+from flask import Flask, g, request, jsonify, session, Response, stream_with_context
 from flask_session import Session  # Flask-Session extension
 import openai 
 from openai import OpenAI
 import os
-import json
-import tiktoken
-from datetime import datetime
+import math
+from token_counter import TokenCounter, sync_token_counts
+from compaction import make_compactor, openai_summarizer
+from response_cache import cache_from_env, cache_key
+from single_flight import SingleFlight
+from upstream_scheduler import UpstreamBusy, scheduler_from_env
+from upstream_hedging import UpstreamTimeout, hedger_from_env
+from admission import Overloaded, admission_from_env
+from chat_logging import event, get_logger
+from history_writer import writer_from_env
+from system_context import SystemContextProvider
+from startup import LazyEncoding, Warmup, warmup_steps
+from session_backend import configure_flask_session, conversation_store_from_env, secret_key_from_env
+from history_index import HistoryIndex, accepts_gzip, export_chunks, filters_from_query, resume_conversation_id, API_ENABLED as HISTORY_API_ENABLED
+from chat_sync import SyncError, decode_body, missing_messages, parse_end_request, sync_state
+from batch_chat import CONTENT_TYPE as BATCH_CONTENT_TYPE, item_result, parse_batch, result_line, run_batch, summary_line
+import metrics
+from metrics import stage
+from profiler import profiler, ENABLED as PROFILER_ENABLED
+from memory_tracker import memory_tracker, DEFAULT_LIMIT as DEFAULT_MEMORY_SITES, ENABLED as TRACEMALLOC_ENABLED
 
 app = Flask(__name__)
-# Replace with a real secret key
-app.config['SECRET_KEY'] = os.urandom(24)
-app.config['SESSION_TYPE'] = 'filesystem'
+logger = get_logger("default")
+# The same key on every worker so sessions survive restarts and load balancing, see session_backend.py
+app.config['SECRET_KEY'] = secret_key_from_env()
+# Filesystem sessions by default, CHAT_SESSION_BACKEND=redis shares them between hosts
+configure_flask_session(app)
 
 # Flask-Session
 Session(app)
+# Request counts and durations, and session load/save times, for GET /metrics
+metrics.instrument_flask(app)
 
 # Constants and Initializations
 MAX_ALLOWED_TOKENS = 4096
 MODEL_NAME = "gpt-4o"
 BOT_RESPONSE_BUFFER = 500
+PROMPT_TOKEN_BUDGET = int(os.getenv("CHAT_PROMPT_TOKEN_BUDGET", "2048"))
+COMPACTION_POLICY = os.getenv("CHAT_COMPACTION_POLICY", "drop_oldest")  # drop_oldest, sliding_window or summary
+SAMPLING_PARAMS = {"temperature": 1, "top_p": 1, "frequency_penalty": 1, "presence_penalty": 1}
 openai.api_key = os.getenv("OPENAI_API_KEY")
-enc = tiktoken.encoding_for_model(MODEL_NAME)
+# The tokenizer loads on a background thread (from a local BPE cache if present), see startup.py
+enc = LazyEncoding(MODEL_NAME).start()
+token_counter = TokenCounter(enc)
+# system_context.txt is parsed and tokenized once, and again only when the file changes
+system_context = SystemContextProvider(token_counter.count)
 
-client = OpenAI()
+# Retries are done with jitter by upstream_hedging, and rate limits by upstream_scheduler
+client = OpenAI(max_retries=0)
+# Tokenize the system context and open an upstream connection before reporting ready
+warmup = Warmup(warmup_steps(enc, system_context, lambda: client.models.list())).start()
+# History sent upstream is fitted into PROMPT_TOKEN_BUDGET, the system context is always kept
+compactor = make_compactor(COMPACTION_POLICY, PROMPT_TOKEN_BUDGET, token_counter.count,
+                           summarize=openai_summarizer(client, MODEL_NAME))
+
+# Finished conversations are written by a background thread, see history_writer.py
+CHAT_HISTORY_DIR = os.getenv("CHAT_HISTORY_DIR", './server/chat_history')
+# Saved conversations are indexed as they are written, for listing, resume and export
+history_index = HistoryIndex(CHAT_HISTORY_DIR)
+history_writer = writer_from_env(CHAT_HISTORY_DIR, history_index)
+
+# Opt-in cache of completions for repeated prompts, None unless CHAT_RESPONSE_CACHE=1
+response_cache = cache_from_env()
+# Identical prompts that are in flight at the same time share one upstream call
+single_flight = SingleFlight()
+# Upstream calls wait for requests/tokens-per-minute budget instead of failing on rate limits
+upstream_scheduler = scheduler_from_env()
+# Deadlines and jittered retries for every upstream call
+upstream_hedger = hedger_from_env()
+# Bounded number of chat requests in progress, shared fairly between users
+admission = admission_from_env()
+
+# Live conversations are kept out of the session, which only holds the conversation id
+conversation_store = conversation_store_from_env(os.path.join(os.path.dirname(__file__), 'conversations'))
+
+# Stats kept by the components above, read when /metrics is scraped
+metrics.register_stats('admission', admission.stats, exclude=('queued_by_user',))
+metrics.register_stats('scheduler', upstream_scheduler.stats)
+metrics.register_stats('hedging', upstream_hedger.stats)
+metrics.register_stats('history', history_writer.stats)
+if response_cache:
+    metrics.register_stats('cache', response_cache.stats)
 
 def initialize_system_context():
-    # Read the system context from the text file, using an example of the Streamy AI sidekick by mAInstream studIOs LLC (mainstreamstudios.ai).
-    try:
-        with open(os.path.join(os.path.dirname(__file__), 'system_context.txt'), 'r') as file:
-            system_context = json.load(file)
-    except Exception as e:
-        print(f"Error reading system context: {e}")
-        system_context = [
-            {"role": "system", "content": "Default system context due to an error."}
-        ]
-    return system_context
-
-@app.before_request
-def before_request():
-    # Check if 'messages' is not in session or 'init_done' flag is False, then initialize it
-    if 'messages' not in session or not session.get('init_done', False):
-        session['messages'] = initialize_system_context()
-        session['init_done'] = True  # Set the flag to True after initialization
-
-@app.after_request
-def after_request(response):
-    session.modified = True
-    return response
+    # The system context from the text file, using an example of the Streamy AI sidekick by mAInstream studIOs LLC (mainstreamstudios.ai).
+    return system_context.get()
+
+def current_conversation():
+    # The session's conversation, or a new one seeded with the system context if it has none yet.
+    # Only the chat endpoints start conversations, so probes and scrapes leave nothing on disk.
+    with stage('conversation_load'):
+        conversation = conversation_store.get(session.get('conversation_id'))
+        if conversation is None:
+            context = initialize_system_context()
+            session['conversation_id'] = conversation_store.create(context.session_messages(), context.session_token_counts())
+            conversation = conversation_store.get(session['conversation_id'])
+        return conversation
+
+@app.teardown_request
+def release_admission(exception=None):
+    # A chat request holds its slot until its response is done
+    admission.release(g.pop('admission_ticket', None))
 
 def get_token_count(text):
-    return len(enc.encode(text))
+    return token_counter.count(text)
 
 def calculate_messages_tokens(messages):
-    total_tokens = 0
-    for message in messages:
-        total_tokens += get_token_count(message['content'])
-    return total_tokens
+    return token_counter.count_messages(messages)
 
 def save_conversation(user_name):
-        # Define the directory for saving chat history
-    chat_history_dir = './server/chat_history'
-
-    # Create the directory if it does not exist
-    os.makedirs(chat_history_dir, exist_ok=True)
-
-    # Save the conversation history to a file
-    filename = os.path.join(chat_history_dir, f"chat_{user_name}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
-    # Use the user_name from the request to save the file
-    # filename = f"conversation_{user_name}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json"
-    with open(filename, 'w') as f:
-        json.dump(session['messages'], f, indent=4)
-    session.pop('messages', None)  # Clear the messages in session after saving
+    # Hand the conversation to the history writer, the request does not wait for the disk
+    conversation_id = session.pop('conversation_id')  # Clear the conversation from the session after saving
+    with stage('history_persist'):
+        conversation = conversation_store.get(conversation_id)
+        history_writer.submit(user_name, list(conversation.messages), conversation_id=conversation_id,
+                              total_tokens=conversation.total_tokens)
+        conversation_store.delete(conversation_id)
 
-# Helper function to add messages with the specified role
+# Helper function to add messages with the specified role, only the new message is written to the log
 def add_message(role, content):
-    session['messages'].append({"role": role, "content": content})
+    with stage('tokenize'):
+        tokens = get_token_count(content)
+    with stage('conversation_append'):
+        return conversation_store.append(session['conversation_id'], {"role": role, "content": content}, tokens)
+
+def complete(compacted, params):
+    # Budgeted as the prompt plus the longest answer allowed, corrected with the real usage
+    estimated_tokens = compacted.prompt_tokens + params['max_completion_tokens']
+    response = upstream_hedger.call(lambda: upstream_scheduler.call(lambda: client.chat.completions.with_raw_response.create(
+        model=MODEL_NAME,
+        messages=compacted.messages,  # Use the compacted messages from the conversation store
+        timeout=upstream_hedger.timeout(),
+        **params
+    ), estimated_tokens))
+    if response.usage:
+        upstream_scheduler.settle(estimated_tokens, response.usage.total_tokens)
+        metrics.record_usage(response.usage)
+    return response
 
 @app.route('/api/chat', methods=['POST'])
 def chat_endpoint():
     user_input = request.json.get('input')
     user_name = request.json.get('user_name', 'unknown_user')  # Get user_name from the request
-    session['user_name'] = user_name  # Save it in the session
-    session['messages'].append({"role": "user", "content": user_input})
+    if session.get('user_name') != user_name:
+        session['user_name'] = user_name  # Save it in the session, only rewritten when it changes
+
+    # Wait for a slot, or shed the request when the server is overloaded. Users are served in
+    # proportion to their prompt sizes, so long histories cost more of a user's share.
+    cost = min(current_conversation().total_tokens + get_token_count(user_input), MAX_ALLOWED_TOKENS)
+    try:
+        with stage('admission_wait'):
+            g.admission_ticket = admission.acquire(user_name, cost)
+    except Overloaded as e:
+        return jsonify({"error": str(e)}), e.status, e.headers()
 
-    # Calculate the available token space for the response
-    max_response_tokens = MAX_ALLOWED_TOKENS - calculate_messages_tokens(session['messages']) - BOT_RESPONSE_BUFFER
+    conversation = add_message("user", user_input)
 
     try:
-        # Call the Chat completions API with appropriate parameters
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=session['messages'],  # Use the messages from the session
-            temperature=1,
-            max_completion_tokens=max_response_tokens,
-            top_p=1,
-            frequency_penalty=1,
-            presence_penalty=1
-        )
-
-        # Access usage and choices using dot notation
-        tokens_used = response.usage.total_tokens  # Correct access to 'total_tokens'
-        
-        if tokens_used + calculate_messages_tokens(session['messages']) > MAX_ALLOWED_TOKENS:
-            print("Token limit exceeded by the bot's response.")
-            return jsonify({"response": "Sorry, the token limit has been exceeded."})
-
-        # Add the assistant's response to the session messages
-        bot_response = response.choices[0].message.content  # Accessing 'content' via dot notation
-        session['messages'].append({"role": "assistant", "content": bot_response})
+        # Fit the history into the prompt budget, the full conversation stays in the store
+        with stage('compaction'):
+            compacted = compactor.compact(conversation.messages, conversation.token_counts)
+        if compacted.saved_tokens:
+            logger.info("Context compaction saved %d prompt tokens this turn.", compacted.saved_tokens, extra=event('compaction'))
+
+        # Calculate the available token space for the response from the compacted prompt
+        max_response_tokens = MAX_ALLOWED_TOKENS - compacted.prompt_tokens - BOT_RESPONSE_BUFFER
+
+        params = dict(SAMPLING_PARAMS, max_completion_tokens=max_response_tokens)
+        key = cache_key(MODEL_NAME, params, compacted.messages)
+        bot_response = response_cache.get(key) if response_cache else None
+
+        if bot_response is None:
+            # Call the Chat completions API with appropriate parameters, sharing the call with
+            # any identical request that is already waiting on it
+            with stage('upstream'):
+                response = single_flight.do(key, lambda: complete(compacted, params))
+
+            # Access usage and choices using dot notation
+            tokens_used = response.usage.total_tokens  # Correct access to 'total_tokens'
+
+            if tokens_used > MAX_ALLOWED_TOKENS:
+                logger.warning("Token limit exceeded by the bot's response.")
+                return jsonify({"response": "Sorry, the token limit has been exceeded."})
+
+            bot_response = response.choices[0].message.content  # Accessing 'content' via dot notation
+            # Only complete answers are cached, not ones cut off by the token limit
+            if response_cache and response.choices[0].finish_reason == 'stop':
+                response_cache.put(key, bot_response)
+
+        # Add the assistant's response to the conversation
+        conversation = add_message("assistant", bot_response)
 
+    except UpstreamBusy as e:
+        logger.warning("Request rejected: %s", e)
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(math.ceil(e.retry_after))}
+    except UpstreamTimeout as e:
+        logger.warning("Upstream call timed out: %s", e)
+        return jsonify({"error": str(e)}), 504
     except openai.OpenAIError as e:  # Corrected error handling to match the updated client
-        print(f"OpenAI Error: {e}.")
+        logger.error("OpenAI Error: %s.", e)
         return jsonify({"response": f"An OpenAI error occurred: {e}"})
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.exception("An error occurred: %s", e)
         return jsonify({"response": f"An error occurred: {e}"})
 
-    # Return the assistant's response
-    return jsonify({"response": bot_response})
+    # Return the assistant's response, with the sequence number the client can end the chat from
+    return jsonify(dict(sync_state(session['conversation_id'], conversation.messages), response=bot_response))
+
+def answer_batch_item(item, user_name):
+    # One conversation of a batch, answered like a chat turn but kept out of the session
+    context = initialize_system_context()
+    messages = context.session_messages() + item.messages
+    with stage('tokenize'):
+        token_counts = context.session_token_counts() + [get_token_count(message['content']) for message in item.messages]
+    with stage('admission_wait'):
+        ticket = admission.acquire(user_name, min(sum(token_counts), MAX_ALLOWED_TOKENS))
+    try:
+        with stage('compaction'):
+            compacted = compactor.compact(messages, token_counts)
+        max_response_tokens = MAX_ALLOWED_TOKENS - compacted.prompt_tokens - BOT_RESPONSE_BUFFER
+        params = dict(SAMPLING_PARAMS, max_completion_tokens=max_response_tokens)
+        key = cache_key(MODEL_NAME, params, compacted.messages)
+        cached_response = response_cache.get(key) if response_cache else None
+        if cached_response is not None:
+            return item_result(item, cached_response, 'stop')
+        with stage('upstream'):
+            response = single_flight.do(key, lambda: complete(compacted, params))
+        choice = response.choices[0]
+        if response_cache and choice.finish_reason == 'stop':
+            response_cache.put(key, choice.message.content)
+        return item_result(item, choice.message.content, choice.finish_reason, response.usage)
+    finally:
+        admission.release(ticket)
+
+@app.route('/api/chat/batch', methods=['POST'])
+def batch_chat():
+    # Many independent prompts in one request, answered with bounded concurrency and streamed
+    # back as NDJSON in completion order, see batch_chat.py
+    batch = request.get_json(silent=True)
+    try:
+        items, concurrency = parse_batch(batch)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    user_name = batch.get('user_name', session.get('user_name', 'unknown_user'))
+
+    def generate():
+        errors = 0
+        for result in run_batch(items, lambda item: answer_batch_item(item, user_name), concurrency):
+            errors += 'error' in result
+            yield result_line(result)
+        yield summary_line(len(items), errors)
+
+    # The request context stays up until the last line is sent. Each item takes and gives back
+    # its own admission slot, the request holds none, so the teardown after the stream has
+    # nothing to release.
+    return Response(stream_with_context(generate()), content_type=BATCH_CONTENT_TYPE)
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(response_cache.stats(), enabled=True))
+
+@app.route('/api/upstream/stats', methods=['GET'])
+def upstream_stats():
+    return jsonify(dict(upstream_scheduler.stats(), hedging=upstream_hedger.stats()))
+
+@app.route('/api/admission/stats', methods=['GET'])
+def admission_stats():
+    return jsonify(admission.stats())
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/api/profiler', methods=['GET', 'POST'])
+def profiler_endpoint():
+    # Runtime switch for the sampling profiler, only when the server runs with CHAT_PROFILER=1
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    if request.method == 'POST':
+        try:
+            return jsonify(profiler.configure(request.get_json(silent=True) or {}))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return Response(profiler.collapsed(), content_type='text/plain', headers={"X-Profiler-Samples": str(profiler.samples)})
+
+@app.route('/api/memory', methods=['GET', 'POST'])
+def memory_endpoint():
+    # tracemalloc reports, only when the server runs with CHAT_TRACEMALLOC=1
+    if not TRACEMALLOC_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    if request.method == 'POST':
+        settings = request.get_json(silent=True)
+        try:
+            return jsonify(memory_tracker.configure({} if settings is None else settings))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify(memory_tracker.report(request.args.get('limit', DEFAULT_MEMORY_SITES, type=int)))
 
 @app.route('/api/chat/end', methods=['POST'])
 def end_chat():
-    # Extract the user_name when the chat ends
-    conversation_data = request.json
-    user_name = conversation_data.get('user_name', 'unknown_user')
+    # Apply the messages the client has and the server doesn't, then save the conversation. A
+    # legacy upload of the whole conversation is not needed, the store already has every message.
+    try:
+        conversation_data = decode_body(request.get_data(), request.headers.get('Content-Encoding'))
+        end_request = parse_end_request(conversation_data)
+        conversation = current_conversation()
+        if not end_request.legacy:
+            conversation_id = session['conversation_id']
+            for message in missing_messages(conversation_id, conversation.messages, end_request):
+                add_message(message['role'], message['content'])
+    except SyncError as e:
+        return jsonify(e.payload()), e.status
+    # Extract the user_name when the chat ends, legacy list uploads don't carry one
+    user_name = session.get('user_name', 'unknown_user')
+    if isinstance(conversation_data, dict):
+        user_name = conversation_data.get('user_name', user_name)
+    state = sync_state(session['conversation_id'], conversation_store.get(session['conversation_id']).messages)
     save_conversation(user_name)
-    return jsonify({"message": "Conversation saved."})
+    return jsonify(dict(state, message="Conversation saved."))
+
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    # Readiness probe, 503 until the startup warmup has finished
+    return jsonify(warmup.status()), 200 if warmup.is_ready() else 503
+
+@app.route('/api/history', methods=['GET'])
+def list_history():
+    # Saved conversations, newest first, filtered by user_name, since/until and min/max_tokens
+    if not HISTORY_API_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    try:
+        filters = filters_from_query(request.args)
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": "Token filters and limit must be integers."}), 400
+    return jsonify({"conversations": history_index.list(limit=limit, **filters)})
+
+@app.route('/api/history/resume', methods=['POST'])
+def resume_history():
+    # Load a saved conversation into this session so the chat continues where it ended
+    if not HISTORY_API_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    try:
+        conversation_id = resume_conversation_id(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    record = history_index.load(conversation_id)
+    if record is None:
+        return jsonify({"error": "Conversation not found."}), 404
+    token_counts = []
+    sync_token_counts(record['messages'], token_counts, token_counter)
+    # The conversation it replaces is dropped, like one that has ended
+    previous_id = session.get('conversation_id')
+    session['conversation_id'] = conversation_store.create(record['messages'], token_counts)
+    if previous_id:
+        conversation_store.delete(previous_id)
+    return jsonify({"conversation_id": record['conversation_id'], "messages": record['messages']})
+
+@app.route('/api/history/export', methods=['GET'])
+def export_history():
+    # Matching conversations as streamed NDJSON, gzip-encoded when the client accepts it
+    if not HISTORY_API_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    try:
+        filters = filters_from_query(request.args)
+    except ValueError:
+        return jsonify({"error": "Token filters must be integers."}), 400
+    compress = accepts_gzip(request.headers.get('Accept-Encoding'))
+    response = Response(export_chunks(history_index.export(**filters), compress), content_type='application/x-ndjson')
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
 if __name__ == '__main__':
     try:
@@ -2,163 +2,537 @@ from flask import Flask, g, request, jsonify, session, Response, stream_with_con
 import openai
 from openai import OpenAI
 import os
-import json
 from datetime import datetime
-import tiktoken
+import threading
+import time
+from token_counter import TokenCounter, sync_token_counts
+from compaction import make_compactor, openai_summarizer
+from response_cache import cache_from_env, cache_key, replay_chunks
+from single_flight import StreamCoalescer
+from upstream_scheduler import UpstreamBusy, scheduler_from_env
+from upstream_hedging import UpstreamTimeout, hedger_from_env
+from admission import Overloaded, admission_from_env
+from stream_framing import TimedCoalescer, flush_policy_from_env, make_framer
+from stream_replay import replay_buffer_from_env
+from chat_logging import LoggedConversation, LoggedText, event, get_logger
+from history_writer import writer_from_env
+from system_context import SystemContextProvider
+from startup import LazyEncoding, Warmup, warmup_steps
+from session_backend import conversation_store_from_env, secret_key_from_env
+from history_index import HistoryIndex, accepts_gzip, export_chunks, filters_from_query, resume_conversation_id, API_ENABLED as HISTORY_API_ENABLED
+from chat_sync import SyncError, decode_body, dialogue_seq, missing_messages, parse_end_request, sync_state
+from batch_chat import CONTENT_TYPE as BATCH_CONTENT_TYPE, item_result, parse_batch, result_line, run_batch, summary_line
+import metrics
+from metrics import stage
+from profiler import profiler, ENABLED as PROFILER_ENABLED
+from memory_tracker import memory_tracker, DEFAULT_LIMIT as DEFAULT_MEMORY_SITES, ENABLED as TRACEMALLOC_ENABLED
 
 # Initialize OpenAI client and tokenizer
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
+logger = get_logger("stream")
+# The same key on every worker so the session cookie survives restarts and load balancing
+app.config['SECRET_KEY'] = secret_key_from_env()
+# Request counts and durations, and session load/save times, for GET /metrics
+metrics.instrument_flask(app)
 
 # Constants and Initializations
 MAX_ALLOWED_TOKENS = 4096
 MODEL_NAME = "gpt-4o"
 BOT_RESPONSE_BUFFER = 500
+PROMPT_TOKEN_BUDGET = int(os.getenv("CHAT_PROMPT_TOKEN_BUDGET", "2048"))
+COMPACTION_POLICY = os.getenv("CHAT_COMPACTION_POLICY", "drop_oldest")  # drop_oldest, sliding_window or summary
+SAMPLING_PARAMS = {"temperature": 1, "top_p": 1, "frequency_penalty": 1, "presence_penalty": 1}
+# Pause between chunks when replaying a cached response
+CACHE_REPLAY_DELAY = float(os.getenv("CHAT_RESPONSE_CACHE_REPLAY_MS", "20")) / 1000
+# Upstream deltas are coalesced into fewer writes, see CHAT_STREAM_FLUSH_BYTES / CHAT_STREAM_FLUSH_MS
+FLUSH_POLICY = flush_policy_from_env()
 OpenAI.api_key = os.getenv("OPENAI_API_KEY")
-enc = tiktoken.encoding_for_model(MODEL_NAME)
-client = OpenAI()
+# The tokenizer loads on a background thread (from a local BPE cache if present), see startup.py
+enc = LazyEncoding(MODEL_NAME).start()
+token_counter = TokenCounter(enc)
+# system_context.txt is parsed and tokenized once, and again only when the file changes
+system_context = SystemContextProvider(token_counter.count)
+# Retries are done with jitter by upstream_hedging, and rate limits by upstream_scheduler
+client = OpenAI(max_retries=0)
+# Tokenize the system context and open an upstream connection before reporting ready
+warmup = Warmup(warmup_steps(enc, system_context, lambda: client.models.list())).start()
+# History sent upstream is fitted into PROMPT_TOKEN_BUDGET, the system context is always kept
+compactor = make_compactor(COMPACTION_POLICY, PROMPT_TOKEN_BUDGET, token_counter.count,
+                           summarize=openai_summarizer(client, MODEL_NAME))
+# Finished conversations are written by a background thread, see history_writer.py
+CHAT_HISTORY_DIR = os.getenv("CHAT_HISTORY_DIR", './server/chat_history')
+# Saved conversations are indexed as they are written, for listing, resume and export
+history_index = HistoryIndex(CHAT_HISTORY_DIR)
+history_writer = writer_from_env(CHAT_HISTORY_DIR, history_index)
+# Opt-in cache of completions for repeated prompts, None unless CHAT_RESPONSE_CACHE=1
+response_cache = cache_from_env()
+# Identical prompts that are in flight at the same time share one upstream stream
+stream_coalescer = StreamCoalescer()
+# Upstream calls wait for requests/tokens-per-minute budget instead of failing on rate limits
+upstream_scheduler = scheduler_from_env()
+# Deadlines, hedging and jittered retries for every upstream stream
+upstream_hedger = hedger_from_env()
+# Bounded number of chat requests in progress, shared fairly between users
+admission = admission_from_env()
+# Numbered chunks of recent answers, so a client that loses its connection can resume
+replay_buffer = replay_buffer_from_env()
+# Live conversations are kept in the store shared by the workers, the session cookie only holds
+# the conversation id. Answers are added to it by the generation thread once they are complete.
+conversation_store = conversation_store_from_env(os.path.join(os.path.dirname(__file__), 'conversations'))
+# Stats kept by the components above, read when /metrics is scraped
+metrics.register_stats('admission', admission.stats, exclude=('queued_by_user',))
+metrics.register_stats('scheduler', upstream_scheduler.stats)
+metrics.register_stats('hedging', upstream_hedger.stats)
+metrics.register_stats('history', history_writer.stats)
+metrics.register_stats('replay', replay_buffer.stats)
+if response_cache:
+    metrics.register_stats('cache', response_cache.stats)
 
 @app.before_request
 def before_request():
     if 'user_id' not in session:
         session['user_id'] = str(datetime.now().timestamp())  # Use timestamp or generate unique ID
-    
-    if 'conversation' not in session:
-        session['conversation'] = load_system_context()  # Initialize conversation with system context
 
 @app.after_request
 def after_request(response):
     session.modified = True
     return response
 
-# System context loading function
-def load_system_context():
-    try:
-        file_path = os.path.join(os.path.dirname(__file__), 'system_context.txt')
-        with open(file_path, 'r') as file:
-            system_context = json.load(file)
-    except Exception as e:
-        print(f"Error reading system context: {e}")
-        system_context = [
-            {"role": "system", "content": "Default system context due to an error."}
-        ]
-    return system_context
+@app.teardown_request
+def release_admission(exception=None):
+    # A chat request that fails before its stream starts gives its slot back here, otherwise the
+    # generation thread holds it until the answer is done
+    admission.release(g.pop('admission_ticket', None))
+
+def current_conversation():
+    # The session's conversation, or a new one seeded with the system context if it has none yet.
+    # The id names it for delta sync at /api/chat/end and in the saved history.
+    with stage('conversation_load'):
+        conversation = conversation_store.get(session.get('conversation_id'))
+        if conversation is None:
+            context = system_context.get()
+            session['conversation_id'] = conversation_store.create(context.session_messages(), context.session_token_counts())
+            conversation = conversation_store.get(session['conversation_id'])
+        return conversation
+
+def save_answer(stream, answer):
+    # The session cookie is sent before the answer is streamed, so the generation thread adds the
+    # answer to the stored conversation itself, as soon as it is complete. Returns None when it
+    # was not added: the chat has ended, or the user sent another message meanwhile and has moved
+    # on. Only saved answers are acknowledged to the client.
+    conversation = conversation_store.get(stream.conversation_id)
+    if conversation is None or dialogue_seq(conversation.messages) != stream.seq:
+        return None
+    with stage('conversation_append'):
+        conversation = conversation_store.append(stream.conversation_id, {"role": "assistant", "content": answer},
+                                                 token_counter.count(answer))
+    logger.debug("Updated conversation messages: %s", LoggedConversation(conversation.messages), extra=event('conversation'))
+    return answer
 
 @app.route('/api/chat', methods=['POST'])
 def chat_endpoint():
     user_input = request.json.get('input')
-    global global_user_name  # Declare the use of the global variable
-    global_user_name = request.json.get('user_name', 'unknown_user')  # Extract user_name from the request
+    user_name = request.json.get('user_name', 'unknown_user')  # Extract user_name from the request
+    session['user_name'] = user_name  # Kept in the session, not in a global shared by all requests
     user_id = session.get('user_id')  # Retrieve user_id from session
 
     # Log received user_name and user_id for debugging
-    print(f"Received user_name: {global_user_name}")
-    print(f"Session user_id: {user_id}")
+    logger.debug("Received user_name: %s, session user_id: %s", user_name, user_id)
+
+    # Wait for a slot, or shed the request when the server is overloaded. Users are served in
+    # proportion to their prompt sizes, so long histories cost more of a user's share.
+    with stage('tokenize'):
+        input_tokens = token_counter.count(user_input)
+    cost = min(current_conversation().total_tokens + input_tokens, MAX_ALLOWED_TOKENS)
+    try:
+        with stage('admission_wait'):
+            g.admission_ticket = admission.acquire(user_name, cost)
+    except Overloaded as e:
+        return jsonify({"error": str(e)}), e.status, e.headers()
     
-    # Initialize or load the conversation from session
-    conversation = session.get('conversation', load_system_context())
-    conversation.append({"role": "user", "content": user_input})
-    session['conversation'] = conversation
+    # Only the new message is written to the conversation's log, with its token count
+    conversation_id = session['conversation_id']
+    with stage('conversation_append'):
+        conversation = conversation_store.append(conversation_id, {"role": "user", "content": user_input}, input_tokens)
+    # Fit the history into the prompt budget, the full conversation stays in the store
+    with stage('compaction'):
+        compacted = compactor.compact(conversation.messages, conversation.token_counts)
+    if compacted.saved_tokens:
+        logger.info("Context compaction saved %d prompt tokens this turn.", compacted.saved_tokens, extra=event('compaction'))
+
+    logger.debug("User input added to conversation: %s", LoggedText(user_input))
+    logger.debug("Current conversation messages: %s", LoggedConversation(conversation.messages), extra=event('conversation'))
+
+    max_response_tokens = MAX_ALLOWED_TOKENS - compacted.prompt_tokens - BOT_RESPONSE_BUFFER
+    params = dict(SAMPLING_PARAMS, max_completion_tokens=max_response_tokens)
+    # NDJSON by default, Server-Sent Events when the client sends Accept: text/event-stream
+    framer = make_framer(request.headers.get('Accept'))
 
-    print(f"User input added to conversation: {user_input}")
-    print(f"Current conversation messages: {conversation}")
+    # The answer is generated on its own thread into a replay buffer and the response reads it
+    # from there, so a client that loses its connection can resume at /api/chat/stream/<id>
+    stream = replay_buffer.create(user_id, conversation_id, dialogue_seq(conversation.messages))
+    threading.Thread(target=generate_answer, args=(stream, compacted, params, g.pop('admission_ticket')),
+                     daemon=True).start()
 
-    max_response_tokens = MAX_ALLOWED_TOKENS - calculate_messages_tokens(conversation) - BOT_RESPONSE_BUFFER
+    # The user message is acknowledged up front, the final frame acknowledges the answer
+    headers = {"X-Conversation-Id": conversation_id, "X-Conversation-Seq": str(stream.seq), "X-Stream-Id": stream.stream_id}
+    return Response(stream_with_context(stream_response(stream, framer)), content_type=framer.content_type, headers=headers)
+
+
+def upstream_request(compacted, params, estimated_tokens, admitted=None, **options):
+    # One chat completions call through the rate limit scheduler, streamed or not
+    return upstream_scheduler.call(lambda: client.chat.completions.with_raw_response.create(
+        model=MODEL_NAME,
+        messages=compacted.messages,
+        timeout=upstream_hedger.timeout(),
+        **options,
+        **params
+    ), estimated_tokens, admitted)
+
+
+def complete(compacted, params):
+    # A whole answer in one response, with the deadlines and hedging of the streams
+    # Budgeted as the prompt plus the longest answer allowed, corrected with the real usage
+    estimated_tokens = compacted.prompt_tokens + params['max_completion_tokens']
+    response = upstream_hedger.call(lambda: upstream_request(compacted, params, estimated_tokens))
+    if response.usage:
+        upstream_scheduler.settle(estimated_tokens, response.usage.total_tokens)
+        metrics.record_usage(response.usage)
+    return response
+
+
+def generate_answer(stream, compacted, params, ticket):
+    # Writes the answer into the replay stream until it is complete, or until no client has
+    # read the stream for the grace period. Holds the admission slot until then.
+    key = cache_key(MODEL_NAME, params, compacted.messages)
+    # Budgeted as the prompt plus the longest answer allowed, corrected with the real usage
+    estimated_tokens = compacted.prompt_tokens + params['max_completion_tokens']
     temp_response = ""
 
-    def generate():
-        nonlocal temp_response
+    def write(text):
+        logger.debug("Streaming chunk to client: %s", LoggedText(text), extra=event('chunk'))
+        stream.append(text)
 
-        try:
-            response = client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=conversation,
-                temperature=1,
-                max_completions_tokens=max_response_tokens,
-                top_p=1,
-                frequency_penalty=1,
-                presence_penalty=1,
-                stream=True
-            )
-
-            print("API request sent successfully. Streaming response chunks...")
-
-            for chunk in response:
-                print(f"Received chunk: {chunk}")
+    # Buffered text is written when it is due even if the upstream stalls before the next delta
+    coalescer = TimedCoalescer(FLUSH_POLICY, write)
+
+    def drain():
+        # Write whatever deltas are still waiting to be flushed
+        coalescer.flush()
+
+    metrics.ACTIVE_STREAMS.inc()
+    try:
+        cached_response = response_cache.get(key) if response_cache else None
+        if cached_response is not None:
+            # Replay the cached answer with the same framing as a live stream
+            logger.info("Replaying cached response.", extra=event('cache'))
+            for chunk_content in replay_chunks(cached_response):
+                stream.append(chunk_content)
+                time.sleep(CACHE_REPLAY_DELAY)
+            stream.finish(answer=save_answer(stream, cached_response))
+            return
+
+        def open_stream(admitted):
+            # The last chunk reports the usage, which settles the token budget. The hedger's
+            # deadlines start when the scheduler admits the call.
+            return upstream_request(compacted, params, estimated_tokens, admitted, stream=True,
+                                    stream_options={"include_usage": True})
 
+        def start_upstream():
+            logger.debug("Sending API request and streaming response chunks...")
+            first_token_at = None
+
+            # Bounded by the first-token and idle deadlines, and hedged when slow to start
+            for chunk in upstream_hedger.stream(open_stream):
+                logger.debug("Received chunk: %s", chunk, extra=event('chunk'))
+
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                if getattr(chunk, 'usage', None):
+                    upstream_scheduler.settle(estimated_tokens, chunk.usage.total_tokens)
+                    metrics.record_usage(chunk.usage, first_token_at)
                 if hasattr(chunk, 'choices') and len(chunk.choices) > 0:
                     delta = chunk.choices[0].delta
-                    chunk_content = getattr(delta, 'content', '')
-                    finish_reason = chunk.choices[0].finish_reason
-
-                    if chunk_content:
-                        temp_response += chunk_content
-                        chunk_json = json.dumps({"choices": [{"delta": {"content": chunk_content}}]})
-                        print(f"Streaming chunk to client: {chunk_json}")
-                        yield f"{chunk_json}\n"
-                    
-                    if finish_reason == 'stop':
-                        print(f"Streaming finished. Final response: {temp_response}")
-                        conversation.append({"role": "assistant", "content": temp_response})
-                        session['conversation'] = conversation
-                        print(f"Assistant response added to conversation: {temp_response}")
-                        print(f"Updated conversation messages: {conversation}")
-                        temp_response = ""
-
-                else:
-                    print("Invalid chunk received or chunk has no content.")
-
-        except openai.OpenAIError as e:
-            error_message = f"An OpenAI error occurred: {e}"
-            print(error_message)
-            yield json.dumps({"error": error_message}) + "\n"
-        except Exception as e:
-            error_message = f"An error occurred: {e}"
-            print(error_message)
-            yield json.dumps({"error": error_message}) + "\n"
-
-    return Response(stream_with_context(generate()), content_type='application/json')
+                    yield getattr(delta, 'content', ''), chunk.choices[0].finish_reason
+                elif not getattr(chunk, 'usage', None):
+                    logger.warning("Invalid chunk received or chunk has no content.", extra=event('chunk'))
+
+        # The upstream stream is shared with any identical request already in flight, and closed
+        # once nobody reads it anymore
+        upstream_started = time.perf_counter()
+        first_chunk_at = None
+        answer = None
+        chunks = stream_coalescer.subscribe(key, start_upstream)
+        try:
+            for chunk_content, finish_reason in chunks:
+                if first_chunk_at is None:
+                    first_chunk_at = time.perf_counter()
+                    metrics.STAGE_SECONDS.observe(first_chunk_at - upstream_started, 'first_token')
+                if chunk_content:
+                    temp_response += chunk_content
+                    coalescer.add(chunk_content)
+
+                if finish_reason == 'stop':
+                    logger.info("Streaming finished. Final response: %s", LoggedText(temp_response))
+                    if response_cache:
+                        response_cache.put(key, temp_response)
+                    answer = temp_response
+                if stream.abandoned(replay_buffer.grace):
+                    logger.info("No client read the stream for %ss, stopping the generation.", replay_buffer.grace)
+                    break
+        finally:
+            chunks.close()
+
+        if first_chunk_at is not None:
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - first_chunk_at, 'streaming')
+        drain()
+        stream.finish(answer=save_answer(stream, answer) if answer is not None else None)
+
+    except UpstreamBusy as e:
+        logger.warning("Request rejected: %s", e)
+        drain()
+        stream.finish(error=str(e))
+    except UpstreamTimeout as e:
+        logger.warning("Upstream call timed out: %s", e)
+        drain()
+        stream.finish(error=str(e))
+    except openai.OpenAIError as e:
+        error_message = f"An OpenAI error occurred: {e}"
+        logger.error(error_message)
+        drain()
+        stream.finish(error=error_message)
+    except Exception as e:
+        error_message = f"An error occurred: {e}"
+        logger.exception(error_message)
+        drain()
+        stream.finish(error=error_message)
+    finally:
+        metrics.ACTIVE_STREAMS.dec()
+        admission.release(ticket)
+
+
+def stream_response(stream, framer, after=0):
+    # Frames the chunks of a replay stream after chunk number `after`, then its end or error
+    chunks = stream.follow(after)
+    try:
+        for number, text in chunks:
+            yield framer.delta(text, chunk=number)
+        if stream.error is not None:
+            yield framer.error(stream.error)
+        else:
+            yield framer.end(stream.sync_state())
+    finally:
+        chunks.close()
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_started, request.endpoint)
+
+
+@app.route('/api/chat/stream/<stream_id>', methods=['GET'])
+def resume_stream(stream_id):
+    # Continue an answer after a dropped connection, from the chunk after ?after= (or the
+    # Last-Event-ID header of an SSE client). The answer keeps being generated meanwhile.
+    try:
+        after = int(request.args.get('after', request.headers.get('Last-Event-ID', 0)))
+    except ValueError:
+        return jsonify({"error": "after must be an integer."}), 400
+    stream = replay_buffer.resume(stream_id, session.get('user_id'))
+    if stream is None:
+        return jsonify({"error": "Stream not found or expired."}), 404
+    framer = make_framer(request.headers.get('Accept'))
+    return Response(stream_with_context(stream_response(stream, framer, after)), content_type=framer.content_type,
+                    headers={"X-Stream-Id": stream.stream_id})
+
+
+def answer_batch_item(item, user_name):
+    # One conversation of a batch, answered like a chat turn but not streamed and kept out of the
+    # session
+    context = system_context.get()
+    messages = context.session_messages() + item.messages
+    with stage('tokenize'):
+        token_counts = context.session_token_counts() + [token_counter.count(message['content']) for message in item.messages]
+    with stage('admission_wait'):
+        ticket = admission.acquire(user_name, min(sum(token_counts), MAX_ALLOWED_TOKENS))
+    try:
+        with stage('compaction'):
+            compacted = compactor.compact(messages, token_counts)
+        max_response_tokens = MAX_ALLOWED_TOKENS - compacted.prompt_tokens - BOT_RESPONSE_BUFFER
+        params = dict(SAMPLING_PARAMS, max_completion_tokens=max_response_tokens)
+        key = cache_key(MODEL_NAME, params, compacted.messages)
+        cached_response = response_cache.get(key) if response_cache else None
+        if cached_response is not None:
+            return item_result(item, cached_response, 'stop')
+        with stage('upstream'):
+            response = complete(compacted, params)
+        choice = response.choices[0]
+        if response_cache and choice.finish_reason == 'stop':
+            response_cache.put(key, choice.message.content)
+        return item_result(item, choice.message.content, choice.finish_reason, response.usage)
+    finally:
+        admission.release(ticket)
+
+
+@app.route('/api/chat/batch', methods=['POST'])
+def batch_chat():
+    # Many independent prompts in one request, answered with bounded concurrency and streamed
+    # back as NDJSON in completion order, see batch_chat.py
+    batch = request.get_json(silent=True)
+    try:
+        items, concurrency = parse_batch(batch)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    user_name = batch.get('user_name', session.get('user_name', 'unknown_user'))
+
+    def generate():
+        errors = 0
+        for result in run_batch(items, lambda item: answer_batch_item(item, user_name), concurrency):
+            errors += 'error' in result
+            yield result_line(result)
+        yield summary_line(len(items), errors)
+
+    # The request context stays up until the last line is sent. Each item takes and gives back
+    # its own admission slot, the request holds none, so the teardown after the stream has
+    # nothing to release.
+    return Response(stream_with_context(generate()), content_type=BATCH_CONTENT_TYPE)
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(response_cache.stats(), enabled=True))
+
+
+@app.route('/api/upstream/stats', methods=['GET'])
+def upstream_stats():
+    return jsonify(dict(upstream_scheduler.stats(), hedging=upstream_hedger.stats()))
+
+
+@app.route('/api/admission/stats', methods=['GET'])
+def admission_stats():
+    return jsonify(admission.stats())
+
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/api/profiler', methods=['GET', 'POST'])
+def profiler_endpoint():
+    # Runtime switch for the sampling profiler, only when the server runs with CHAT_PROFILER=1
+    if not PROFILER_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    if request.method == 'POST':
+        try:
+            return jsonify(profiler.configure(request.get_json(silent=True) or {}))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return Response(profiler.collapsed(), content_type='text/plain', headers={"X-Profiler-Samples": str(profiler.samples)})
+
+@app.route('/api/memory', methods=['GET', 'POST'])
+def memory_endpoint():
+    # tracemalloc reports, only when the server runs with CHAT_TRACEMALLOC=1
+    if not TRACEMALLOC_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    if request.method == 'POST':
+        settings = request.get_json(silent=True)
+        try:
+            return jsonify(memory_tracker.configure({} if settings is None else settings))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+    return jsonify(memory_tracker.report(request.args.get('limit', DEFAULT_MEMORY_SITES, type=int)))
 
 
 @app.route('/api/chat/end', methods=['POST'])
 def end_chat():
-    # Get conversation data from the request
-    new_conversation = request.json
-    
-    if not isinstance(new_conversation, list):
-        return jsonify({"error": "Conversation data must be an array."}), 400
+    # Get conversation data from the request, gzip-encoded bodies are accepted
+    try:
+        end_request = parse_end_request(decode_body(request.get_data(), request.headers.get('Content-Encoding')))
+        conversation_id = session.get('conversation_id')
+        if end_request.legacy:
+            # Whole conversation uploaded by an older client, saved after the current system context
+            context = system_context.get()
+            saved_conversation = context.session_messages() + end_request.messages
+            total_tokens = context.total_tokens + token_counter.count_messages(end_request.messages)
+        else:
+            # The store holds the conversation, only the messages it is missing are applied
+            conversation = conversation_store.get(conversation_id)
+            if conversation is None:
+                raise SyncError(409, "Unknown conversation_id, the conversation has ended or expired.")
+            missing = missing_messages(conversation_id, conversation.messages, end_request)
+            saved_conversation = conversation.messages + missing
+            total_tokens = conversation.total_tokens + token_counter.count_messages(missing)
+    except SyncError as e:
+        return jsonify(e.payload()), e.status
 
-    # Load existing system context
-    system_context = load_system_context()
-    
-    # Append new conversation to system context
-    system_context.extend(new_conversation)
+    # Hand the conversation to the history writer, the request does not wait for the disk
+    user_name = session.get('user_name', 'unknown_user')
+    with stage('history_persist'):
+        # Legacy uploads may end the same session more than once, each is saved on its own
+        history_writer.submit(user_name, saved_conversation, conversation_id=None if end_request.legacy else conversation_id,
+                              total_tokens=total_tokens)
+    logger.info("Chat history queued for %s", user_name)
+    response = {"message": "Conversation saved."}
+    if not end_request.legacy:
+        response.update(sync_state(conversation_id, saved_conversation))
+        # The conversation is finalized, the next request starts a new one
+        conversation_store.delete(session.pop('conversation_id'))
+    return jsonify(response)
 
-    # Define the directory for saving chat history
-    chat_history_dir = './server/chat_history'
+@app.route('/api/ready', methods=['GET'])
+def ready():
+    # Readiness probe, 503 until the startup warmup has finished
+    return jsonify(warmup.status()), 200 if warmup.is_ready() else 503
 
-    # Create the directory if it does not exist
-    os.makedirs(chat_history_dir, exist_ok=True)
+@app.route('/api/history', methods=['GET'])
+def list_history():
+    # Saved conversations, newest first, filtered by user_name, since/until and min/max_tokens
+    if not HISTORY_API_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    try:
+        filters = filters_from_query(request.args)
+        limit = int(request.args.get('limit', 50))
+    except ValueError:
+        return jsonify({"error": "Token filters and limit must be integers."}), 400
+    return jsonify({"conversations": history_index.list(limit=limit, **filters)})
+
+@app.route('/api/history/resume', methods=['POST'])
+def resume_history():
+    # Load a saved conversation into this session so the chat continues where it ended
+    if not HISTORY_API_ENABLED:
+        return jsonify({"error": "Not found."}), 404
+    try:
+        conversation_id = resume_conversation_id(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    record = history_index.load(conversation_id)
+    if record is None:
+        return jsonify({"error": "Conversation not found."}), 404
+    token_counts = []
+    sync_token_counts(record['messages'], token_counts, token_counter)
+    # The resumed chat is saved as a new conversation when it ends, the one it replaces is dropped
+    previous_id = session.get('conversation_id')
+    session['conversation_id'] = conversation_store.create(record['messages'], token_counts)
+    if previous_id:
+        conversation_store.delete(previous_id)
+    return jsonify({"conversation_id": record['conversation_id'], "messages": record['messages']})
 
-    # Save the conversation history to a file
-    filename = os.path.join(chat_history_dir, f"chat_{global_user_name}_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.json")
+@app.route('/api/history/export', methods=['GET'])
+def export_history():
+    # Matching conversations as streamed NDJSON, gzip-encoded when the client accepts it
+    if not HISTORY_API_ENABLED:
+        return jsonify({"error": "Not found."}), 404
     try:
-        with open(filename, 'w') as f:
-            json.dump(system_context, f, indent=4)
-        print(f"Chat history saved to {filename}")
-        return jsonify({"message": "Conversation saved."})
-    except IOError as e:
-        print(f"IOError while saving system context: {e}")
-        return jsonify({"error": "Error saving conversation."}), 500
-    except json.JSONEncodeError as e:
-        print(f"JSON encoding error while saving system context: {e}")
-        return jsonify({"error": "Error encoding conversation data."}), 500
+        filters = filters_from_query(request.args)
+    except ValueError:
+        return jsonify({"error": "Token filters must be integers."}), 400
+    compress = accepts_gzip(request.headers.get('Accept-Encoding'))
+    response = Response(export_chunks(history_index.export(**filters), compress), content_type='application/x-ndjson')
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
 def calculate_messages_tokens(messages):
-    total_tokens = 0
-    for message in messages:
-        total_tokens += len(enc.encode(message['content']))
-    return total_tokens
+    return token_counter.count_messages(messages)
 
 if __name__ == '__main__':
     try:
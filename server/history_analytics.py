@@ -0,0 +1,258 @@
+# Token and cost report over the saved chat histories: the server's archive (segments written by
+# the history writer, and legacy chat_<user>_<timestamp>.json files) and the client's
+# <timestamp>_conversation_<user>.json files. Totals are kept by user, day, role and archive.
+#
+# Conversations are streamed through a generator pipeline (files -> conversations -> batches of
+# message texts), and each batch is tokenized with tiktoken's batch encoding in a pool of worker
+# processes. Only a few batches are in flight at a time, so memory stays flat however large the
+# archive is.
+#
+# Runs are incremental. The totals and the files already counted are kept in a state file. The
+# next run only reads files that are new or have grown since then, and skips the conversations
+# it already counted in a grown file.
+#
+# Prompt tokens are estimated as the whole history before each assistant message, which is what
+# was sent upstream unless it was compacted. Completion tokens are the assistant messages. The
+# client's files have no system context, and they repeat conversations the server also saved.
+# Compare the two archives with by_source instead of adding them up.
+#
+# Usage (from the repository root):
+#   python server/history_analytics.py [--directories ./server/chat_history ./client/chat_history]
+#                                      [--workers 4] [--batch-messages 2000] [--full]
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from history_writer import open_segment, read_legacy_file
+from startup import LazyEncoding
+
+MODEL_NAME = "gpt-4o"
+DEFAULT_DIRECTORIES = ['./server/chat_history', './client/chat_history']
+DEFAULT_STATE_PATH = './server/chat_history/analytics-state.json'
+# Message texts sent to a worker at once
+BATCH_MESSAGES = 2000
+# USD per million tokens, for the cost columns
+PROMPT_PRICE = float(os.getenv("CHAT_ANALYTICS_PROMPT_PRICE", "2.50"))
+COMPLETION_PRICE = float(os.getenv("CHAT_ANALYTICS_COMPLETION_PRICE", "10.00"))
+CLIENT_FILENAME = re.compile(r'^(?P<time>\d{4}-\d{2}-\d{2})_\d{2}-\d{2}-\d{2}_conversation_(?P<user>.+)\.json$')
+ARCHIVE_FILES = (('server', 'chat_*.json'), ('server', 'history-*.jsonl*'), ('client', '*_conversation_*.json'))
+DIMENSIONS = ('by_user', 'by_day', 'by_source')
+
+
+class Conversation:
+    __slots__ = ('source', 'user_name', 'day', 'messages')
+
+    def __init__(self, source, user_name, day, messages):
+        self.source = source
+        self.user_name = user_name or 'unknown_user'
+        self.day = day or 'unknown'
+        self.messages = messages
+
+
+def read_conversations(path, source):
+    # Every conversation in one archive file, in file order
+    name = os.path.basename(path)
+    if name.startswith('history-'):
+        with open_segment(path) as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        yield Conversation(source, record.get('user_name'), (record.get('saved_at') or '')[:10],
+                                           record['messages'])
+            except EOFError:
+                # A block still being written, it is read on the next run
+                return
+    elif name.startswith('chat_'):
+        record = read_legacy_file(path)
+        yield Conversation(source, record['user_name'], (record['saved_at'] or '')[:10], record['messages'])
+    else:
+        match = CLIENT_FILENAME.match(name)
+        with open(path, 'r') as f:
+            messages = json.load(f)
+        yield Conversation(source, match and match.group('user'), match and match.group('time'), messages)
+
+
+def new_conversations(directories, files, full=False):
+    # Conversations not counted by an earlier run. `files` (path -> size, mtime and number of
+    # conversations counted) is updated as files are read.
+    for directory in directories:
+        for source, pattern in ARCHIVE_FILES:
+            for path in sorted(glob.glob(os.path.join(directory, pattern))):
+                key = os.path.realpath(path)
+                stat = os.stat(path)
+                seen = files.get(key) if not full else None
+                if seen and seen['size'] == stat.st_size and seen['mtime_ns'] == stat.st_mtime_ns:
+                    continue
+                skip = seen['conversations'] if seen else 0
+                counted = 0
+                try:
+                    for counted, conversation in enumerate(read_conversations(path, source), 1):
+                        if counted > skip:
+                            yield conversation
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"Skipping the rest of {path}: {e}", file=sys.stderr)
+                files[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "conversations": max(counted, skip)}
+
+
+def message_batches(conversations, batch_messages=BATCH_MESSAGES):
+    # (conversations, their message texts) in batches of about batch_messages texts
+    batch, texts = [], []
+    for conversation in conversations:
+        batch.append(conversation)
+        texts.extend(message.get('content') or "" for message in conversation.messages)
+        if len(texts) >= batch_messages:
+            yield batch, texts
+            batch, texts = [], []
+    if batch:
+        yield batch, texts
+
+
+# The worker process's tokenizer, loaded once by init_worker
+_encoding = None
+
+
+def init_worker(model_name=MODEL_NAME):
+    global _encoding
+    _encoding = LazyEncoding(model_name).get()
+
+
+def count_batch(texts):
+    # Token counts of a batch of texts. encode_ordinary_batch treats special tokens as plain text,
+    # like the API does for message contents.
+    if hasattr(_encoding, 'encode_ordinary_batch'):
+        return [len(tokens) for tokens in _encoding.encode_ordinary_batch(texts, num_threads=1)]
+    return [len(_encoding.encode(text)) for text in texts]
+
+
+def counted_batches(batches, pool, in_flight):
+    # (conversations, token counts) in order, with at most `in_flight` batches handed to the pool
+    # so the archive is never read far ahead of the workers
+    if pool is None:
+        for batch, texts in batches:
+            yield batch, count_batch(texts)
+        return
+    pending = deque()
+    for batch, texts in batches:
+        pending.append((batch, pool.submit(count_batch, texts)))
+        if len(pending) >= in_flight:
+            batch, future = pending.popleft()
+            yield batch, future.result()
+    while pending:
+        batch, future = pending.popleft()
+        yield batch, future.result()
+
+
+def empty_report():
+    return {"conversations": 0, "messages": 0, "by_user": {}, "by_day": {}, "by_source": {}, "by_role": {}}
+
+
+def add_conversation(report, conversation, counts):
+    prompt_tokens = completion_tokens = history_tokens = 0
+    for message, tokens in zip(conversation.messages, counts):
+        role = message.get('role', 'unknown')
+        role_totals = report['by_role'].setdefault(role, {"messages": 0, "tokens": 0})
+        role_totals['messages'] += 1
+        role_totals['tokens'] += tokens
+        if role == 'assistant':
+            prompt_tokens += history_tokens
+            completion_tokens += tokens
+        history_tokens += tokens
+    report['conversations'] += 1
+    report['messages'] += len(counts)
+    for dimension, key in zip(DIMENSIONS, (conversation.user_name, conversation.day, conversation.source)):
+        totals = report[dimension].setdefault(key, {"conversations": 0, "messages": 0, "prompt_tokens": 0,
+                                                    "completion_tokens": 0})
+        totals['conversations'] += 1
+        totals['messages'] += len(counts)
+        totals['prompt_tokens'] += prompt_tokens
+        totals['completion_tokens'] += completion_tokens
+
+
+def add_batch(report, batch, counts):
+    position = 0
+    for conversation in batch:
+        end = position + len(conversation.messages)
+        add_conversation(report, conversation, counts[position:end])
+        position = end
+
+
+def with_costs(report):
+    # The report with the estimated cost of every user, day and archive
+    priced = dict(report)
+    for dimension in DIMENSIONS:
+        priced[dimension] = {
+            key: dict(totals, cost_usd=round((totals['prompt_tokens'] * PROMPT_PRICE
+                                              + totals['completion_tokens'] * COMPLETION_PRICE) / 1e6, 4))
+            for key, totals in sorted(report[dimension].items())
+        }
+    return priced
+
+
+def load_state(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"files": {}, "report": empty_report()}
+
+
+def save_state(path, state):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(state, f, separators=(',', ':'))
+    os.replace(temp_path, path)
+
+
+def analyze(directories, state_path=None, workers=None, batch_messages=BATCH_MESSAGES, full=False):
+    # Count what is new in the archives and add it to the totals of the last run. Returns the
+    # totals and this run's throughput. The state is only saved once every batch is counted.
+    state = load_state(state_path) if state_path and not full else {"files": {}, "report": empty_report()}
+    report = state['report']
+    workers = os.cpu_count() if workers is None else workers
+    before = report['messages']
+    started = time.perf_counter()
+    batches = message_batches(new_conversations(directories, state['files'], full), batch_messages)
+    if workers:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as pool:
+            for batch, counts in counted_batches(batches, pool, in_flight=workers * 2):
+                add_batch(report, batch, counts)
+    else:
+        # On this process, for comparison
+        init_worker()
+        for batch, counts in counted_batches(batches, None, 0):
+            add_batch(report, batch, counts)
+    elapsed = time.perf_counter() - started
+    if state_path:
+        save_state(state_path, state)
+    messages = report['messages'] - before
+    cores = max(workers, 1)
+    run = {"messages": messages, "seconds": round(elapsed, 3), "workers": workers,
+           "messages_per_sec": round(messages / elapsed) if elapsed else None,
+           "messages_per_sec_per_core": round(messages / elapsed / cores) if elapsed else None}
+    return report, run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Token and cost report over the chat history archives")
+    parser.add_argument('--directories', nargs='+', default=DEFAULT_DIRECTORIES)
+    parser.add_argument('--state', default=DEFAULT_STATE_PATH, help="totals and files counted by earlier runs")
+    parser.add_argument('--workers', type=int, default=None, help="tokenizer processes, 0 to tokenize in this process (default: one per core)")
+    parser.add_argument('--batch-messages', type=int, default=BATCH_MESSAGES)
+    parser.add_argument('--full', action='store_true', help="ignore earlier runs and count everything again")
+    args = parser.parse_args()
+
+    report, run = analyze(args.directories, args.state, args.workers, args.batch_messages, args.full)
+    print(json.dumps(with_costs(report), indent=2))
+    print(f"Counted {run['messages']} new messages in {run['seconds']}s with {run['workers']} workers: "
+          f"{run['messages_per_sec']} messages/s, {run['messages_per_sec_per_core']} per core", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from history_writer import EXTENSIONS, decompress_block, read_legacy_file
+
+# SQLite index over the saved chat history. Every conversation written by the history writer
+# gets a row with its user, save time, size and the location of its line in a segment, so
+# conversations can be listed by user, time range or token total and loaded without scanning
+# the directory or parsing more than their own block. Files in the original
+# chat_<user>_<timestamp>.json format can be added with import_legacy() (see import_history.py).
+#
+# The /api/history endpoints list, export and resume any user's conversations, and user_name is
+# not authenticated, so the servers only serve them when run with CHAT_HISTORY_API=1.
+
+INDEX_FILENAME = 'index.sqlite3'
+DEFAULT_LIST_LIMIT = 50
+MAX_LIST_LIMIT = 1000
+# Export responses are written in chunks of this many conversations
+EXPORT_CHUNK_RECORDS = 100
+
+API_ENABLED = os.getenv("CHAT_HISTORY_API", "0") == "1"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY,
+    conversation_id TEXT NOT NULL UNIQUE,
+    user_name TEXT,
+    saved_at TEXT,
+    message_count INTEGER NOT NULL,
+    total_tokens INTEGER,
+    segment TEXT NOT NULL,
+    block_offset INTEGER NOT NULL,
+    block_length INTEGER NOT NULL,
+    line_offset INTEGER,
+    line_length INTEGER
+);
+CREATE INDEX IF NOT EXISTS conversations_user_time ON conversations (user_name, saved_at);
+CREATE INDEX IF NOT EXISTS conversations_time ON conversations (saved_at);
+CREATE INDEX IF NOT EXISTS conversations_tokens ON conversations (total_tokens);
+"""
+
+SUMMARY_COLUMNS = "conversation_id, user_name, saved_at, message_count, total_tokens"
+LOCATION_COLUMNS = "segment, block_offset, block_length, line_offset, line_length"
+SUMMARY_FIELDS = SUMMARY_COLUMNS.split(", ")
+
+
+class HistoryIndex:
+    def __init__(self, directory, filename=INDEX_FILENAME):
+        self.directory = directory
+        self.path = os.path.join(directory, filename)
+        os.makedirs(directory, exist_ok=True)
+        # sqlite3 connections can't be shared between threads, each thread opens its own
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            # WAL lets the request threads read while the writer thread (or another worker) commits
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def add_many(self, entries):
+        # entries: (record, segment, block_offset, block_length, line_offset, line_length)
+        rows = [(record["conversation_id"], record.get("user_name"), record.get("saved_at"),
+                 len(record["messages"]), record.get("total_tokens")) + tuple(location)
+                for record, *location in entries]
+        connection = self._connection()
+        with connection:
+            connection.executemany(
+                f"INSERT OR IGNORE INTO conversations ({SUMMARY_COLUMNS}, {LOCATION_COLUMNS}) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def list(self, user_name=None, since=None, until=None, min_tokens=None, max_tokens=None,
+             limit=DEFAULT_LIST_LIMIT):
+        # Newest first. since/until are ISO timestamps, the range is [since, until). The limit is
+        # clamped to 1..MAX_LIST_LIMIT, SQLite would read a negative one as no limit.
+        where, params = self._filters(user_name, since, until, min_tokens, max_tokens)
+        rows = self._connection().execute(
+            f"SELECT {SUMMARY_COLUMNS} FROM conversations {where} ORDER BY saved_at DESC, id DESC LIMIT ?",
+            params + [max(1, min(limit, MAX_LIST_LIMIT))])
+        return [dict(zip(SUMMARY_FIELDS, row)) for row in rows]
+
+    def get(self, conversation_id):
+        # The summary row of one conversation, or None
+        row = self._connection().execute(
+            f"SELECT {SUMMARY_COLUMNS} FROM conversations WHERE conversation_id = ?", (conversation_id,)).fetchone()
+        return dict(zip(SUMMARY_FIELDS, row)) if row else None
+
+    def load(self, conversation_id):
+        # The saved record ({"conversation_id","user_name","saved_at","messages",...}) or None
+        row = self._connection().execute(
+            f"SELECT {LOCATION_COLUMNS} FROM conversations WHERE conversation_id = ?",
+            (conversation_id,)).fetchone()
+        if row is None:
+            return None
+        record = self._read(row, {})
+        record.setdefault("conversation_id", conversation_id)
+        return record
+
+    def export(self, user_name=None, since=None, until=None, min_tokens=None, max_tokens=None):
+        # Every matching record, oldest first, read lazily so a large range never sits in memory
+        where, params = self._filters(user_name, since, until, min_tokens, max_tokens)
+        # A connection of its own, so the generator can be resumed from any thread (the async
+        # server advances it with asyncio.to_thread) and a long export holds no shared cursor
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        try:
+            cursor = connection.execute(
+                f"SELECT {LOCATION_COLUMNS}, conversation_id FROM conversations {where} ORDER BY saved_at, id",
+                params)
+            # Neighbouring conversations usually share a compressed block, keep the last one decoded
+            blocks = {}
+            for row in cursor:
+                record = self._read(row[:5], blocks)
+                record.setdefault("conversation_id", row[5])
+                yield record
+        finally:
+            connection.close()
+
+    def import_legacy(self, directory=None, count_tokens=None, batch_size=1000):
+        # Index chat_<user>_<timestamp>.json files in place, returns how many were added.
+        # Their ids are derived from the file name so running the import again adds nothing.
+        # count_tokens(messages) fills in the token totals the old files don't have.
+        directory = directory or self.directory
+        added = 0
+        batch = []
+        for path in sorted(glob.glob(os.path.join(directory, 'chat_*.json'))):
+            try:
+                record = read_legacy_file(path)
+            except (OSError, ValueError):
+                continue
+            name = os.path.relpath(path, self.directory)
+            if count_tokens is not None:
+                record["total_tokens"] = count_tokens(record["messages"])
+            record["conversation_id"] = hashlib.blake2b(name.encode('utf-8'), digest_size=16).hexdigest()
+            batch.append((record, name, 0, os.path.getsize(path), None, None))
+            if len(batch) >= batch_size:
+                added += self._add_counted(batch)
+                batch = []
+        if batch:
+            added += self._add_counted(batch)
+        return added
+
+    def _add_counted(self, entries):
+        connection = self._connection()
+        before = connection.total_changes
+        self.add_many(entries)
+        return connection.total_changes - before
+
+    def _filters(self, user_name, since, until, min_tokens, max_tokens):
+        clauses, params = [], []
+        for clause, value in (("user_name = ?", user_name), ("saved_at >= ?", since), ("saved_at < ?", until),
+                              ("total_tokens >= ?", min_tokens), ("total_tokens <= ?", max_tokens)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        return ("WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def _read(self, location, blocks):
+        segment, block_offset, block_length, line_offset, line_length = location
+        path = os.path.join(self.directory, segment)
+        if line_offset is None:
+            return read_legacy_file(path)
+        key = (segment, block_offset)
+        data = blocks.get(key)
+        if data is None:
+            with open(path, 'rb') as f:
+                f.seek(block_offset)
+                data = decompress_block(f.read(block_length), segment_compression(segment))
+            blocks.clear()
+            blocks[key] = data
+        return json.loads(data[line_offset:line_offset + line_length])
+
+
+def segment_compression(segment):
+    for compression, extension in EXTENSIONS.items():
+        if extension and segment.endswith(extension):
+            return compression
+    return None
+
+
+def filters_from_query(query):
+    # Query string arguments (user_name, since, until, min_tokens, max_tokens) as keyword
+    # arguments for list()/export(). Raises ValueError for a malformed number.
+    filters = {name: query.get(name) or None for name in ('user_name', 'since', 'until')}
+    for name in ('min_tokens', 'max_tokens'):
+        value = query.get(name)
+        filters[name] = int(value) if value not in (None, '') else None
+    return filters
+
+
+def resume_conversation_id(data):
+    # The conversation_id of a POST /api/history/resume body. Raises ValueError for a body that
+    # is not a JSON object with a string conversation_id.
+    if not isinstance(data, dict) or not isinstance(data.get('conversation_id'), str):
+        raise ValueError("The body must be a JSON object with a conversation_id string.")
+    return data['conversation_id']
+
+
+def export_chunks(records, compress=False):
+    # NDJSON bytes for a streamed export, gzip-encoded when compress is set. Each chunk is
+    # flushed through the compressor so the client receives data as the export progresses.
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if len(lines) >= EXPORT_CHUNK_RECORDS:
+            data = "".join(lines).encode('utf-8')
+            lines = []
+            yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else data
+    data = "".join(lines).encode('utf-8')
+    if compressor:
+        yield compressor.compress(data) + compressor.flush()
+    elif data:
+        yield data
+
+
+def accepts_gzip(accept_encoding):
+    return 'gzip' in (accept_encoding or '').lower()
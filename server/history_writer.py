@@ -0,0 +1,249 @@
+import atexit
+import glob
+import gzip
+import io
+import json
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+from chat_logging import get_logger
+
+try:
+    import zstandard
+except ImportError:  # Only needed for CHAT_HISTORY_COMPRESSION=zstd
+    zstandard = None
+
+# Saved conversations are handed to a bounded queue and a writer thread appends them as JSON
+# Lines to segment files (history-<time>-<pid>-<n>.jsonl[.gz|.zst]), rotating once a segment
+# reaches its size limit. fsync is done as a group commit at most every `fsync_interval`
+# seconds instead of once per conversation.
+#
+# Compressed segments hold one gzip member / zstd frame per batch, so a single conversation can
+# be read back by decompressing only its own block (see history_index.py).
+
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = 1.0
+DEFAULT_QUEUE_SIZE = 10000
+MAX_BATCH = 500
+EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+LEGACY_FILENAME = re.compile(r'^chat_(?P<user>.+)_(?P<time>\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\.json$')
+
+logger = get_logger("history")
+_STOP = object()
+
+
+def compress_block(data, compression):
+    if compression == 'gzip':
+        return gzip.compress(data)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def decompress_block(data, compression):
+    if compression == 'gzip':
+        return gzip.decompress(data)
+    if compression == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+class Segment:
+    # One open segment file, optionally compressed
+
+    def __init__(self, path, compression):
+        self.path = path
+        self.compression = compression
+        self.raw = open(path, 'ab')
+        self.bytes_written = self.raw.tell()
+
+    def write(self, data):
+        # Append one block and return its (offset, length) in the file
+        block = compress_block(data, self.compression)
+        offset = self.bytes_written
+        self.raw.write(block)
+        self.bytes_written += len(block)
+        return offset, len(block)
+
+    def sync(self):
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+
+    def close(self):
+        self.sync()
+        self.raw.close()
+
+
+class HistoryWriter:
+    def __init__(self, directory, compression=None, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 fsync_interval=DEFAULT_FSYNC_INTERVAL, queue_size=DEFAULT_QUEUE_SIZE, index=None):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unknown history compression: {compression}")
+        if compression == 'zstd' and zstandard is None:
+            raise RuntimeError("CHAT_HISTORY_COMPRESSION=zstd needs the 'zstandard' package")
+        self.directory = directory
+        self.compression = compression
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        # Optional HistoryIndex that gets a row for every conversation written
+        self.index = index
+        self.records_written = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._segment = None
+        self._segment_count = 0
+        self._last_sync = time.monotonic()
+        self._dirty = False
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, user_name, messages, block=True, conversation_id=None, total_tokens=None):
+        # Queue a finished conversation for writing and return its id. With block=False a full
+        # queue raises queue.Full.
+        record = {"conversation_id": conversation_id or uuid.uuid4().hex, "user_name": user_name,
+                  "saved_at": datetime.now().isoformat(timespec='seconds'), "total_tokens": total_tokens,
+                  "messages": messages}
+        self._queue.put(record, block=block)
+        return record["conversation_id"]
+
+    def stats(self):
+        return {"records_written": self.records_written, "queued": self._queue.qsize()}
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _open_segment(self):
+        self._segment_count += 1
+        name = (f"history-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._segment_count}"
+                f".jsonl{EXTENSIONS[self.compression]}")
+        return Segment(os.path.join(self.directory, name), self.compression)
+
+    def _write_batch(self, records):
+        lines = [(json.dumps(record, separators=(',', ':'), ensure_ascii=False) + "\n").encode('utf-8')
+                 for record in records]
+        if self._segment is None:
+            self._segment = self._open_segment()
+        segment = self._segment
+        block_offset, block_length = segment.write(b"".join(lines))
+        self.records_written += len(records)
+        self._dirty = True
+        if self.index is not None:
+            self._index_batch(segment, records, lines, block_offset, block_length)
+        if self._segment.bytes_written >= self.segment_bytes:
+            self._segment.close()
+            self._segment = None
+            self._dirty = False
+            self._last_sync = time.monotonic()
+
+    def _index_batch(self, segment, records, lines, block_offset, block_length):
+        entries = []
+        line_offset = 0
+        for record, line in zip(records, lines):
+            if self.compression is None:
+                # Uncompressed lines are addressed directly in the file
+                location = (block_offset + line_offset, len(line), 0, len(line))
+            else:
+                location = (block_offset, block_length, line_offset, len(line))
+            entries.append((record, os.path.basename(segment.path)) + location)
+            line_offset += len(line)
+        try:
+            self.index.add_many(entries)
+        except sqlite3.Error as e:
+            logger.error("Error indexing chat history: %s", e)
+
+    def _maybe_sync(self, force=False):
+        if self._dirty and self._segment is not None and \
+                (force or time.monotonic() - self._last_sync >= self.fsync_interval):
+            self._segment.sync()
+            self._dirty = False
+            self._last_sync = time.monotonic()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                # Wake up at least once per fsync interval so pending writes get committed
+                first = self._queue.get(timeout=self.fsync_interval or None)
+            except queue.Empty:
+                self._maybe_sync(force=True)
+                continue
+
+            batch = []
+            item = first
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= MAX_BATCH:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                try:
+                    self._write_batch(batch)
+                    self._maybe_sync()
+                except OSError as e:
+                    logger.error("Error writing chat history: %s", e)
+
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+
+def writer_from_env(directory, index=None):
+    compression = os.getenv("CHAT_HISTORY_COMPRESSION", "none").lower()
+    return HistoryWriter(
+        directory,
+        index=index,
+        compression=None if compression == 'none' else compression,
+        segment_bytes=int(float(os.getenv("CHAT_HISTORY_SEGMENT_MB", "64")) * 1024 * 1024),
+        fsync_interval=float(os.getenv("CHAT_HISTORY_FSYNC_MS", str(DEFAULT_FSYNC_INTERVAL * 1000))) / 1000,
+    )
+
+
+def open_segment(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f"Reading {path} needs the 'zstandard' package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True),
+                                encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+
+def read_legacy_file(path):
+    # A record for one of the original pretty-printed chat_<user>_<timestamp>.json files
+    match = LEGACY_FILENAME.match(os.path.basename(path))
+    with open(path, 'r') as f:
+        messages = json.load(f)
+    user_name = match.group('user') if match else None
+    saved_at = datetime.strptime(match.group('time'), '%Y-%m-%d_%H-%M-%S').isoformat() if match else None
+    return {"user_name": user_name, "saved_at": saved_at, "messages": messages}
+
+
+def iter_history(directory):
+    # Every saved conversation in the directory, from legacy per-file JSON and from segments
+    for path in sorted(glob.glob(os.path.join(directory, 'chat_*.json'))):
+        yield read_legacy_file(path)
+    for path in sorted(glob.glob(os.path.join(directory, 'history-*.jsonl*'))):
+        with open_segment(path) as f:
+            try:
+                for line in f:
+                    if line.strip():
+                        yield json.loads(line)
+            except EOFError:
+                # A block cut short by a crash while it was being written
+                logger.debug("Stopped at the unfinished end of %s", path)
@@ -0,0 +1,28 @@
+# Adds the existing chat_<user>_<timestamp>.json files to the chat history index so they can be
+# listed, resumed and exported like conversations saved by the history writer. The files are
+# indexed in place and the import can be run again safely.
+#
+# Usage (from the repository root): python server/import_history.py [--directory ./server/chat_history]
+import argparse
+import os
+import time
+from history_index import HistoryIndex
+from startup import LazyEncoding
+from token_counter import TokenCounter
+
+MODEL_NAME = "gpt-4o"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Index existing chat history files")
+    parser.add_argument('--directory', default=os.getenv("CHAT_HISTORY_DIR", './server/chat_history'))
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    token_counter = TokenCounter(LazyEncoding(MODEL_NAME))
+    added = HistoryIndex(args.directory).import_legacy(count_tokens=token_counter.count_messages)
+    print(f"Indexed {added} conversations in {time.perf_counter() - start_time:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import gc
+import os
+import threading
+import time
+import tracemalloc
+
+# tracemalloc reports from a running server, to find what keeps growing in a long-running
+# process (benchmarks/soak.py reads them during soak tests). Tracing slows every allocation and
+# takes memory of its own, so it only starts when the server runs with CHAT_TRACEMALLOC=1:
+#   POST /api/memory  {"baseline": true} takes the snapshot that later reports are compared with
+#   GET  /api/memory?limit=20  RSS, traced memory and the allocation sites that grew the most
+#                              since the baseline (the largest sites when there is none),
+#                              limit=0 for the totals only
+#
+# CHAT_TRACEMALLOC_FRAMES is the number of frames kept per allocation (default 1). With more,
+# sites are reported as whole tracebacks, which costs more but tells shared helpers' callers apart.
+
+ENABLED = os.getenv("CHAT_TRACEMALLOC", "0") == "1"
+FRAMES = int(os.getenv("CHAT_TRACEMALLOC_FRAMES", "1"))
+DEFAULT_LIMIT = 20
+# tracemalloc's own bookkeeping and the import machinery are not the server's memory
+_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+def rss_bytes():
+    # Resident set size of this process, None where there is no /proc
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def format_site(traceback):
+    # "package/module.py:123", innermost frame first
+    return " < ".join(f"{os.path.join(*frame.filename.split(os.sep)[-2:])}:{frame.lineno}"
+                      for frame in reversed(traceback))
+
+
+class MemoryTracker:
+    def __init__(self, frames=FRAMES):
+        self.frames = frames
+        self._baseline = None
+        self._baseline_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def tracing(self):
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def _snapshot(self):
+        # Unreachable cycles would otherwise show up as growth until the next collection
+        gc.collect()
+        return tracemalloc.take_snapshot().filter_traces(_FILTERS)
+
+    def set_baseline(self):
+        snapshot = self._snapshot()
+        with self._lock:
+            self._baseline = snapshot
+            self._baseline_at = time.time()
+
+    def status(self):
+        traced, peak = tracemalloc.get_traced_memory()
+        return {"tracing": self.tracing, "frames": self.frames, "rss_bytes": rss_bytes(),
+                "traced_bytes": traced, "peak_traced_bytes": peak,
+                "tracemalloc_overhead_bytes": tracemalloc.get_tracemalloc_memory(),
+                "baseline_at": self._baseline_at}
+
+    def report(self, limit=DEFAULT_LIMIT):
+        if not self.tracing or not limit:
+            # limit=0 skips the snapshot, for frequent polling of the totals
+            return dict(self.status(), sites=[])
+        snapshot = self._snapshot()
+        with self._lock:
+            baseline = self._baseline
+        key_type = 'traceback' if self.frames > 1 else 'lineno'
+        if baseline is None:
+            stats = snapshot.statistics(key_type)[:limit]
+            sites = [{"site": format_site(stat.traceback), "size": stat.size, "count": stat.count}
+                     for stat in stats]
+        else:
+            stats = sorted(snapshot.compare_to(baseline, key_type), key=lambda stat: stat.size_diff, reverse=True)
+            sites = [{"site": format_site(stat.traceback), "size": stat.size, "count": stat.count,
+                      "size_diff": stat.size_diff, "count_diff": stat.count_diff}
+                     for stat in stats[:limit] if stat.size_diff > 0]
+        return dict(self.status(), sites=sites)
+
+    def configure(self, settings):
+        # Apply a POST /api/memory body and return the new status, ValueError if it is invalid
+        if not isinstance(settings, dict):
+            raise ValueError("The body must be a JSON object.")
+        for name in ("baseline", "reset_peak"):
+            if not isinstance(settings.get(name, False), bool):
+                raise ValueError(f"{name} must be true or false.")
+        if settings.get("reset_peak"):
+            tracemalloc.reset_peak()
+        if settings.get("baseline"):
+            self.set_baseline()
+        return self.status()
+
+
+memory_tracker = MemoryTracker()
+if ENABLED:
+    memory_tracker.start()
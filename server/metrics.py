@@ -0,0 +1,218 @@
+import bisect
+import re
+import threading
+import time
+
+# Process-wide metrics in the Prometheus text format, served at GET /metrics. Hot paths only
+# bump a counter or a histogram bucket under a short lock, the text is built when scraped.
+# Stats that already exist elsewhere (admission, rate limits, hedging) are read at scrape time
+# through register_stats().
+
+# Seconds, from tokenizing a message to a long stream
+STAGE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+RATE_BUCKETS = (5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_metrics = []
+_stats_sources = []
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.value = 0
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge",
+                f"{self.name} {format_value(self.value)}"]
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((label_values, list(counts), total) for label_values, (counts, total) in self._series.items())
+        for label_values, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class StageTimer:
+    # with stage('tokenize'): ... records the block's duration in chat_stage_seconds
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.observe(time.perf_counter() - self.started, self.name)
+        return False
+
+
+def stage(name):
+    return StageTimer(name)
+
+
+def metric_name(text):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', text)
+
+
+def register_stats(prefix, stats, exclude=()):
+    # Export the numbers in stats() (nested dicts flattened) as gauges named chat_<prefix>_<key>
+    _stats_sources.append((prefix, stats, set(exclude)))
+
+
+def flatten_stats(prefix, values, exclude):
+    for key, value in values.items():
+        if key in exclude:
+            continue
+        name = f"{prefix}_{metric_name(key)}"
+        if isinstance(value, dict):
+            yield from flatten_stats(name, value, exclude)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+        elif isinstance(value, bool):
+            yield name, int(value)
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for prefix, stats, exclude in _stats_sources:
+        for name, value in flatten_stats(f"chat_{prefix}", stats(), exclude):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram("chat_stage_seconds", "Time spent in each stage of a chat turn.", labels=("stage",))
+REQUEST_SECONDS = Histogram("chat_request_seconds", "Time from request start to the last byte of the answer.",
+                            labels=("endpoint",))
+REQUESTS = Counter("chat_requests_total", "Requests answered, by endpoint and status.", labels=("endpoint", "status"))
+UPSTREAM_TOKENS = Counter("chat_upstream_tokens_total", "Tokens reported by the upstream usage.", labels=("kind",))
+STREAM_TOKENS_PER_SECOND = Histogram("chat_stream_tokens_per_second",
+                                     "Completion tokens per second of upstream streams, after the first token.",
+                                     buckets=RATE_BUCKETS)
+ACTIVE_STREAMS = Gauge("chat_active_streams", "Responses currently being streamed.")
+
+
+def time_flask_sessions(app):
+    # Record how long Flask takes to load and save each session, whatever its backend
+    interface = app.session_interface
+    open_session, save_session = interface.open_session, interface.save_session
+
+    def timed_open_session(*args):
+        with stage('session_load'):
+            return open_session(*args)
+
+    def timed_save_session(*args):
+        with stage('session_save'):
+            return save_session(*args)
+
+    interface.open_session = timed_open_session
+    interface.save_session = timed_save_session
+
+
+def instrument_flask(app):
+    # Count every request by endpoint and status and time the ones that are not streamed, a
+    # streamed response records its own duration when the stream ends. Call right after the
+    # session interface is configured, so these hooks run first.
+    from flask import g, request
+
+    @app.before_request
+    def start_request_timer():
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        endpoint = request.endpoint or "unknown"
+        REQUESTS.inc(1, endpoint, str(response.status_code))
+        started = g.get('request_started')
+        if started is not None and not response.is_streamed:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint)
+        return response
+
+    time_flask_sessions(app)
+
+
+def record_usage(usage, first_token_at=None):
+    # Count the tokens of a finished call, and its streaming rate when it was streamed
+    UPSTREAM_TOKENS.inc(usage.prompt_tokens, "prompt")
+    UPSTREAM_TOKENS.inc(usage.completion_tokens, "completion")
+    if first_token_at is not None:
+        elapsed = time.perf_counter() - first_token_at
+        if elapsed > 0:
+            STREAM_TOKENS_PER_SECOND.observe(usage.completion_tokens / elapsed)
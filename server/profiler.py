@@ -0,0 +1,113 @@
+import math
+import os
+import sys
+import threading
+from collections import Counter
+
+# Sampling profiler that can be switched on and off while a server runs. A background thread
+# records the stack of every other thread every few milliseconds, and the counts are returned in
+# the collapsed-stack format ("frame;frame;frame count" per line) that flamegraph.pl and
+# speedscope read. Nothing runs while it is stopped.
+#
+# The servers only expose it when CHAT_PROFILER=1:
+#   POST /api/profiler  {"running": true, "interval_ms": 5} starts it, {"running": false} stops it
+#   GET  /api/profiler  returns the collapsed stacks collected so far
+
+DEFAULT_INTERVAL = 0.005
+# Allowed sampling intervals in milliseconds, shorter ones would keep a core busy sampling
+MIN_INTERVAL_MS = 1
+MAX_INTERVAL_MS = 10000
+MAX_DEPTH = 64
+# Distinct stacks kept, further new stacks are counted as dropped
+MAX_STACKS = 20000
+
+ENABLED = os.getenv("CHAT_PROFILER", "0") == "1"
+
+
+def collapse(frame):
+    names = []
+    while frame is not None and len(names) < MAX_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def parse_interval(interval_ms):
+    # Seconds between samples from an interval_ms setting
+    if isinstance(interval_ms, bool) or not isinstance(interval_ms, (int, float)) or math.isnan(interval_ms) \
+            or not MIN_INTERVAL_MS <= interval_ms <= MAX_INTERVAL_MS:
+        raise ValueError(f"interval_ms must be a number from {MIN_INTERVAL_MS} to {MAX_INTERVAL_MS}.")
+    return interval_ms / 1000
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self.interval = DEFAULT_INTERVAL
+        self.samples = 0
+        self.dropped = 0
+        self.stacks = Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval=DEFAULT_INTERVAL, reset=True):
+        with self._lock:
+            if self.running:
+                return
+            if reset:
+                self.stacks.clear()
+                self.samples = 0
+                self.dropped = 0
+            self.interval = interval
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, frame in frames.items():
+                    if thread_id == own_id:
+                        continue
+                    stack = collapse(frame)
+                    if stack in self.stacks or len(self.stacks) < MAX_STACKS:
+                        self.stacks[stack] += 1
+                    else:
+                        self.dropped += 1
+                self.samples += 1
+
+    def collapsed(self):
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def status(self):
+        with self._lock:
+            return {"running": self.running, "interval_ms": round(self.interval * 1000, 3),
+                    "samples": self.samples, "stacks": len(self.stacks), "dropped": self.dropped}
+
+    def configure(self, settings):
+        # Apply a POST /api/profiler body and return the new status, ValueError if it is invalid
+        if not isinstance(settings, dict):
+            raise ValueError("The body must be a JSON object.")
+        if settings.get("running"):
+            self.start(parse_interval(settings.get("interval_ms", DEFAULT_INTERVAL * 1000)),
+                       reset=settings.get("reset", True))
+        elif "running" in settings:
+            self.stop()
+        return self.status()
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL_SECONDS = 3600
+# Replayed responses are sent in pieces of roughly this many characters
+REPLAY_CHUNK_CHARS = 16
+
+
+def cache_key(model, params, messages):
+    # Canonical hash of everything that determines the completion
+    payload = json.dumps({"model": model, "params": params, "messages": messages},
+                         sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def replay_chunks(text, chunk_chars=REPLAY_CHUNK_CHARS):
+    # Split a cached response into stream-sized pieces, breaking after whitespace where possible
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_chars, len(text))
+        if end < len(text):
+            space = text.rfind(' ', start, end)
+            if space > start:
+                end = space + 1
+        yield text[start:end]
+        start = end
+
+
+class ResponseCache:
+    # Completion cache with an in-process LRU tier and an optional on-disk tier. Entries expire
+    # after `ttl_seconds` in both tiers. Each disk entry is a small JSON file named after its key.
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS,
+                 directory=None, max_disk_entries=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries or max_entries * 10
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+        self._disk = OrderedDict()
+        self._lock = Lock()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            # Rebuild the disk tier's LRU order from file modification times
+            entries = []
+            for name in os.listdir(directory):
+                if name.endswith('.json'):
+                    entries.append((os.path.getmtime(os.path.join(directory, name)), name[:-5]))
+            for _, key in sorted(entries):
+                self._disk[key] = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _remove_disk(self, key):
+        self._disk.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, text = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return text
+                del self._memory[key]
+
+            if self.directory and key in self._disk:
+                try:
+                    with open(self._path(key), 'r') as f:
+                        entry = json.load(f)
+                except (OSError, ValueError):
+                    entry = None
+                if entry is not None and entry['expires_at'] > now:
+                    self._disk.move_to_end(key)
+                    self._memory[key] = (entry['expires_at'], entry['text'])
+                    if len(self._memory) > self.max_entries:
+                        self._memory.popitem(last=False)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return entry['text']
+                self._remove_disk(key)
+
+            self.misses += 1
+            return None
+
+    def put(self, key, text):
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._memory[key] = (expires_at, text)
+            self._memory.move_to_end(key)
+            if len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+            if self.directory:
+                with open(self._path(key), 'w') as f:
+                    json.dump({"expires_at": expires_at, "text": text}, f)
+                self._disk[key] = None
+                self._disk.move_to_end(key)
+                while len(self._disk) > self.max_disk_entries:
+                    self._remove_disk(next(iter(self._disk)))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "memory_entries": len(self._memory),
+                "disk_entries": len(self._disk),
+            }
+
+
+def cache_from_env():
+    # Build the response cache from CHAT_RESPONSE_CACHE* variables, or None when it is not enabled
+    if os.getenv("CHAT_RESPONSE_CACHE", "0").lower() not in ("1", "true", "yes"):
+        return None
+    return ResponseCache(
+        max_entries=int(os.getenv("CHAT_RESPONSE_CACHE_SIZE", str(DEFAULT_MAX_ENTRIES))),
+        ttl_seconds=float(os.getenv("CHAT_RESPONSE_CACHE_TTL", str(DEFAULT_TTL_SECONDS))),
+        directory=os.getenv("CHAT_RESPONSE_CACHE_DIR") or None,
+    )
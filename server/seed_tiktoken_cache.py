@@ -0,0 +1,29 @@
+# Downloads the tokenizer's BPE file into a local cache directory that can be shipped with a
+# deployment, so the servers start without network access (see startup.py). Run it once on a
+# machine with internet access and copy the directory to the servers.
+#
+# Usage (from the repository root): python server/seed_tiktoken_cache.py [--directory server/tiktoken_cache]
+import argparse
+import os
+from startup import DEFAULT_TIKTOKEN_CACHE_DIR
+
+MODEL_NAME = "gpt-4o"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Seed a local tiktoken cache")
+    parser.add_argument('--directory', default=DEFAULT_TIKTOKEN_CACHE_DIR)
+    parser.add_argument('--models', nargs='+', default=[MODEL_NAME])
+    args = parser.parse_args()
+
+    os.makedirs(args.directory, exist_ok=True)
+    os.environ["TIKTOKEN_CACHE_DIR"] = args.directory
+    import tiktoken
+    for model_name in args.models:
+        encoding = tiktoken.encoding_for_model(model_name)
+        print(f"Cached {encoding.name} for {model_name}")
+    print(f"Set CHAT_TIKTOKEN_CACHE_DIR={os.path.abspath(args.directory)} or ship the directory as server/tiktoken_cache")
+
+
+if __name__ == '__main__':
+    main()
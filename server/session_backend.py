@@ -0,0 +1,184 @@
+import json
+import os
+import re
+import secrets
+import time
+from collections import OrderedDict
+from threading import Lock, get_ident
+from chat_logging import get_logger
+
+try:
+    import redis
+except ImportError:  # Only needed for CHAT_SESSION_BACKEND=redis
+    redis = None
+
+# Shared state for running several server processes (on one or several hosts) behind a load
+# balancer: a stable session signing key, and where sessions and live conversations are kept.
+#
+# Configuration:
+#   CHAT_SECRET_KEY       session signing key, must be the same on every worker. Without it a
+#                         key is generated once and kept in CHAT_SECRET_KEY_FILE (default
+#                         server/.secret_key), which only covers the workers of one host.
+#   CHAT_SESSION_BACKEND  filesystem or redis (the async server also has memory, its default)
+#   CHAT_SESSION_DIR      directory of the filesystem backend, a shared mount for several hosts
+#   CHAT_REDIS_URL        Redis (or Redis-protocol) server of the redis backend (default redis://localhost:6379/0)
+#   CHAT_SESSION_TTL      seconds an idle session or conversation is kept (default 86400)
+
+DEFAULT_SECRET_KEY_FILE = os.path.join(os.path.dirname(__file__), '.secret_key')
+DEFAULT_SESSION_DIR = os.path.join(os.path.dirname(__file__), 'sessions')
+SESSION_TTL = int(os.getenv("CHAT_SESSION_TTL", "86400"))
+# Session ids come from a client cookie, only these are used in keys and file names
+VALID_SESSION_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+logger = get_logger("session")
+
+
+def secret_key_from_env():
+    secret_key = os.getenv("CHAT_SECRET_KEY")
+    if secret_key:
+        return secret_key
+    path = os.getenv("CHAT_SECRET_KEY_FILE", DEFAULT_SECRET_KEY_FILE)
+    try:
+        # O_EXCL so concurrently starting workers agree on the key written by the first one
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'r') as f:
+            secret_key = f.read().strip()
+        if secret_key:
+            return secret_key
+        # Another worker created the file but hasn't written it yet
+        time.sleep(0.1)
+        with open(path, 'r') as f:
+            return f.read().strip()
+    secret_key = secrets.token_hex(32)
+    with os.fdopen(fd, 'w') as f:
+        f.write(secret_key)
+    logger.warning("CHAT_SECRET_KEY is not set, generated a key in %s. Set CHAT_SECRET_KEY when "
+                   "running on more than one host.", path)
+    return secret_key
+
+
+def session_backend_name(default='filesystem'):
+    return os.getenv("CHAT_SESSION_BACKEND", default).lower()
+
+
+def redis_from_env():
+    if redis is None:
+        raise RuntimeError("CHAT_SESSION_BACKEND=redis needs the 'redis' package")
+    return redis.Redis.from_url(os.getenv("CHAT_REDIS_URL", "redis://localhost:6379/0"))
+
+
+def configure_flask_session(app):
+    # Flask-Session settings for the default server
+    if session_backend_name() == 'redis':
+        app.config['SESSION_TYPE'] = 'redis'
+        app.config['SESSION_REDIS'] = redis_from_env()
+    else:
+        app.config['SESSION_TYPE'] = 'filesystem'
+        app.config['SESSION_FILE_DIR'] = os.getenv("CHAT_SESSION_DIR", DEFAULT_SESSION_DIR)
+    app.config['PERMANENT_SESSION_LIFETIME'] = SESSION_TTL
+
+
+class JsonCodec:
+    # Sessions as compact JSON, for stores without a codec of their own
+    @staticmethod
+    def dumps(chat_session):
+        return json.dumps(chat_session, separators=(',', ':')).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class MemorySessionStore:
+    # Sessions of one process, least recently used first. Nothing is shared between workers.
+    blocking = False
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = Lock()
+
+    def load(self, session_id):
+        with self._lock:
+            chat_session = self._sessions.get(session_id)
+            if chat_session is not None:
+                self._sessions.move_to_end(session_id)
+            return chat_session
+
+    def save(self, session_id, chat_session):
+        with self._lock:
+            self._sessions[session_id] = chat_session
+            self._sessions.move_to_end(session_id)
+            if len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+
+class FileSessionStore:
+    # One file per session, replaced atomically so readers never see a partial write
+    blocking = True
+
+    def __init__(self, directory, ttl=SESSION_TTL, codec=JsonCodec):
+        self.directory = directory
+        self.ttl = ttl
+        self.codec = codec
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id):
+        return os.path.join(self.directory, f"{session_id}.session")
+
+    def load(self, session_id):
+        if not VALID_SESSION_ID.match(session_id or ''):
+            return None
+        path = self._path(session_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                return self.codec.loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def save(self, session_id, chat_session):
+        path = self._path(session_id)
+        temp_path = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(self.codec.dumps(chat_session))
+        os.replace(temp_path, path)
+
+
+class RedisSessionStore:
+    blocking = True
+
+    def __init__(self, client, ttl=SESSION_TTL, prefix="chat:session:", codec=JsonCodec):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.codec = codec
+
+    def load(self, session_id):
+        data = self.client.get(self.prefix + session_id)
+        return self.codec.loads(data) if data else None
+
+    def save(self, session_id, chat_session):
+        self.client.set(self.prefix + session_id, self.codec.dumps(chat_session), ex=self.ttl)
+
+
+def session_store_from_env(max_sessions, codec=JsonCodec):
+    # Session store of the async server. The memory store keeps the session objects themselves,
+    # the shared stores write them with `codec`.
+    backend = session_backend_name(default='memory')
+    if backend == 'redis':
+        return RedisSessionStore(redis_from_env(), codec=codec)
+    if backend == 'filesystem':
+        return FileSessionStore(os.getenv("CHAT_SESSION_DIR", DEFAULT_SESSION_DIR), codec=codec)
+    return MemorySessionStore(max_sessions)
+
+
+def conversation_store_from_env(directory):
+    # Live conversations of the default server
+    from conversation_store import ConversationStore, RedisConversationStore
+    if session_backend_name() == 'redis':
+        return RedisConversationStore(redis_from_env(), SESSION_TTL)
+    return ConversationStore(os.getenv("CHAT_CONVERSATION_DIR", directory), ttl=SESSION_TTL)
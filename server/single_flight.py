@@ -0,0 +1,221 @@
+import asyncio
+import threading
+
+# Request coalescing for identical in-flight upstream calls. Callers that arrive with the same
+# key while a call is running share its result instead of making their own upstream request.
+
+
+class SingleFlight:
+    # Thread-based: the first caller for a key runs the call, the others wait for its result
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = {"done": threading.Event(), "result": None, "error": None}
+                self._in_flight[key] = call
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call['done'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call['done'].set()
+        return call['result']
+
+
+class SharedStream:
+    # Chunks of one upstream stream, buffered so subscribers that join late still see every chunk
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        # Set when the last subscriber leaves early, the reading thread then closes the upstream
+        self.cancelled = False
+        self._cond = threading.Condition()
+
+    def publish(self, chunk):
+        with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            if not self.done:
+                self.done = True
+                self.error = error
+            self._cond.notify_all()
+
+    def subscribe(self):
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.chunks) and not self.done:
+                    self._cond.wait()
+                pending = self.chunks[index:]
+                done = self.done
+            for chunk in pending:
+                yield chunk
+            index += len(pending)
+            if done and index >= len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class StreamCoalescer:
+    # Thread-based fan-out: one upstream stream per key, read on a background thread, with its
+    # chunks delivered to every subscriber. `start` returns an iterator of chunks. When the last
+    # subscriber goes away before the stream is done, the upstream stream is closed.
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._streams = {}
+
+    def subscribe(self, key, start):
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is None:
+                stream = SharedStream()
+                self._streams[key] = stream
+                self.calls += 1
+                threading.Thread(target=self._run, args=(key, stream, start), daemon=True).start()
+            else:
+                self.shared += 1
+            stream.subscribers += 1
+        try:
+            yield from stream.subscribe()
+        finally:
+            with self._lock:
+                stream.subscribers -= 1
+                if stream.subscribers == 0 and not stream.done:
+                    if self._streams.get(key) is stream:
+                        del self._streams[key]
+                    stream.cancelled = True
+
+    def _run(self, key, stream, start):
+        error = None
+        chunks = start()
+        try:
+            for chunk in chunks:
+                if stream.cancelled:
+                    error = ConnectionAbortedError("Upstream stream cancelled, no subscribers left.")
+                    break
+                stream.publish(chunk)
+        except Exception as e:
+            error = e
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            with self._lock:
+                if self._streams.get(key) is stream:
+                    del self._streams[key]
+            stream.finish(error)
+
+
+class AsyncSharedStream:
+    # Event-loop version of SharedStream that also tracks how many subscribers are still reading
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.task = None
+        self._cond = asyncio.Condition()
+
+    async def publish(self, chunk):
+        async with self._cond:
+            self.chunks.append(chunk)
+            self._cond.notify_all()
+
+    async def finish(self, error=None):
+        async with self._cond:
+            if not self.done:
+                self.done = True
+                self.error = error
+            self._cond.notify_all()
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            async with self._cond:
+                await self._cond.wait_for(lambda: index < len(self.chunks) or self.done)
+                pending = self.chunks[index:]
+                done = self.done
+            for chunk in pending:
+                yield chunk
+            index += len(pending)
+            if done and index >= len(self.chunks):
+                if self.error is not None:
+                    raise self.error
+                return
+
+
+class AsyncStreamCoalescer:
+    # Event-loop fan-out: one upstream stream per key, read by a task, with its chunks delivered
+    # to every subscriber. `start` returns an async iterator of chunks. When the last subscriber
+    # goes away before the stream is done, the upstream task is cancelled.
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._streams = {}
+
+    async def subscribe(self, key, start):
+        stream = self._streams.get(key)
+        if stream is None:
+            stream = AsyncSharedStream()
+            self._streams[key] = stream
+            self.calls += 1
+            stream.task = asyncio.create_task(self._run(key, stream, start))
+        else:
+            self.shared += 1
+
+        stream.subscribers += 1
+        try:
+            async for chunk in stream.subscribe():
+                yield chunk
+        finally:
+            stream.subscribers -= 1
+            if stream.subscribers == 0 and not stream.done:
+                if self._streams.get(key) is stream:
+                    del self._streams[key]
+                stream.task.cancel()
+
+    async def _run(self, key, stream, start):
+        error = None
+        try:
+            async for chunk in start():
+                await stream.publish(chunk)
+        except asyncio.CancelledError:
+            error = ConnectionAbortedError("Upstream stream cancelled, no subscribers left.")
+        except Exception as e:
+            error = e
+        finally:
+            if self._streams.get(key) is stream:
+                del self._streams[key]
+            await stream.finish(error)
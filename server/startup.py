@@ -0,0 +1,148 @@
+import asyncio
+import os
+import threading
+import time
+from chat_logging import get_logger
+
+# Startup for the chat servers. The tokenizer is loaded on a background thread instead of at
+# import time, from a pre-seeded local BPE cache when one is available (tiktoken otherwise
+# downloads the file, which stalls or fails on hosts without internet access). A warmup then
+# tokenizes the system context and opens an upstream connection, and the server only reports
+# ready once it is done.
+#
+# Configuration:
+#   CHAT_TIKTOKEN_CACHE_DIR  directory with the cached BPE files (default server/tiktoken_cache
+#                            when it exists, see seed_tiktoken_cache.py)
+#   CHAT_WARMUP_UPSTREAM     0 to skip opening an upstream connection during warmup
+
+DEFAULT_TIKTOKEN_CACHE_DIR = os.path.join(os.path.dirname(__file__), 'tiktoken_cache')
+WARMUP_UPSTREAM = os.getenv("CHAT_WARMUP_UPSTREAM", "1") != "0"
+
+logger = get_logger("startup")
+
+
+def configure_tiktoken_cache():
+    # tiktoken reads TIKTOKEN_CACHE_DIR when it loads a BPE file, an explicit setting wins
+    directory = os.getenv("CHAT_TIKTOKEN_CACHE_DIR")
+    if directory is None and os.path.isdir(DEFAULT_TIKTOKEN_CACHE_DIR):
+        directory = DEFAULT_TIKTOKEN_CACHE_DIR
+    if directory and "TIKTOKEN_CACHE_DIR" not in os.environ:
+        os.environ["TIKTOKEN_CACHE_DIR"] = directory
+    return os.environ.get("TIKTOKEN_CACHE_DIR")
+
+
+class ApproximateEncoding:
+    # Used when the tokenizer can't be loaded, estimates 4 characters per token
+
+    def encode(self, text):
+        return range((len(text) + 3) // 4)
+
+
+class LazyEncoding:
+    # Stands in for a tiktoken Encoding. start() loads it on a background thread, the first
+    # encode() waits for the load to finish.
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.load_seconds = None
+        self._encoding = None
+        self._thread = None
+        self._loaded = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._load, name="tokenizer-load", daemon=True)
+                self._thread.start()
+        return self
+
+    def _load(self):
+        start_time = time.perf_counter()
+        try:
+            import tiktoken
+            cache_dir = configure_tiktoken_cache()
+            self._encoding = tiktoken.encoding_for_model(self.model_name)
+            logger.info("Loaded tokenizer for %s in %.0f ms (cache: %s)", self.model_name,
+                        (time.perf_counter() - start_time) * 1000, cache_dir or "tiktoken default")
+        except Exception as e:
+            logger.error("Error loading tokenizer for %s, token counts are estimated: %s", self.model_name, e)
+            self._encoding = ApproximateEncoding()
+        finally:
+            self.load_seconds = time.perf_counter() - start_time
+            self._loaded.set()
+
+    def is_loaded(self):
+        return self._loaded.is_set()
+
+    def get(self):
+        self.start()
+        self._loaded.wait()
+        return self._encoding
+
+    def encode(self, text):
+        return self.get().encode(text)
+
+
+class Warmup:
+    # Runs named startup steps once and records how long each took. Steps that fail are logged
+    # and skipped, a slow or unreachable upstream never keeps the server from starting.
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.timings = {}
+        self.ready_seconds = None
+        self._created = time.perf_counter()
+        self._done = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.run, name="warmup", daemon=True).start()
+        return self
+
+    def run(self):
+        for name, step in self.steps:
+            start_time = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                logger.warning("Warmup step %s failed: %s", name, e)
+            self.timings[name] = time.perf_counter() - start_time
+        self._finish()
+
+    async def run_async(self):
+        # Coroutine steps run on the loop, the others on a worker thread
+        for name, step in self.steps:
+            start_time = time.perf_counter()
+            try:
+                if asyncio.iscoroutinefunction(step):
+                    await step()
+                else:
+                    await asyncio.to_thread(step)
+            except Exception as e:
+                logger.warning("Warmup step %s failed: %s", name, e)
+            self.timings[name] = time.perf_counter() - start_time
+        self._finish()
+
+    def _finish(self):
+        self.ready_seconds = time.perf_counter() - self._created
+        self._done.set()
+        logger.info("Ready %.0f ms after startup (%s)", self.ready_seconds * 1000,
+                    ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.timings.items()))
+
+    def is_ready(self):
+        return self._done.is_set()
+
+    def status(self):
+        return {
+            "ready": self.is_ready(),
+            "ready_ms": round(self.ready_seconds * 1000, 1) if self.ready_seconds is not None else None,
+            "steps_ms": {name: round(seconds * 1000, 1) for name, seconds in self.timings.items()},
+        }
+
+
+def warmup_steps(encoding, system_context, open_upstream):
+    # The tokenizer, then the system context's token counts, then an upstream connection
+    steps = [("tokenizer", encoding.get), ("system_context", system_context.get)]
+    if WARMUP_UPSTREAM:
+        steps.append(("upstream", open_upstream))
+    return steps
@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+
+# Flush policy and wire framing for streamed responses. Upstream deltas are often a single
+# token, so instead of one write per delta they are coalesced and flushed once enough bytes
+# have built up or the oldest pending delta has waited long enough.
+
+DEFAULT_FLUSH_BYTES = 256
+DEFAULT_FLUSH_MS = 40
+
+
+class FlushPolicy:
+    # max_bytes=0 and max_delay=0 flush every delta as soon as it arrives
+
+    def __init__(self, max_bytes=DEFAULT_FLUSH_BYTES, max_delay=DEFAULT_FLUSH_MS / 1000, flush_first=True):
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        # The first delta goes out immediately so coalescing never delays the first token
+        self.flush_first = flush_first
+
+
+class DeltaCoalescer:
+    def __init__(self, policy, clock=time.monotonic):
+        self.policy = policy
+        self.clock = clock
+        self.flushes = 0
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+
+    def add(self, text):
+        # Buffer a delta and return the text to write now, or None to keep waiting
+        if not text:
+            return None
+        now = self.clock()
+        if self._pending_since is None:
+            self._pending_since = now
+        self._pending.append(text)
+        self._pending_bytes += len(text.encode('utf-8'))
+
+        if (self.flushes == 0 and self.policy.flush_first) \
+                or self._pending_bytes >= self.policy.max_bytes \
+                or now - self._pending_since >= self.policy.max_delay:
+            return self.flush()
+        return None
+
+    def time_until_due(self):
+        # Seconds until the pending text must be flushed, or None when nothing is pending
+        if self._pending_since is None:
+            return None
+        return max(0.0, self._pending_since + self.policy.max_delay - self.clock())
+
+    def flush(self):
+        if not self._pending:
+            return None
+        text = "".join(self._pending)
+        self._pending = []
+        self._pending_bytes = 0
+        self._pending_since = None
+        self.flushes += 1
+        return text
+
+
+class TimedCoalescer:
+    # A DeltaCoalescer for a thread that blocks on the upstream iterator. When the upstream
+    # stalls, no new delta arrives to trigger the flush, so a timer writes the pending text once
+    # it has waited max_delay. The async server gets the same effect from time_until_due() and
+    # asyncio.wait_for.
+
+    def __init__(self, policy, write):
+        self.coalescer = DeltaCoalescer(policy)
+        # Called with each flushed text, under the lock, so writes stay in order
+        self.write = write
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def flushes(self):
+        return self.coalescer.flushes
+
+    def add(self, text):
+        with self._lock:
+            flushed = self.coalescer.add(text)
+            if flushed:
+                self.write(flushed)
+            due = self.coalescer.time_until_due()
+            if due is not None and self._timer is None:
+                self._timer = threading.Timer(due, self._flush_due)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_due(self):
+        # May run early for text buffered after an earlier flush, never late
+        with self._lock:
+            self._timer = None
+            flushed = self.coalescer.flush()
+            if flushed:
+                self.write(flushed)
+
+    def flush(self):
+        # Write whatever is pending now, at the end of the stream
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            flushed = self.coalescer.flush()
+            if flushed:
+                self.write(flushed)
+
+
+class NdjsonFramer:
+    # The original framing: one {"choices":[{"delta":...}]} JSON object per line
+    content_type = 'application/json'
+
+    def delta(self, text, chunk=None):
+        # Resumable streams number their chunks, a reconnecting client resumes after the last one
+        payload = {"choices": [{"delta": {"content": text}}]}
+        if chunk is not None:
+            payload["chunk"] = chunk
+        return json.dumps(payload) + "\n"
+
+    def error(self, message):
+        return json.dumps({"error": message}) + "\n"
+
+    def end(self, sync=None):
+        # A last line with the conversation id and sequence number, when there is one
+        return json.dumps(sync) + "\n" if sync else ""
+
+
+class SseFramer:
+    # text/event-stream framing with increasing event ids, the data payload is the same JSON
+    content_type = 'text/event-stream'
+
+    def __init__(self):
+        self.event_id = 0
+
+    def _event(self, payload, event=None, event_id=None):
+        # Numbered chunks of resumable streams are sent with their number as the event id, so
+        # Last-Event-ID tells where to resume
+        self.event_id = event_id if event_id is not None else self.event_id + 1
+        lines = f"id: {self.event_id}\n"
+        if event:
+            lines += f"event: {event}\n"
+        return lines + f"data: {json.dumps(payload)}\n\n"
+
+    def delta(self, text, chunk=None):
+        return self._event({"choices": [{"delta": {"content": text}}]}, event_id=chunk)
+
+    def error(self, message):
+        return self._event({"error": message}, event="error")
+
+    def end(self, sync=None):
+        return self._event(dict(sync or {}, done=True), event="done")
+
+
+def make_framer(accept_header=None, default_format=None):
+    # SSE when the client asks for it in Accept, otherwise the configured default format
+    stream_format = default_format or os.getenv("CHAT_STREAM_FORMAT", "ndjson")
+    if accept_header and 'text/event-stream' in accept_header:
+        stream_format = 'sse'
+    return SseFramer() if stream_format == 'sse' else NdjsonFramer()
+
+
+def flush_policy_from_env():
+    return FlushPolicy(
+        max_bytes=int(os.getenv("CHAT_STREAM_FLUSH_BYTES", str(DEFAULT_FLUSH_BYTES))),
+        max_delay=float(os.getenv("CHAT_STREAM_FLUSH_MS", str(DEFAULT_FLUSH_MS))) / 1000,
+    )
@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Replay buffer for resumable streams. Each streamed answer gets a stream id, and the text written
+# to the client is kept as numbered chunks (1, 2, 3, ...). The generation runs on its own thread
+# and writes into the buffer, and responses only read from it. When a client loses its
+# connection, the generation keeps going for a grace period, so the client can reconnect and read
+# on from the last chunk it got instead of asking again and paying for a new generation.
+#
+# The grace period is CHAT_STREAM_GRACE_SECONDS. Streams are kept for CHAT_STREAM_REPLAY_TTL
+# seconds after they finish, and at most CHAT_STREAM_REPLAY_MAX_STREAMS at once (the oldest is
+# dropped first).
+
+DEFAULT_TTL = 120
+DEFAULT_MAX_STREAMS = 1000
+DEFAULT_GRACE = 30
+
+
+class ReplayStream:
+    def __init__(self, owner, conversation_id=None, seq=0, on_finish=None):
+        self.stream_id = uuid.uuid4().hex
+        # Only the session that started the stream may resume it
+        self.owner = owner
+        # The conversation and the sequence number of the message this stream answers
+        self.conversation_id = conversation_id
+        self.seq = seq
+        self.chunks = []
+        self.done = False
+        # Set when the stream finishes: the complete answer (None if it was cut off) or an error
+        self.answer = None
+        self.error = None
+        self.finished_at = None
+        self._on_finish = on_finish
+        self._readers = 0
+        # The grace period also covers the time until the first response starts reading
+        self._detached_at = time.monotonic()
+        self._cond = threading.Condition()
+
+    def append(self, text):
+        with self._cond:
+            self.chunks.append(text)
+            self._cond.notify_all()
+            return len(self.chunks)
+
+    def finish(self, answer=None, error=None):
+        with self._cond:
+            if self.done:
+                return
+            self.done = True
+            self.answer = answer
+            self.error = error
+            self.finished_at = time.monotonic()
+            self._cond.notify_all()
+        if self._on_finish:
+            self._on_finish(self)
+
+    def sync_state(self):
+        # Delta sync state once the stream is done, complete answers are added to the conversation
+        return {"conversation_id": self.conversation_id, "seq": self.seq + 1 if self.answer is not None else self.seq}
+
+    def abandoned(self, grace):
+        # True once no response has been reading the stream for `grace` seconds
+        with self._cond:
+            return self._readers == 0 and time.monotonic() - self._detached_at > grace
+
+    def follow(self, after=0):
+        # Yield (number, text) for every chunk after `after`, waiting for new ones until the
+        # stream finishes. Closing the generator detaches the reader.
+        with self._cond:
+            self._readers += 1
+        try:
+            position = after
+            while True:
+                with self._cond:
+                    while len(self.chunks) <= position and not self.done:
+                        self._cond.wait()
+                    new_chunks = self.chunks[position:]
+                    finished = self.done
+                for number, text in enumerate(new_chunks, position + 1):
+                    yield number, text
+                position += len(new_chunks)
+                if finished and position >= len(self.chunks):
+                    return
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._detached_at = time.monotonic()
+
+
+class ReplayBuffer:
+    def __init__(self, ttl=DEFAULT_TTL, max_streams=DEFAULT_MAX_STREAMS, grace=DEFAULT_GRACE):
+        self.ttl = ttl
+        self.max_streams = max_streams
+        self.grace = grace
+        self.resumed = 0
+        self.evicted = 0
+        # Every stream in creation order, and the finished ones in the order they finished
+        self._streams = OrderedDict()
+        self._finished = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        while self._finished:
+            stream_id, stream = next(iter(self._finished.items()))
+            if now - stream.finished_at <= self.ttl:
+                break
+            del self._finished[stream_id]
+            self._streams.pop(stream_id, None)
+        while len(self._streams) > self.max_streams:
+            stream_id, _ = self._streams.popitem(last=False)
+            self._finished.pop(stream_id, None)
+            self.evicted += 1
+
+    def _finished_stream(self, stream):
+        with self._lock:
+            if stream.stream_id in self._streams:
+                self._finished[stream.stream_id] = stream
+
+    def create(self, owner, conversation_id=None, seq=0):
+        stream = ReplayStream(owner, conversation_id, seq, on_finish=self._finished_stream)
+        with self._lock:
+            self._streams[stream.stream_id] = stream
+            self._evict(time.monotonic())
+        return stream
+
+    def get(self, stream_id, owner):
+        with self._lock:
+            self._evict(time.monotonic())
+            stream = self._streams.get(stream_id)
+        if stream is None or stream.owner != owner:
+            return None
+        return stream
+
+    def resume(self, stream_id, owner):
+        stream = self.get(stream_id, owner)
+        if stream is not None:
+            with self._lock:
+                self.resumed += 1
+        return stream
+
+    def stats(self):
+        with self._lock:
+            return {"streams": len(self._streams), "finished": len(self._finished),
+                    "resumed": self.resumed, "evicted": self.evicted}
+
+
+def replay_buffer_from_env():
+    return ReplayBuffer(
+        ttl=float(os.getenv("CHAT_STREAM_REPLAY_TTL", str(DEFAULT_TTL))),
+        max_streams=int(os.getenv("CHAT_STREAM_REPLAY_MAX_STREAMS", str(DEFAULT_MAX_STREAMS))),
+        grace=float(os.getenv("CHAT_STREAM_GRACE_SECONDS", str(DEFAULT_GRACE))),
+    )
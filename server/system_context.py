@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from chat_logging import get_logger
+
+# Process-wide system context. system_context.txt is parsed once into an immutable snapshot with
+# per-message token counts, and only re-read when the file's mtime or size changes and its
+# content hash differs. New sessions start from the shared snapshot instead of re-reading and
+# re-tokenizing the file.
+
+SYSTEM_CONTEXT_PATH = os.path.join(os.path.dirname(__file__), 'system_context.txt')
+# How often the file is stat()ed for changes, 0 checks on every call
+CHECK_INTERVAL = float(os.getenv("CHAT_SYSTEM_CONTEXT_CHECK_MS", "1000")) / 1000
+# Versions of the file kept for version(), after it changed
+MAX_VERSIONS = 8
+DEFAULT_CONTEXT = [{"role": "system", "content": "Default system context due to an error."}]
+
+logger = get_logger("system_context")
+
+
+class SystemContext:
+    # One parsed version of the file. The messages are shared by every session started from it
+    # and must not be modified; sessions get their own list and only append to it.
+
+    def __init__(self, messages, token_counts, digest):
+        self.messages = tuple(messages)
+        self.token_counts = tuple(token_counts)
+        self.total_tokens = sum(token_counts)
+        self.digest = digest
+
+    def session_messages(self):
+        # A new list for a session, the message dicts themselves are not copied
+        return list(self.messages)
+
+    def session_token_counts(self):
+        return list(self.token_counts)
+
+
+class SystemContextProvider:
+    def __init__(self, count_tokens, path=SYSTEM_CONTEXT_PATH, check_interval=CHECK_INTERVAL):
+        self.count_tokens = count_tokens
+        self.path = path
+        self.check_interval = check_interval
+        self.reloads = 0
+        # Recent versions by digest, so sessions saved before a reload still find theirs
+        self._versions = OrderedDict()
+        self._context = None
+        self._stat = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        now = time.monotonic()
+        if self._context is not None and now - self._checked_at < self.check_interval:
+            return self._context
+        with self._lock:
+            if self._context is None or now - self._checked_at >= self.check_interval:
+                self._refresh()
+                self._checked_at = now
+            return self._context
+
+    def version(self, digest):
+        # The context parsed from the file content with this digest, None if it is not known
+        self.get()
+        with self._lock:
+            return self._versions.get(digest)
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.path)
+            file_stat = (stat.st_mtime_ns, stat.st_size)
+            if self._context is not None and file_stat == self._stat:
+                return
+            with open(self.path, 'rb') as file:
+                data = file.read()
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            self._stat = file_stat
+            if self._context is not None and digest == self._context.digest:
+                # Touched but not changed, keep the parsed snapshot
+                return
+            messages = json.loads(data)
+        except (OSError, ValueError) as e:
+            logger.error("Error reading system context: %s", e)
+            if self._context is None:
+                self._context = self._build(DEFAULT_CONTEXT, None)
+            return
+        self._context = self._build(messages, digest)
+        self._versions[digest] = self._context
+        if len(self._versions) > MAX_VERSIONS:
+            self._versions.popitem(last=False)
+        self.reloads += 1
+        logger.info("Loaded system context: %d messages, %d tokens", len(self._context.messages),
+                    self._context.total_tokens)
+
+    def _build(self, messages, digest):
+        return SystemContext(messages, [self.count_tokens(message['content']) for message in messages], digest)
@@ -0,0 +1,55 @@
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+
+# Number of distinct message contents whose token counts are remembered
+DEFAULT_CACHE_SIZE = 4096
+
+
+class TokenCounter:
+    # Counts tokens for message contents and remembers the results in a bounded LRU
+    # keyed by a hash of the content, so text that shows up in every conversation
+    # (like the system context) is only encoded once per process.
+
+    def __init__(self, encoding, max_entries=DEFAULT_CACHE_SIZE):
+        self.encoding = encoding
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = Lock()
+
+    def count(self, text):
+        if not text:
+            return 0
+
+        key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return tokens
+
+        # Encode outside the lock so one long message does not block other requests
+        tokens = len(self.encoding.encode(text))
+
+        with self._lock:
+            self.misses += 1
+            self._cache[key] = tokens
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def count_messages(self, messages):
+        return sum(self.count(message['content']) for message in messages)
+
+
+def sync_token_counts(messages, token_counts, counter):
+    # Bring the per-message counts up to date with the message list and return the total.
+    # Only messages that have no count yet are tokenized; the rest are reused as is.
+    if len(token_counts) > len(messages):
+        del token_counts[len(messages):]
+    for message in messages[len(token_counts):]:
+        token_counts.append(counter.count(message['content']))
+    return sum(token_counts)
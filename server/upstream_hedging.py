@@ -0,0 +1,378 @@
+import asyncio
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+import httpx
+import openai
+from chat_logging import event, get_logger
+
+# Deadlines, hedging and retries for upstream calls, so one stalled call does not become a hang.
+#
+# Every call gets a connect timeout and a deadline for its first token. Streams also get an idle
+# deadline between chunks. A stream's first-token deadline and hedge delay count from when
+# upstream_scheduler lets the call through, time spent waiting for rate limit budget is not the
+# upstream's. With hedging on, a stream that has not produced a token after the
+# recent p95 time-to-first-token gets a duplicate request; the first of the two to produce a
+# token is kept and the other is closed, which cancels its generation. A call that fails before
+# any token reached the client (connection error, timeout, 5xx) is retried after a full-jitter
+# backoff. Rate limits are handled by upstream_scheduler, not here.
+#
+# Configuration:
+#   CHAT_UPSTREAM_CONNECT_TIMEOUT   seconds to connect to the API (default 5)
+#   CHAT_UPSTREAM_TTFT_TIMEOUT      seconds until the first token, or the whole answer when not streamed (default 30)
+#   CHAT_UPSTREAM_IDLE_TIMEOUT      seconds between two chunks of a stream (default 20)
+#   CHAT_UPSTREAM_HEDGE             1 to hedge streams that are slow to start (default 0)
+#   CHAT_UPSTREAM_HEDGE_PERCENTILE  time-to-first-token percentile after which to hedge (default 0.95)
+#   CHAT_UPSTREAM_HEDGE_MIN_MS      never hedge earlier than this (default 300)
+#   CHAT_UPSTREAM_RETRIES           retries of a call that failed before its first token (default 2)
+#   CHAT_UPSTREAM_RETRY_BASE_MS     base delay of the jittered exponential backoff (default 200)
+
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_TTFT_TIMEOUT = 30.0
+DEFAULT_IDLE_TIMEOUT = 20.0
+# Time-to-first-token samples kept for the hedge delay, and how many are needed before hedging
+TTFT_SAMPLES = 500
+MIN_TTFT_SAMPLES = 20
+MAX_RETRY_DELAY = 5.0
+
+# Failures that happened before any token was sent, so the call can safely be made again
+RETRYABLE = (openai.APIConnectionError, openai.InternalServerError)
+
+logger = get_logger("hedging")
+
+_DONE = object()
+# Put on an attempt's queue when the scheduler has admitted it
+_ADMITTED = object()
+
+
+class UpstreamTimeout(Exception):
+    pass
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class _Attempt:
+    # One upstream stream read on its own thread, its chunks go to a queue shared with the
+    # other attempt of the same call
+
+    def __init__(self, open_stream, results):
+        self.results = results
+        # When the scheduler admitted the call, None while it waits for budget
+        self.started = None
+        self.response = None
+        self.cancelled = False
+        threading.Thread(target=self._run, args=(open_stream,), daemon=True).start()
+
+    def _admitted(self):
+        self.started = time.monotonic()
+        self.results.put((self, _ADMITTED))
+
+    def _run(self, open_stream):
+        try:
+            self.response = open_stream(self._admitted)
+            for chunk in self.response:
+                if self.cancelled:
+                    break
+                self.results.put((self, chunk))
+            self.results.put((self, _DONE))
+        except Exception as e:
+            self.results.put((self, e))
+        finally:
+            if self.cancelled and self.response is not None:
+                self.response.close()
+
+    def cancel(self):
+        self.cancelled = True
+        if self.response is not None:
+            try:
+                # Drops the connection, which stops the generation upstream
+                self.response.close()
+            except Exception:
+                pass
+
+
+class UpstreamHedger:
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, ttft_timeout=DEFAULT_TTFT_TIMEOUT,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, hedge=False, hedge_percentile=0.95, hedge_min=0.3,
+                 retries=2, retry_base=0.2):
+        self.connect_timeout = connect_timeout
+        self.ttft_timeout = ttft_timeout
+        self.idle_timeout = idle_timeout
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min = hedge_min
+        self.retries = retries
+        self.retry_base = retry_base
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.retried = 0
+        self.ttft_timeouts = 0
+        self.idle_timeouts = 0
+        self._ttfts = deque(maxlen=TTFT_SAMPLES)
+        self._lock = threading.Lock()
+
+    def timeout(self):
+        # httpx timeout for the client call, a backstop for the deadlines enforced here
+        return httpx.Timeout(max(self.ttft_timeout, self.idle_timeout), connect=self.connect_timeout)
+
+    def hedge_delay(self):
+        # Seconds to wait for a first token before hedging, None to not hedge
+        with self._lock:
+            if not self.hedge or len(self._ttfts) < MIN_TTFT_SAMPLES:
+                return None
+            return max(self.hedge_min, percentile(self._ttfts, self.hedge_percentile))
+
+    def retry_delay(self, retry):
+        # Full jitter: anywhere between 0 and the exponential backoff
+        return random.uniform(0, min(MAX_RETRY_DELAY, self.retry_base * 2 ** retry))
+
+    def _first_token(self, started, hedged):
+        with self._lock:
+            self._ttfts.append(time.monotonic() - started)
+            if hedged:
+                self.hedge_wins += 1
+
+    def _retrying(self, retry, error):
+        delay = self.retry_delay(retry)
+        with self._lock:
+            self.retried += 1
+        logger.warning("Upstream call failed before its first token (%s), retrying in %.2fs", error, delay,
+                       extra=event('upstream'))
+        return delay
+
+    def _timed_out(self, kind, message):
+        with self._lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+        return UpstreamTimeout(message)
+
+    def call(self, create):
+        # A call that is not streamed: deadline through timeout(), retried with jitter
+        with self._lock:
+            self.calls += 1
+        for retry in range(self.retries + 1):
+            try:
+                return create()
+            except openai.APITimeoutError:
+                if retry == self.retries:
+                    raise self._timed_out('ttft_timeouts', f"No answer from the upstream after {self.ttft_timeout:.0f}s")
+                time.sleep(self._retrying(retry, "timeout"))
+            except RETRYABLE as e:
+                if retry == self.retries:
+                    raise
+                time.sleep(self._retrying(retry, e))
+
+    async def call_async(self, create):
+        # The same for an awaitable create()
+        with self._lock:
+            self.calls += 1
+        for retry in range(self.retries + 1):
+            try:
+                return await create()
+            except openai.APITimeoutError:
+                if retry == self.retries:
+                    raise self._timed_out('ttft_timeouts', f"No answer from the upstream after {self.ttft_timeout:.0f}s")
+                await asyncio.sleep(self._retrying(retry, "timeout"))
+            except RETRYABLE as e:
+                if retry == self.retries:
+                    raise
+                await asyncio.sleep(self._retrying(retry, e))
+
+    def _start(self, open_stream):
+        # Wait for the first chunk of one attempt, hedging if it is late. Returns the winning
+        # attempt, its first chunk, the shared queue and every attempt started.
+        results = queue.Queue()
+        attempts = [_Attempt(open_stream, results)]
+        hedge_delay = self.hedge_delay()
+        # Both are set once the scheduler admits the first attempt, a call waiting for budget is
+        # bounded by the scheduler's queue timeout instead
+        hedge_at = deadline = None
+        failed = 0
+        while True:
+            now = time.monotonic()
+            if hedge_at is not None and now >= hedge_at:
+                attempts.append(_Attempt(open_stream, results))
+                hedge_at = None
+                with self._lock:
+                    self.hedged += 1
+                logger.info("No first token after %.2fs, hedging the upstream call", hedge_delay, extra=event('upstream'))
+                continue
+            if deadline is not None and now >= deadline:
+                for attempt in attempts:
+                    attempt.cancel()
+                raise self._timed_out('ttft_timeouts', f"No first token from the upstream after {self.ttft_timeout:.0f}s")
+            try:
+                attempt, item = results.get(timeout=min(deadline, hedge_at or deadline) - now if deadline is not None else None)
+            except queue.Empty:
+                continue
+            if item is _ADMITTED:
+                if attempt is attempts[0]:
+                    deadline = attempt.started + self.ttft_timeout
+                    hedge_at = attempt.started + hedge_delay if hedge_delay is not None else None
+                continue
+            if isinstance(item, Exception):
+                failed += 1
+                if failed == len(attempts):
+                    raise item
+                continue
+            self._first_token(attempt.started, attempt is not attempts[0])
+            for other in attempts:
+                if other is not attempt:
+                    other.cancel()
+            return attempt, item, results, attempts
+
+    def stream(self, open_stream):
+        # Yield the chunks of open_stream(admitted), a sync chat completions stream. open_stream
+        # passes `admitted` on to upstream_scheduler.call(), which calls it once the call has its
+        # budget.
+        with self._lock:
+            self.calls += 1
+        for retry in range(self.retries + 1):
+            try:
+                winner, first, results, attempts = self._start(open_stream)
+                break
+            except (UpstreamTimeout,) + RETRYABLE as e:
+                if retry == self.retries:
+                    raise
+                time.sleep(self._retrying(retry, e))
+        try:
+            item = first
+            while item is not _DONE:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                while True:
+                    try:
+                        attempt, item = results.get(timeout=self.idle_timeout)
+                    except queue.Empty:
+                        raise self._timed_out('idle_timeouts', f"The upstream stream stalled for {self.idle_timeout:.0f}s")
+                    if attempt is winner:
+                        break
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def _attempt_async(self, open_stream, results, attempt_id, starts):
+        def admitted():
+            starts[attempt_id] = time.monotonic()
+            results.put_nowait((attempt_id, _ADMITTED))
+
+        response = None
+        try:
+            response = await open_stream(admitted)
+            async for chunk in response:
+                await results.put((attempt_id, chunk))
+            await results.put((attempt_id, _DONE))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await results.put((attempt_id, e))
+        finally:
+            if response is not None:
+                # Closing the stream drops the upstream connection, which cancels the generation
+                await response.close()
+
+    async def _start_async(self, open_stream):
+        results = asyncio.Queue()
+        # When the scheduler admitted each attempt
+        starts = [None, None]
+        tasks = [asyncio.create_task(self._attempt_async(open_stream, results, 0, starts))]
+        hedge_delay = self.hedge_delay()
+        hedge_at = deadline = None
+        failed = 0
+        try:
+            while True:
+                now = time.monotonic()
+                if hedge_at is not None and now >= hedge_at:
+                    tasks.append(asyncio.create_task(self._attempt_async(open_stream, results, 1, starts)))
+                    hedge_at = None
+                    with self._lock:
+                        self.hedged += 1
+                    logger.info("No first token after %.2fs, hedging the upstream call", hedge_delay, extra=event('upstream'))
+                    continue
+                if deadline is not None and now >= deadline:
+                    raise self._timed_out('ttft_timeouts', f"No first token from the upstream after {self.ttft_timeout:.0f}s")
+                try:
+                    attempt_id, item = await asyncio.wait_for(results.get(), min(deadline, hedge_at or deadline) - now if deadline is not None else None)
+                except asyncio.TimeoutError:
+                    continue
+                if item is _ADMITTED:
+                    if attempt_id == 0:
+                        deadline = starts[0] + self.ttft_timeout
+                        hedge_at = starts[0] + hedge_delay if hedge_delay is not None else None
+                    continue
+                if isinstance(item, Exception):
+                    failed += 1
+                    if failed == len(tasks):
+                        raise item
+                    continue
+                self._first_token(starts[attempt_id], attempt_id != 0)
+                for other_id, task in enumerate(tasks):
+                    if other_id != attempt_id:
+                        task.cancel()
+                return attempt_id, item, results, tasks
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+    async def stream_async(self, open_stream):
+        # Yield the chunks of await open_stream(admitted), an async chat completions stream
+        with self._lock:
+            self.calls += 1
+        for retry in range(self.retries + 1):
+            try:
+                winner, first, results, tasks = await self._start_async(open_stream)
+                break
+            except (UpstreamTimeout,) + RETRYABLE as e:
+                if retry == self.retries:
+                    raise
+                await asyncio.sleep(self._retrying(retry, e))
+        try:
+            item = first
+            while item is not _DONE:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                while True:
+                    try:
+                        attempt_id, item = await asyncio.wait_for(results.get(), self.idle_timeout)
+                    except asyncio.TimeoutError:
+                        raise self._timed_out('idle_timeouts', f"The upstream stream stalled for {self.idle_timeout:.0f}s")
+                    if attempt_id == winner:
+                        break
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "retried": self.retried,
+                "ttft_timeouts": self.ttft_timeouts,
+                "idle_timeouts": self.idle_timeouts,
+                "ttft_p50_ms": round(percentile(self._ttfts, 0.5) * 1000, 2) if self._ttfts else None,
+                "ttft_p95_ms": round(percentile(self._ttfts, 0.95) * 1000, 2) if self._ttfts else None,
+            }
+
+
+def hedger_from_env():
+    return UpstreamHedger(
+        connect_timeout=float(os.getenv("CHAT_UPSTREAM_CONNECT_TIMEOUT", str(DEFAULT_CONNECT_TIMEOUT))),
+        ttft_timeout=float(os.getenv("CHAT_UPSTREAM_TTFT_TIMEOUT", str(DEFAULT_TTFT_TIMEOUT))),
+        idle_timeout=float(os.getenv("CHAT_UPSTREAM_IDLE_TIMEOUT", str(DEFAULT_IDLE_TIMEOUT))),
+        hedge=os.getenv("CHAT_UPSTREAM_HEDGE", "0") == "1",
+        hedge_percentile=float(os.getenv("CHAT_UPSTREAM_HEDGE_PERCENTILE", "0.95")),
+        hedge_min=float(os.getenv("CHAT_UPSTREAM_HEDGE_MIN_MS", "300")) / 1000,
+        retries=int(os.getenv("CHAT_UPSTREAM_RETRIES", "2")),
+        retry_base=float(os.getenv("CHAT_UPSTREAM_RETRY_BASE_MS", "200")) / 1000,
+    )
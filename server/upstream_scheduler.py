@@ -0,0 +1,219 @@
+import asyncio
+import os
+import threading
+import time
+import openai
+from chat_logging import get_logger
+
+# Scheduling layer in front of the upstream client. Every call first reserves its cost from a
+# requests-per-minute and a tokens-per-minute bucket and waits, instead of failing, until the
+# budget allows it or its queue deadline passes. The token cost is estimated as the prompt
+# tokens plus max_completion_tokens and corrected with the usage the API reports. Limits come
+# from the configuration and are tightened by the x-ratelimit-* response headers, and a 429
+# pauses every call for its Retry-After.
+#
+# Configuration:
+#   CHAT_UPSTREAM_RPM            requests per minute, 0 to only follow the response headers (default 0)
+#   CHAT_UPSTREAM_TPM            tokens per minute, 0 to only follow the response headers (default 0)
+#   CHAT_UPSTREAM_QUEUE_TIMEOUT  seconds a call may wait for budget before it is rejected (default 30)
+
+DEFAULT_QUEUE_TIMEOUT = 30.0
+# Used when a 429 comes without a Retry-After header
+DEFAULT_RETRY_AFTER = 1.0
+
+logger = get_logger("scheduler")
+
+
+class UpstreamBusy(Exception):
+    # The call could not be scheduled before its deadline, retry_after is a hint for the client
+
+    def __init__(self, retry_after):
+        super().__init__(f"Upstream rate limit reached, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    # Budget of a per-minute limit. Reservations may take the level below zero, the deficit is
+    # the time the caller has to wait, so calls are served in the order they reserved.
+
+    def __init__(self, per_minute=0):
+        self.capacity = 0
+        self.rate = 0.0
+        self.level = 0.0
+        self._updated = time.monotonic()
+        self.set_limit(per_minute)
+
+    def set_limit(self, per_minute):
+        unlimited = not self.capacity
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute if unlimited else min(self.level, per_minute)
+
+    def _refill(self, now):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount, now):
+        # Take `amount` and return the seconds until it is covered
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+        return 0.0 if self.level >= 0 else -self.level / self.rate
+
+    def refund(self, amount, now):
+        if self.capacity:
+            self._refill(now)
+            self.level = min(self.capacity, self.level + min(amount, self.capacity))
+
+    def clamp(self, remaining, now):
+        # The provider's count of what is left wins over ours
+        if self.capacity:
+            self._refill(now)
+            self.level = min(self.level, remaining)
+
+
+def header_number(headers, name):
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_seconds(headers):
+    retry_after_ms = header_number(headers, 'retry-after-ms')
+    if retry_after_ms is not None:
+        return retry_after_ms / 1000
+    retry_after = header_number(headers, 'retry-after')
+    return retry_after if retry_after is not None else DEFAULT_RETRY_AFTER
+
+
+class UpstreamScheduler:
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, queue_timeout=DEFAULT_QUEUE_TIMEOUT):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.queue_timeout = queue_timeout
+        self.calls = 0
+        self.delayed = 0
+        self.rejected = 0
+        self.rate_limited = 0
+        self.wait_seconds = 0.0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _reserve(self, estimated_tokens, deadline):
+        # Seconds to wait before calling and the (requests, tokens) taken from the buckets, or
+        # UpstreamBusy if that would pass the deadline. A bucket without a limit takes nothing.
+        with self._lock:
+            now = time.monotonic()
+            taken = (1 if self.requests.capacity else 0, estimated_tokens if self.tokens.capacity else 0)
+            wait = max(self.requests.reserve(1, now), self.tokens.reserve(estimated_tokens, now),
+                       self._paused_until - now)
+            if now + wait > deadline:
+                self.requests.refund(1, now)
+                self.tokens.refund(estimated_tokens, now)
+                self.rejected += 1
+                raise UpstreamBusy(wait)
+            self.calls += 1
+            if wait > 0:
+                self.delayed += 1
+                self.wait_seconds += wait
+            return wait, taken
+
+    def _refund(self, taken):
+        # Give back the reservation of a call the API turned down, the retry reserves its own.
+        # Only what was taken: a limit learned from the headers since then was never charged.
+        requests, tokens = taken
+        with self._lock:
+            now = time.monotonic()
+            self.requests.refund(requests, now)
+            self.tokens.refund(tokens, now)
+
+    def observe(self, headers):
+        # Follow the provider's view of the limits
+        with self._lock:
+            now = time.monotonic()
+            for bucket, kind in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+                limit = header_number(headers, f'x-ratelimit-limit-{kind}')
+                if limit and (not bucket.capacity or limit < bucket.capacity):
+                    bucket.set_limit(limit)
+                remaining = header_number(headers, f'x-ratelimit-remaining-{kind}')
+                if remaining is not None:
+                    bucket.clamp(remaining, now)
+
+    def _rate_limited(self, error, taken):
+        # Refunded before the headers are applied, so the provider's remaining count still wins
+        self._refund(taken)
+        headers = error.response.headers
+        self.observe(headers)
+        pause = retry_after_seconds(headers)
+        with self._lock:
+            self.rate_limited += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        logger.warning("Upstream rate limit hit, pausing calls for %.1fs", pause)
+
+    def settle(self, estimated_tokens, actual_tokens):
+        # Correct the token bucket once the real usage of a call is known
+        with self._lock:
+            now = time.monotonic()
+            difference = actual_tokens - estimated_tokens
+            if difference > 0:
+                self.tokens.reserve(difference, now)
+            elif difference < 0:
+                self.tokens.refund(-difference, now)
+
+    def call(self, create, estimated_tokens, admitted=None):
+        # create() must return a raw response (client....with_raw_response.create(...)), the
+        # parsed result is returned. admitted() is called when the call leaves the queue, right
+        # before create(), so callers can time the upstream without the wait for budget.
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            wait, taken = self._reserve(estimated_tokens, deadline)
+            if wait > 0:
+                time.sleep(wait)
+            if admitted is not None:
+                admitted()
+            try:
+                raw_response = create()
+            except openai.RateLimitError as e:
+                self._rate_limited(e, taken)
+                continue
+            self.observe(raw_response.headers)
+            return raw_response.parse()
+
+    async def call_async(self, create, estimated_tokens, admitted=None):
+        deadline = time.monotonic() + self.queue_timeout
+        while True:
+            wait, taken = self._reserve(estimated_tokens, deadline)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if admitted is not None:
+                admitted()
+            try:
+                raw_response = await create()
+            except openai.RateLimitError as e:
+                self._rate_limited(e, taken)
+                continue
+            self.observe(raw_response.headers)
+            return raw_response.parse()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "delayed": self.delayed,
+                "rejected": self.rejected,
+                "rate_limited": self.rate_limited,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "requests_per_minute": self.requests.capacity,
+                "tokens_per_minute": self.tokens.capacity,
+            }
+
+
+def scheduler_from_env():
+    return UpstreamScheduler(
+        requests_per_minute=int(os.getenv("CHAT_UPSTREAM_RPM", "0")),
+        tokens_per_minute=int(os.getenv("CHAT_UPSTREAM_TPM", "0")),
+        queue_timeout=float(os.getenv("CHAT_UPSTREAM_QUEUE_TIMEOUT", str(DEFAULT_QUEUE_TIMEOUT))),
+    )
@@ -0,0 +1,152 @@
+# Shared fixtures. The fake upstream (benchmarks/fake_upstream.py) runs in the test process on a
+# background thread, so tests change its settings and read its counters directly. Servers run as
+# subprocesses on free ports, pointed at it, the way the benchmarks start them.
+#
+# Run with: python -m pytest tests/
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+import httpx
+import pytest
+import uvicorn
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'server'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import fake_redis  # noqa: E402
+import fake_upstream  # noqa: E402
+from harness import SERVER_DIR, SERVERS, start, stop, wait_for_port  # noqa: E402
+
+# Quick answers, so a test spends milliseconds waiting for each
+COMPLETION_TOKENS = 20
+FAST_UPSTREAM = {"TTFT_SECONDS": 0.05, "TOKENS_PER_SEC": 2000, "COMPLETION_TOKENS": COMPLETION_TOKENS}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Upstream:
+    # Handle on the fake upstream for one test, settings changed here are undone after it
+
+    def __init__(self, port, monkeypatch):
+        self.port = port
+        self.base_url = f"http://127.0.0.1:{port}/v1"
+        self._monkeypatch = monkeypatch
+
+    @property
+    def stats(self):
+        return fake_upstream.stats
+
+    @property
+    def answer(self):
+        # The text of every completion
+        return "".join(fake_upstream.completion_tokens(fake_upstream.COMPLETION_TOKENS))
+
+    def configure(self, **settings):
+        # fake_upstream's module settings: TTFT_SECONDS, ERROR_RATE, ERROR_STATUS, ...
+        for name, value in settings.items():
+            self._monkeypatch.setattr(fake_upstream, name, value)
+
+    def rate_limit(self, requests_per_minute):
+        # Enforce a requests-per-minute limit and return it, tests may drain its level
+        limit = fake_upstream.RateLimit(requests_per_minute)
+        self._monkeypatch.setitem(fake_upstream.limits, 'requests', limit)
+        return limit
+
+
+@pytest.fixture(scope='session')
+def upstream_port():
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(fake_upstream.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    wait_for_port(port)
+    yield port
+    server.should_exit = True
+    thread.join()
+
+
+@pytest.fixture
+def upstream(upstream_port, monkeypatch):
+    # The fake upstream with fresh counters and quick answers
+    monkeypatch.setattr(fake_upstream, 'stats', dict.fromkeys(fake_upstream.stats, 0))
+    upstream = Upstream(upstream_port, monkeypatch)
+    upstream.configure(**FAST_UPSTREAM)
+    return upstream
+
+
+@pytest.fixture(scope='session')
+def redis_url():
+    # benchmarks/fake_redis.py on a background thread
+    port = free_port()
+    server = fake_redis.start(port)
+    yield f"redis://127.0.0.1:{port}/0"
+    server.shutdown()
+
+
+def wait_until_ready(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if httpx.get(f"{url}/api/ready").status_code == 200:
+            return
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} not ready after {timeout}s")
+
+
+@pytest.fixture
+def start_server(upstream, tmp_path):
+    # start_server(name, **settings) runs one of the servers against the fake upstream and returns
+    # its URL. The servers of a test share their state directories and secret key, like the
+    # workers of one deployment.
+    processes = []
+
+    def start_server(name, **settings):
+        port = free_port()
+        env = dict(os.environ, OPENAI_API_KEY="fake", OPENAI_BASE_URL=upstream.base_url,
+                   CHAT_SECRET_KEY="test-secret", CHAT_LOG_LEVEL="ERROR",
+                   CHAT_HISTORY_DIR=str(tmp_path / 'chat_history'),
+                   CHAT_CONVERSATION_DIR=str(tmp_path / 'conversations'),
+                   CHAT_SESSION_DIR=str(tmp_path / 'sessions'))
+        env.update({name: str(value) for name, value in settings.items()})
+        command, _ = SERVERS[name]
+        processes.append(start(command + [str(port)], SERVER_DIR, env, port))
+        url = f"http://127.0.0.1:{port}"
+        wait_until_ready(url)
+        return url
+
+    yield start_server
+    stop(processes)
+
+
+def read_answer(response):
+    # The answer text of a /api/chat response: one JSON object from the default server, NDJSON
+    # deltas from the streaming servers
+    text = ""
+    for line in response.iter_lines():
+        if not line.strip():
+            continue
+        payload = json.loads(line)
+        if 'error' in payload:
+            raise AssertionError(f"The server answered with an error: {payload['error']}")
+        text += payload.get('response', '')
+        for choice in payload.get('choices', []):
+            text += choice.get('delta', {}).get('content') or ''
+    return text
+
+
+@pytest.fixture
+def chat():
+    # chat(client, url, text) sends one message and returns the answer
+    def chat(client, url, text, user_name="test"):
+        with client.stream('POST', f"{url}/api/chat", json={"input": text, "user_name": user_name}) as response:
+            response.raise_for_status()
+            return read_answer(response)
+    return chat
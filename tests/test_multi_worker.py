@@ -0,0 +1,74 @@
+# Sessions and conversations shared between workers (server/session_backend.py,
+# server/conversation_store.py), through a shared directory or Redis (benchmarks/fake_redis.py)
+import httpx
+import pytest
+import redis
+
+from conversation_store import ConversationStore, RedisConversationStore
+from session_backend import FileSessionStore, RedisSessionStore
+
+SYSTEM = {"role": "system", "content": "You are a helpful assistant."}
+QUESTION = {"role": "user", "content": "Who are you?"}
+
+
+@pytest.fixture(params=['filesystem', 'redis'])
+def backend(request, tmp_path, redis_url):
+    # (backend name, server settings, a factory of stores the way one worker would open them)
+    if request.param == 'redis':
+        settings = {"CHAT_SESSION_BACKEND": "redis", "CHAT_REDIS_URL": redis_url}
+        return request.param, settings, lambda kind: (
+            RedisConversationStore(redis.Redis.from_url(redis_url), ttl=60) if kind == 'conversations'
+            else RedisSessionStore(redis.Redis.from_url(redis_url), ttl=60))
+    settings = {"CHAT_SESSION_BACKEND": "filesystem"}
+    return request.param, settings, lambda kind: (
+        ConversationStore(str(tmp_path / 'conversations')) if kind == 'conversations'
+        else FileSessionStore(str(tmp_path / 'sessions')))
+
+
+@pytest.fixture
+def conversation_stores(backend):
+    # The conversation stores of two workers
+    _, _, open_store = backend
+    return open_store('conversations'), open_store('conversations')
+
+
+def test_a_conversation_created_by_one_worker_is_read_by_another(conversation_stores):
+    first, second = conversation_stores
+    conversation_id = first.create([SYSTEM], [7])
+    assert second.get(conversation_id).messages == [SYSTEM]
+
+
+def test_appends_from_both_workers_are_kept_in_order(conversation_stores):
+    first, second = conversation_stores
+    conversation_id = first.create([SYSTEM], [7])
+    second.get(conversation_id)
+    first.append(conversation_id, QUESTION, 4)
+    answer = {"role": "assistant", "content": "Streamy."}
+    assert second.append(conversation_id, answer, 3).messages == [SYSTEM, QUESTION, answer]
+
+
+def test_a_conversation_deleted_by_one_worker_is_gone_for_another(conversation_stores):
+    first, second = conversation_stores
+    conversation_id = first.create([SYSTEM], [7])
+    second.get(conversation_id)
+    first.delete(conversation_id)
+    assert second.get(conversation_id) is None
+
+
+def test_a_session_saved_by_one_worker_is_loaded_by_another(backend):
+    _, _, open_store = backend
+    chat_session = {"user_id": "1", "user_name": "test"}
+    open_store('sessions').save("session1", chat_session)
+    assert open_store('sessions').load("session1") == chat_session
+
+
+@pytest.mark.parametrize('server', ['default', 'stream', 'asgi'])
+def test_a_conversation_continues_on_another_worker(server, backend, upstream, start_server, chat):
+    _, settings, _ = backend
+    workers = [start_server(server, **settings), start_server(server, **settings)]
+    with httpx.Client(timeout=30) as client:
+        chat(client, workers[0], "Who are you?")
+        first_turn = upstream.stats['max_messages']
+        chat(client, workers[1], "What can you do?")
+    # The second worker sent the first turn's question and answer along with the new question
+    assert upstream.stats['max_messages'] == first_turn + 2
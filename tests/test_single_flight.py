@@ -0,0 +1,138 @@
+# Coalescing of identical in-flight upstream calls (server/single_flight.py), on its own and in
+# the servers
+import asyncio
+import threading
+
+import httpx
+import openai
+import pytest
+
+from single_flight import AsyncStreamCoalescer, SingleFlight, StreamCoalescer
+
+CALLERS = 10
+# Long enough for every caller to arrive while the first call is still in flight
+SLOW_FIRST_TOKEN = 0.5
+QUESTION = [{"role": "user", "content": "Who are you?"}]
+
+
+def run_together(fn, count=CALLERS):
+    # Call fn(index) from `count` threads released at once, returning results or exceptions
+    barrier = threading.Barrier(count)
+    results = [None] * count
+
+    def run(index):
+        barrier.wait()
+        try:
+            results[index] = fn(index)
+        except Exception as e:
+            results[index] = e
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+@pytest.fixture
+def slow_upstream(upstream):
+    upstream.configure(TTFT_SECONDS=SLOW_FIRST_TOKEN)
+    return upstream
+
+
+@pytest.fixture
+def complete(slow_upstream):
+    # One whole completion of QUESTION
+    client = openai.OpenAI(api_key="fake", base_url=slow_upstream.base_url, max_retries=0)
+    return lambda: client.chat.completions.create(model="gpt-4o", messages=QUESTION).choices[0].message.content
+
+
+@pytest.fixture
+def stream_text(slow_upstream):
+    # The deltas of one streamed completion of QUESTION
+    client = openai.OpenAI(api_key="fake", base_url=slow_upstream.base_url, max_retries=0)
+
+    def stream_text():
+        for chunk in client.chat.completions.create(model="gpt-4o", messages=QUESTION, stream=True):
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
+    return stream_text
+
+
+def test_identical_calls_make_one_upstream_request(slow_upstream, complete):
+    flight = SingleFlight()
+    run_together(lambda index: flight.do("key", complete))
+    assert slow_upstream.stats['requests'] == 1
+
+
+def test_identical_calls_share_the_answer(slow_upstream, complete):
+    flight = SingleFlight()
+    answers = run_together(lambda index: flight.do("key", complete))
+    assert answers == [slow_upstream.answer] * CALLERS
+
+
+def test_different_calls_are_not_coalesced(slow_upstream, complete):
+    flight = SingleFlight()
+    run_together(lambda index: flight.do(f"key{index}", complete))
+    assert slow_upstream.stats['requests'] == CALLERS
+
+
+def test_a_failed_call_fails_every_caller(slow_upstream, complete):
+    slow_upstream.configure(ERROR_RATE=1.0)
+    flight = SingleFlight()
+    errors = run_together(lambda index: flight.do("key", complete))
+    assert all(isinstance(error, openai.InternalServerError) for error in errors)
+
+
+def test_subscribers_share_one_upstream_stream(slow_upstream, stream_text):
+    coalescer = StreamCoalescer()
+    run_together(lambda index: "".join(coalescer.subscribe("key", stream_text)))
+    assert slow_upstream.stats['requests'] == 1
+
+
+def test_every_subscriber_gets_the_whole_stream(slow_upstream, stream_text):
+    coalescer = StreamCoalescer()
+    texts = run_together(lambda index: "".join(coalescer.subscribe("key", stream_text)))
+    assert texts == [slow_upstream.answer] * CALLERS
+
+
+def test_a_stream_left_by_every_subscriber_is_not_joined(slow_upstream, stream_text):
+    coalescer = StreamCoalescer()
+    chunks = coalescer.subscribe("key", stream_text)
+    next(chunks)
+    chunks.close()
+    "".join(coalescer.subscribe("key", stream_text))
+    assert coalescer.calls == 2
+
+
+def test_async_subscribers_share_one_upstream_stream(slow_upstream):
+    client = openai.AsyncOpenAI(api_key="fake", base_url=slow_upstream.base_url, max_retries=0)
+
+    async def stream_text():
+        async for chunk in await client.chat.completions.create(model="gpt-4o", messages=QUESTION, stream=True):
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
+
+    async def subscriber(coalescer):
+        return "".join([text async for text in coalescer.subscribe("key", stream_text)])
+
+    async def burst():
+        coalescer = AsyncStreamCoalescer()
+        await asyncio.gather(*(subscriber(coalescer) for _ in range(CALLERS)))
+
+    asyncio.run(burst())
+    assert slow_upstream.stats['requests'] == 1
+
+
+@pytest.mark.parametrize('server', ['default', 'stream', 'asgi'])
+def test_servers_send_identical_first_questions_upstream_once(server, slow_upstream, start_server, chat):
+    url = start_server(server)
+
+    def ask(index):
+        # A new client per request, so every request starts a fresh session
+        with httpx.Client(timeout=30) as client:
+            return chat(client, url, "Who are you?")
+
+    run_together(ask)
+    assert slow_upstream.stats['requests'] == 1
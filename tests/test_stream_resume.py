@@ -0,0 +1,129 @@
+# Resumable streams of the Flask streaming server (server/stream_replay.py): resuming after a
+# dropped connection, saving answers to the shared conversation store, and ending the chat
+import json
+import time
+
+import httpx
+import pytest
+
+# Every delta is written as its own chunk, so there are chunks to cut between
+STREAM_SETTINGS = {"CHAT_STREAM_FLUSH_BYTES": 0, "CHAT_STREAM_FLUSH_MS": 0}
+
+
+@pytest.fixture
+def server(upstream, start_server):
+    # Slow enough that a stream cut after a few chunks is still being generated
+    upstream.configure(TOKENS_PER_SEC=100)
+    return start_server('stream', **STREAM_SETTINGS)
+
+
+def read_frames(response, state, cut_after=None):
+    # Add the chunks of an NDJSON stream to `state` until its end frame, or until `cut_after` chunks
+    received = 0
+    for line in response.iter_lines():
+        if not line:
+            continue
+        frame = json.loads(line)
+        if 'error' in frame:
+            raise AssertionError(f"The stream ended with an error: {frame['error']}")
+        if 'seq' in frame:
+            state['seq'] = frame['seq']
+            return
+        state['chunk'] = frame['chunk']
+        state['text'] += frame['choices'][0]['delta']['content']
+        received += 1
+        if received == cut_after:
+            return
+
+
+def start_chat(client, url, text, cut_after=None):
+    # Send a message and read its answer, up to `cut_after` chunks (0 reads nothing)
+    state = {"text": "", "chunk": 0, "seq": None}
+    with client.stream('POST', f"{url}/api/chat", json={"input": text, "user_name": "test"}) as response:
+        response.raise_for_status()
+        state['stream_id'] = response.headers['x-stream-id']
+        state['conversation_id'] = response.headers['x-conversation-id']
+        if cut_after != 0:
+            read_frames(response, state, cut_after)
+    return state
+
+
+def resume(client, url, state):
+    with client.stream('GET', f"{url}/api/chat/stream/{state['stream_id']}", params={"after": state['chunk']}) as response:
+        response.raise_for_status()
+        read_frames(response, state)
+    return state
+
+
+def wait_for_finished_streams(url, count, timeout=10):
+    # Until the replay buffer reports `count` finished streams in /metrics
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for line in httpx.get(f"{url}/metrics").text.splitlines():
+            if line.startswith('chat_replay_finished ') and float(line.split()[1]) >= count:
+                return
+        time.sleep(0.05)
+    raise AssertionError(f"{count} streams did not finish within {timeout}s")
+
+
+def end_chat(client, url, state):
+    return client.post(f"{url}/api/chat/end", json={"conversation_id": state['conversation_id'],
+                                                    "base_seq": state['seq'], "messages": []})
+
+
+def test_a_resumed_stream_completes_the_answer(upstream, server):
+    with httpx.Client(timeout=30) as client:
+        state = resume(client, server, start_chat(client, server, "Who are you?", cut_after=3))
+    assert state['text'] == upstream.answer
+
+
+def test_resuming_does_not_generate_the_answer_again(upstream, server):
+    with httpx.Client(timeout=30) as client:
+        resume(client, server, start_chat(client, server, "Who are you?", cut_after=3))
+    assert upstream.stats['requests'] == 1
+
+
+def test_the_end_frame_acknowledges_the_saved_answer(server):
+    with httpx.Client(timeout=30) as client:
+        state = start_chat(client, server, "Who are you?")
+    assert state['seq'] == 2
+
+
+def test_an_answer_nobody_read_is_saved(upstream, server):
+    with httpx.Client(timeout=30) as client:
+        start_chat(client, server, "Who are you?", cut_after=0)
+        wait_for_finished_streams(server, 1)
+        first_turn = upstream.stats['max_messages']
+        start_chat(client, server, "What can you do?")
+    # The second turn was sent with the first turn's question and answer
+    assert upstream.stats['max_messages'] == first_turn + 2
+
+
+def test_an_answer_is_saved_after_its_stream_is_evicted(upstream, start_server):
+    # With room for one stream, the second user's stream evicts the first user's
+    url = start_server('stream', CHAT_STREAM_REPLAY_MAX_STREAMS=1, **STREAM_SETTINGS)
+    with httpx.Client(timeout=30) as first_user, httpx.Client(timeout=30) as second_user:
+        start_chat(first_user, url, "Who are you?")
+        first_turn = upstream.stats['max_messages']
+        start_chat(second_user, url, "Who are you?")
+        start_chat(first_user, url, "What can you do?")
+    assert upstream.stats['max_messages'] == first_turn + 2
+
+
+def test_ending_an_ended_conversation_is_a_conflict(server):
+    with httpx.Client(timeout=30) as client:
+        state = start_chat(client, server, "Who are you?")
+        end_chat(client, server, state)
+        response = end_chat(client, server, state)
+    assert response.status_code == 409
+
+
+def test_a_whole_conversation_is_accepted_after_a_conflict(upstream, server):
+    # A client that gets a 409 falls back to uploading the conversation it holds
+    with httpx.Client(timeout=30) as client:
+        state = start_chat(client, server, "Who are you?")
+        end_chat(client, server, state)
+        end_chat(client, server, state)
+        response = client.post(f"{server}/api/chat/end", json=[{"role": "user", "content": "Who are you?"},
+                                                              {"role": "assistant", "content": state['text']}])
+    assert response.status_code == 200
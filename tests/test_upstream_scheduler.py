@@ -0,0 +1,81 @@
+# Rate limit scheduling of upstream calls (server/upstream_scheduler.py) against the fake
+# upstream's simulated limits
+import openai
+import pytest
+
+from upstream_scheduler import UpstreamBusy, UpstreamScheduler
+
+UPSTREAM_RPM = 60
+# Configured a little below the upstream's limit, as the README recommends
+CONFIGURED_RPM = 57
+QUESTION = [{"role": "user", "content": "Who are you?"}]
+
+
+@pytest.fixture
+def create(upstream):
+    # Starts one completion and returns its raw response, as the servers pass it to the scheduler
+    upstream.configure(TTFT_SECONDS=0)
+    client = openai.OpenAI(api_key="fake", base_url=upstream.base_url, max_retries=0)
+    return lambda: client.chat.completions.with_raw_response.create(model="gpt-4o", messages=QUESTION,
+                                                                    max_completion_tokens=20)
+
+
+def fail_first_attempt(upstream, create, before_failure=None):
+    # create() whose first attempt gets a 429 with only a Retry-After header
+    attempts = []
+
+    def create_once():
+        if not attempts and before_failure is not None:
+            before_failure()
+        upstream.configure(ERROR_RATE=0.0 if attempts else 1.0, ERROR_STATUS=429)
+        attempts.append(True)
+        return create()
+    return create_once
+
+
+def burst_past_the_budget(upstream, create):
+    # Two calls more than the configured budget, one after the other
+    upstream.rate_limit(UPSTREAM_RPM)
+    scheduler = UpstreamScheduler(requests_per_minute=CONFIGURED_RPM)
+    for _ in range(CONFIGURED_RPM + 2):
+        scheduler.call(create, 30)
+    return scheduler
+
+
+def test_configured_limits_keep_calls_under_the_upstream_limit(upstream, create):
+    burst_past_the_budget(upstream, create)
+    assert upstream.stats['rate_limited'] == 0
+
+
+def test_calls_past_the_budget_wait_for_it(upstream, create):
+    scheduler = burst_past_the_budget(upstream, create)
+    assert scheduler.stats()['delayed'] == 2
+
+
+def test_a_call_that_would_wait_past_its_deadline_is_rejected(upstream, create):
+    scheduler = UpstreamScheduler(requests_per_minute=1, queue_timeout=0.2)
+    scheduler.call(create, 30)
+    with pytest.raises(UpstreamBusy):
+        scheduler.call(create, 30)
+
+
+def test_a_rate_limited_call_is_retried(upstream, create):
+    scheduler = UpstreamScheduler()
+    response = scheduler.call(fail_first_attempt(upstream, create), 30)
+    assert response.choices[0].message.content == upstream.answer
+
+
+def test_a_rate_limited_call_is_charged_once(upstream, create):
+    # 6 per minute refills 0.1 per second, so the budget left shows what the call was charged
+    scheduler = UpstreamScheduler(requests_per_minute=6)
+    scheduler.call(fail_first_attempt(upstream, create), 30)
+    assert scheduler.requests.level == pytest.approx(5, abs=0.5)
+
+
+def test_a_limit_learned_after_reserving_is_not_refunded(upstream, create):
+    # Another call's response sets the limit while this one is in flight. This one reserved
+    # nothing, so its 429 gives nothing back and the retry waits for the budget.
+    scheduler = UpstreamScheduler()
+    headers = {'x-ratelimit-limit-requests': '60', 'x-ratelimit-remaining-requests': '0'}
+    scheduler.call(fail_first_attempt(upstream, create, lambda: scheduler.observe(headers)), 30)
+    assert scheduler.requests.level < -0.5